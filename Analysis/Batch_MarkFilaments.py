@@ -0,0 +1,240 @@
+"""
+Parallel batch marking of cells with the Coli-Inspector macro "Mark Filaments".
+
+The linked images of a project are split into contiguous image ranges, one per worker. Each worker is a
+separate Fiji instance opening its own copy of the project, in which the macro "AutoRun" marks the range
+unattended and exports the marked objects. The ImgNo of each object is the same as when all images are
+marked one after the other in a single session: every range starts at the number of slices x frames of the
+images before it. The exported objects are merged into one file that is imported into the original
+project with the macro "Import Marked Objects".
+
+Usage:
+	1. Open the project in Fiji and run "Export Image List" (writes <project>-Images.txt).
+	2. python Batch_MarkFilaments.py all <project>.ojj --fiji <Fiji executable> --workers 4
+	3. In the original project run "Import Marked Objects" with <project>-MergedObjects.txt, then "Rebuild Map".
+
+Requires tifffile.
+"""
+import argparse
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import tifffile
+
+OBJECT_COLUMNS = ["Image", "ImageName", "StackIndex", "ImgNo", "Thr", "StartX", "StartY", "AxisX", "AxisY", "DiaX", "DiaY", "Object", "ObjectID", "PixelSize"]
+
+def get_project_files(project_path):
+	"""Returns the folder and the name without extension of a project, as used by the macro for its side files."""
+	project_dir, project_file = os.path.split(os.path.abspath(project_path))
+	return project_dir, os.path.splitext(project_file)[0]
+
+def read_image_list(project_path):
+	"""
+	Reads the linked images written by the macro "Export Image List".
+	:return: List of image names in project order (image 1 first).
+	"""
+	project_dir, project_name = get_project_files(project_path)
+	list_path = os.path.join(project_dir, project_name + "-Images.txt")
+	if not os.path.exists(list_path):
+		sys.exit("Image list not found: {}\nRun 'Export Image List' in the project first.".format(list_path))
+	with open(list_path, newline="") as f:
+		rows = list(csv.DictReader(f, delimiter="\t"))
+	rows.sort(key=lambda row: int(row["Image"]))
+	return [row["ImageName"] for row in rows]
+
+def count_planes(image_path):
+	"""
+	Counts the planes marked per image (slices x frames), matching Stack.getDimensions in the macro.
+	Only the TIFF header is read.
+	"""
+	with tifffile.TiffFile(image_path) as tif:
+		metadata = tif.imagej_metadata or {}
+		if "slices" in metadata or "frames" in metadata:
+			return int(metadata.get("slices", 1)) * int(metadata.get("frames", 1))
+		images = int(metadata.get("images", len(tif.pages)))
+		return max(1, images // int(metadata.get("channels", 1)))
+
+def split_images(plane_counts, n_workers):
+	"""
+	Splits the images into at most n_workers contiguous ranges with similar numbers of planes.
+	:return: List of (first image, last image) tuples, 1-based and inclusive.
+	"""
+	n_workers = max(1, min(n_workers, len(plane_counts)))
+	total = float(sum(plane_counts))
+	ranges = []
+	first = 1
+	done = 0
+	for img, planes in enumerate(plane_counts, start=1):
+		done += planes
+		remaining_workers = n_workers - len(ranges) - 1
+		remaining_images = len(plane_counts) - img
+		if remaining_workers > 0 and (done >= total * (len(ranges) + 1) / n_workers or remaining_images == remaining_workers):
+			ranges.append((first, img))
+			first = img + 1
+	ranges.append((first, len(plane_counts)))
+	return ranges
+
+def get_worker_name(project_name, worker):
+	return "{}_worker{}".format(project_name, worker)
+
+def prepare(project_path, n_workers, gc_interval):
+	"""
+	Copies the project once per worker and writes the settings file of each copy.
+	:return: List of worker dicts (name, project, firstImg, lastImg, imgNoOffset, planes).
+	"""
+	project_dir, project_name = get_project_files(project_path)
+	images = read_image_list(project_path)
+	plane_counts = [count_planes(os.path.join(project_dir, image)) for image in images]
+	offsets = [sum(plane_counts[:i]) for i in range(len(plane_counts))]
+
+	workers = []
+	for worker, (first_img, last_img) in enumerate(split_images(plane_counts, n_workers), start=1):
+		name = get_worker_name(project_name, worker)
+		worker_project = os.path.join(project_dir, name + ".ojj")
+		shutil.copyfile(project_path, worker_project)
+		for suffix in ("-Objects.txt", "-Done.txt"):
+			if os.path.exists(os.path.join(project_dir, name + suffix)):
+				os.remove(os.path.join(project_dir, name + suffix))
+		settings = {
+			"firstImg": first_img,
+			"lastImg": last_img,
+			"imgNoOffset": offsets[first_img - 1],
+			"gcInterval": gc_interval
+		}
+		with open(os.path.join(project_dir, name + "-Shard.txt"), "w", newline="\n") as f:
+			for key, value in settings.items():
+				f.write("{}={}\n".format(key, value))
+		workers.append(dict(settings, name=name, project=worker_project, planes=sum(plane_counts[first_img - 1:last_img])))
+		print("{}: images {}-{}, {} planes, ImgNo from {}".format(name, first_img, last_img, workers[-1]["planes"], settings["imgNoOffset"]))
+
+	with open(os.path.join(project_dir, project_name + "-Workers.csv"), "w", newline="") as f:
+		writer = csv.DictWriter(f, fieldnames=["name", "project", "firstImg", "lastImg", "imgNoOffset", "planes", "gcInterval"])
+		writer.writeheader()
+		writer.writerows(workers)
+	return workers
+
+def read_workers(project_path):
+	project_dir, project_name = get_project_files(project_path)
+	manifest_path = os.path.join(project_dir, project_name + "-Workers.csv")
+	if not os.path.exists(manifest_path):
+		sys.exit("Workers not prepared: {} not found".format(manifest_path))
+	with open(manifest_path, newline="") as f:
+		workers = list(csv.DictReader(f))
+	for worker in workers:
+		for key in ("firstImg", "lastImg", "imgNoOffset", "planes"):
+			worker[key] = int(worker[key])
+	return workers
+
+def run_workers(project_path, fiji_path, command, timeout_minutes):
+	"""
+	Starts one Fiji instance per worker and waits until every worker has written its done file.
+	:return: Number of seconds until all workers were done.
+	"""
+	project_dir, project_name = get_project_files(project_path)
+	workers = read_workers(project_path)
+	processes = {}
+	start_time = time.time()
+	for worker in workers:
+		args = command.format(fiji=fiji_path, project=worker["project"])
+		processes[worker["name"]] = subprocess.Popen(args, shell=True, cwd=project_dir)
+		print("Started {}".format(worker["name"]))
+
+	pending = set(processes)
+	while pending:
+		time.sleep(5)
+		for name in sorted(pending):
+			if os.path.exists(os.path.join(project_dir, name + "-Done.txt")):
+				print("{} done after {:.1f} min".format(name, (time.time() - start_time) / 60))
+				pending.discard(name)
+			elif processes[name].poll() is not None:
+				print("{} stopped without finishing (exit code {})".format(name, processes[name].returncode))
+				pending.discard(name)
+		if timeout_minutes and time.time() - start_time > timeout_minutes * 60:
+			print("Timeout, unfinished workers: {}".format(", ".join(sorted(pending))))
+			break
+	elapsed = time.time() - start_time
+
+	# Workers quit Fiji themselves; stop those that did not
+	for name, process in processes.items():
+		try:
+			process.wait(timeout=30)
+		except subprocess.TimeoutExpired:
+			process.kill()
+	return elapsed
+
+def merge(project_path, elapsed_seconds=None):
+	"""
+	Merges the objects exported by all workers in image order and checks that the ImgNo ranges do not overlap.
+	:return: Path of the merged file.
+	"""
+	project_dir, project_name = get_project_files(project_path)
+	workers = read_workers(project_path)
+	merged_rows = []
+	for worker in workers:
+		objects_path = os.path.join(project_dir, worker["name"] + "-Objects.txt")
+		if not os.path.exists(os.path.join(project_dir, worker["name"] + "-Done.txt")) or not os.path.exists(objects_path):
+			sys.exit("{} has not finished; rerun it before merging".format(worker["name"]))
+		with open(objects_path, newline="") as f:
+			reader = csv.DictReader(f, delimiter="\t")
+			if reader.fieldnames != OBJECT_COLUMNS:
+				sys.exit("Unexpected columns in {}: {}".format(objects_path, reader.fieldnames))
+			rows = list(reader)
+		for row in rows:
+			img, img_no = int(row["Image"]), int(float(row["ImgNo"]))
+			if not worker["firstImg"] <= img <= worker["lastImg"]:
+				sys.exit("{}: image {} is outside its range {}-{}".format(worker["name"], img, worker["firstImg"], worker["lastImg"]))
+			if not worker["imgNoOffset"] <= img_no < worker["imgNoOffset"] + worker["planes"]:
+				sys.exit("{}: ImgNo {} is outside its range {}-{}".format(worker["name"], img_no, worker["imgNoOffset"], worker["imgNoOffset"] + worker["planes"] - 1))
+		merged_rows.extend(rows)
+		print("{}: {} objects".format(worker["name"], len(rows)))
+
+	merged_rows.sort(key=lambda row: (int(row["Image"]), int(row["StackIndex"])))
+	for obj, row in enumerate(merged_rows, start=1):
+		row["Object"] = obj # Index after "Import Marked Objects" into an unmarked project
+	merged_path = os.path.join(project_dir, project_name + "-MergedObjects.txt")
+	with open(merged_path, "w", newline="") as f:
+		writer = csv.DictWriter(f, fieldnames=OBJECT_COLUMNS, delimiter="\t", lineterminator="\n")
+		writer.writeheader()
+		writer.writerows(merged_rows)
+	print("Merged {} objects into {}".format(len(merged_rows), merged_path))
+	if elapsed_seconds:
+		print("Speed: {:.0f} cells/min with {} workers".format(len(merged_rows) / (elapsed_seconds / 60.0), len(workers)))
+	return merged_path
+
+def clean(project_path):
+	"""Deletes the worker copies of the project and their side files."""
+	project_dir, project_name = get_project_files(project_path)
+	for worker in read_workers(project_path):
+		for suffix in (".ojj", "-Shard.txt", "-Objects.txt", "-Done.txt"):
+			path = os.path.join(project_dir, worker["name"] + suffix)
+			if os.path.exists(path):
+				os.remove(path)
+	os.remove(os.path.join(project_dir, project_name + "-Workers.csv"))
+
+def main():
+	parser = argparse.ArgumentParser(description="Parallel 'Mark Filaments' for Coli-Inspector projects")
+	parser.add_argument("step", choices=["prepare", "run", "merge", "all", "clean"])
+	parser.add_argument("project", help="Coli-Inspector project (.ojj) with linked images")
+	parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of parallel Fiji instances")
+	parser.add_argument("--gc-interval", type=int, default=20, help="garbage collection every n slices in workers")
+	parser.add_argument("--fiji", default="ImageJ-win64.exe", help="Fiji executable")
+	parser.add_argument("--command", default='"{fiji}" "{project}"', help="command starting one worker; {fiji} and {project} are replaced")
+	parser.add_argument("--timeout", type=float, default=0, help="stop waiting for workers after this many minutes (0 = no limit)")
+	args = parser.parse_args()
+
+	elapsed = None
+	if args.step in ("prepare", "all"):
+		prepare(args.project, args.workers, args.gc_interval)
+	if args.step in ("run", "all"):
+		elapsed = run_workers(args.project, args.fiji, args.command, args.timeout)
+	if args.step in ("merge", "all"):
+		merge(args.project, elapsed)
+	if args.step == "clean":
+		clean(args.project)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,233 @@
+"""
+Runs a MicrobeJ template over many preprocessed hyperstacks in parallel Fiji instances.
+
+For every input image a job folder is created in the output folder with a copy of the template, in which the
+image folder, the hyperstack name and the experiment name point to the input, and a macro that opens the
+image, runs MicrobeJ with the template and quits Fiji. The jobs are run by a configurable number of worker
+processes, each starting its own Fiji. Progress is kept in <output>/manifest.csv (input, status, time and
+result files per job); finished jobs are skipped when the batch is run again.
+
+MicrobeJ is started by a macro snippet that depends on the MicrobeJ version. Record it once with
+Plugins > Macros > Record while running MicrobeJ on one image, save the recorded lines as a text file and
+replace the paths by {image}, {template}, {output} and {name}.
+
+Usage:
+	python Batch_MicrobeJ.py MJtemplate_RecNinDNA_tracking.xml "D:/Preprocessed/*.tif" --macro microbej.ijm --fiji <Fiji executable> --output D:/MicrobeJ --workers 4
+
+Requires Python 3 only.
+"""
+import argparse
+import csv
+import glob
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+MANIFEST_COLUMNS = ["input", "name", "output", "status", "returncode", "seconds", "results"]
+JOB_FILES = ("template.xml", "run.ijm", "worker.log", "done.txt")
+# Template entries pointing to the analysed image, set for every job
+IMAGE_DIRECTORY_IDS = ("IMAGE_DIRECTORY", "BATCH_FOLDER")
+IMAGE_NAME_IDS = ("IMAGE_NAME_HYPERSTACK",)
+EXPERIMENT_NAME_ID = "NAME"
+
+def set_template_strings(template_text, values):
+	"""
+	Sets the value of every <string id="..."> element with one of the given ids, keeping the rest of the
+	template unchanged.
+	:param values: Dict of element id to new value.
+	"""
+	for element_id, value in values.items():
+		pattern = re.compile(r'<string id="{}"(?:/>|>[^<]*</string>)'.format(re.escape(element_id)))
+		replacement = '<string id="{}">{}</string>'.format(element_id, escape(value)) if value else '<string id="{}"/>'.format(element_id)
+		template_text = pattern.sub(lambda match: replacement, template_text)
+	return template_text
+
+def set_experiment_name(template_text, name):
+	"""Sets the experiment name, the last NAME entry of the template (other NAME entries name classes or clusters)."""
+	matches = list(re.finditer(r'<string id="{}"(?:/>|>[^<]*</string>)'.format(EXPERIMENT_NAME_ID), template_text))
+	if not matches:
+		return template_text
+	last = matches[-1]
+	return template_text[:last.start()] + '<string id="{}">{}</string>'.format(EXPERIMENT_NAME_ID, escape(name)) + template_text[last.end():]
+
+def write_job_template(template_path, image_path, name, job_template_path):
+	with open(template_path, encoding="utf-8", newline="") as f:
+		text = f.read()
+	image_dir = os.path.dirname(os.path.abspath(image_path)).replace("\\", "/") + "/"
+	values = dict((element_id, image_dir) for element_id in IMAGE_DIRECTORY_IDS)
+	values.update((element_id, os.path.basename(image_path)) for element_id in IMAGE_NAME_IDS)
+	text = set_experiment_name(set_template_strings(text, values), name)
+	with open(job_template_path, "w", encoding="utf-8", newline="") as f:
+		f.write(text)
+
+def macro_path(path):
+	"""Path with forward slashes, which the macro language accepts on all platforms."""
+	return os.path.abspath(path).replace("\\", "/")
+
+def write_job_macro(microbej_macro, image_path, name, job_dir):
+	"""Writes the macro run by the worker Fiji: open the image, run MicrobeJ, mark the job as done and quit."""
+	fields = {
+		"image": macro_path(image_path),
+		"template": macro_path(os.path.join(job_dir, "template.xml")),
+		"output": macro_path(job_dir),
+		"name": name
+	}
+	lines = [
+		"// Written by Batch_MicrobeJ.py",
+		'open("{}");'.format(fields["image"]),
+		microbej_macro.replace("{image}", fields["image"]).replace("{template}", fields["template"])
+			.replace("{output}", fields["output"]).replace("{name}", fields["name"]).rstrip(),
+		'File.saveString("done", "{}");'.format(macro_path(os.path.join(job_dir, "done.txt"))),
+		'eval("js", "java.lang.System.exit(0);");',
+		""
+	]
+	with open(os.path.join(job_dir, "run.ijm"), "w", newline="\n") as f:
+		f.write("\n".join(lines))
+
+def expand_inputs(patterns, list_path=None):
+	"""
+	Expands file names and glob patterns, and the lines of an optional list file, to image paths in a stable order.
+	"""
+	if list_path:
+		with open(list_path) as f:
+			patterns = list(patterns) + [line.strip() for line in f if line.strip() and not line.startswith("#")]
+	images = []
+	for pattern in patterns:
+		matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+		for path in matches:
+			if not os.path.isfile(path):
+				sys.exit("Input not found: {}".format(path))
+			if os.path.abspath(path) not in images:
+				images.append(os.path.abspath(path))
+	return images
+
+def get_job_names(images):
+	"""Job names from the image names; images with the same name in different folders get a number appended."""
+	names = []
+	for image in images:
+		base = os.path.splitext(os.path.basename(image))[0]
+		name = base
+		count = 1
+		while name in names:
+			count += 1
+			name = "{}_{}".format(base, count)
+		names.append(name)
+	return names
+
+class Manifest:
+	"""Manifest of all jobs, rewritten after every finished job so that an interrupted batch can be resumed."""
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.rows = {}
+		if os.path.exists(path):
+			with open(path, newline="") as f:
+				for row in csv.DictReader(f):
+					self.rows[row["name"]] = row
+
+	def update(self, row):
+		with self.lock:
+			self.rows[row["name"]] = row
+			with open(self.path + ".tmp", "w", newline="") as f:
+				writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+				writer.writeheader()
+				writer.writerows(self.rows[name] for name in sorted(self.rows))
+			os.replace(self.path + ".tmp", self.path)
+
+def list_results(job_dir):
+	return sorted(entry for entry in os.listdir(job_dir) if entry not in JOB_FILES)
+
+def run_job(image, name, job_dir, fiji_path, command, timeout_minutes):
+	"""
+	Runs one job in its own Fiji and waits until Fiji has quit.
+	:return: Manifest row of the job.
+	"""
+	args = command.format(fiji=fiji_path, macro=macro_path(os.path.join(job_dir, "run.ijm")))
+	start_time = time.time()
+	with open(os.path.join(job_dir, "worker.log"), "w") as log:
+		process = subprocess.Popen(args, shell=True, cwd=job_dir, stdout=log, stderr=subprocess.STDOUT)
+		try:
+			returncode = process.wait(timeout=timeout_minutes * 60 if timeout_minutes else None)
+		except subprocess.TimeoutExpired:
+			process.kill()
+			returncode = process.wait()
+	seconds = time.time() - start_time
+	if os.path.exists(os.path.join(job_dir, "done.txt")):
+		status = "done"
+	elif timeout_minutes and seconds > timeout_minutes * 60:
+		status = "timeout"
+	else:
+		status = "failed"
+	return {
+		"input": image, "name": name, "output": job_dir, "status": status, "returncode": returncode,
+		"seconds": "{:.1f}".format(seconds), "results": ";".join(list_results(job_dir))
+	}
+
+def run_batch(template_path, images, microbej_macro, output_dir, fiji_path, command, n_workers, timeout_minutes, force=False):
+	"""
+	Prepares one job per image and runs the jobs in parallel.
+	:return: Dict of job name to manifest row.
+	"""
+	if not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+	manifest = Manifest(os.path.join(output_dir, "manifest.csv"))
+	jobs = []
+	for image, name in zip(images, get_job_names(images)):
+		job_dir = os.path.join(output_dir, name)
+		if not force and os.path.exists(os.path.join(job_dir, "done.txt")):
+			print("{}: already done".format(name))
+			continue
+		if not os.path.isdir(job_dir):
+			os.makedirs(job_dir)
+		if os.path.exists(os.path.join(job_dir, "done.txt")):
+			os.remove(os.path.join(job_dir, "done.txt"))
+		write_job_template(template_path, image, name, os.path.join(job_dir, "template.xml"))
+		write_job_macro(microbej_macro, image, name, job_dir)
+		manifest.update({"input": image, "name": name, "output": job_dir, "status": "pending", "returncode": "", "seconds": "", "results": ""})
+		jobs.append((image, name, job_dir))
+
+	start_time = time.time()
+	def run(job):
+		row = run_job(job[0], job[1], job[2], fiji_path, command, timeout_minutes)
+		manifest.update(row)
+		print("{}: {} after {} s, {} result file(s)".format(row["name"], row["status"], row["seconds"], len(list_results(job[2]))))
+		return row
+
+	with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+		rows = list(executor.map(run, jobs))
+	if jobs:
+		done = sum(1 for row in rows if row["status"] == "done")
+		print("{} of {} jobs done in {:.1f} min with {} workers".format(done, len(jobs), (time.time() - start_time) / 60, n_workers))
+	return manifest.rows
+
+def main():
+	parser = argparse.ArgumentParser(description="Run a MicrobeJ template over many hyperstacks in parallel Fiji instances")
+	parser.add_argument("template", help="MicrobeJ template (.xml)")
+	parser.add_argument("inputs", nargs="*", help="images or glob patterns, e.g. \"D:/Preprocessed/*.tif\"")
+	parser.add_argument("--list", help="text file with one image or glob pattern per line")
+	parser.add_argument("--macro", required=True, help="macro snippet running MicrobeJ; {image}, {template}, {output} and {name} are replaced")
+	parser.add_argument("--output", default="MicrobeJ_batch", help="output folder with one job folder per image and manifest.csv")
+	parser.add_argument("--workers", type=int, default=2, help="number of parallel Fiji instances")
+	parser.add_argument("--fiji", default="ImageJ-win64.exe", help="Fiji executable")
+	parser.add_argument("--command", default='"{fiji}" -macro "{macro}"', help="command starting one worker; {fiji} and {macro} are replaced")
+	parser.add_argument("--timeout", type=float, default=0, help="stop a job after this many minutes (0 = no limit)")
+	parser.add_argument("--force", action="store_true", help="also run jobs that are already done")
+	args = parser.parse_args()
+
+	images = expand_inputs(args.inputs, args.list)
+	if not images:
+		parser.error("no input images")
+	with open(args.macro) as f:
+		microbej_macro = f.read()
+	rows = run_batch(args.template, images, microbej_macro, args.output, args.fiji, args.command, args.workers, args.timeout, args.force)
+	failed = [row["name"] for row in rows.values() if row["status"] != "done"]
+	if failed:
+		print("Not done: {}".format(", ".join(failed)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,186 @@
+"""
+Speed and accuracy benchmark of Foci_Engine.py on synthetic time-lapses.
+
+Cells are placed on a grid of a label image. Every cell contains foci that move by a random walk; the foci are
+rendered as Gaussian spots on a noisy background. The benchmark reports the time for detection, assignment to
+cells and linking, the fraction of true foci that were detected, and the fraction of true frame-to-frame steps
+that were linked into the same track.
+
+A smaller time-lapse is then written as hyperstack together with an objects file as written by "Export Objects",
+which also holds objects of another image at the same positions, and processed with Foci_Engine.process_hyperstack.
+The check reports the fraction of foci assigned to the right object and fails if foci were assigned to objects of
+the other image.
+
+Usage:
+	python Benchmark_Foci_Engine.py --size 2048 --frames 20 --cells 4000
+
+Requires numpy, pandas, scipy and tifffile.
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy.spatial import cKDTree
+
+import Batch_MarkFilaments
+import Foci_Engine
+
+OTHER_IMAGE_OFFSET = 100000 # Added to the ObjectIDs of the objects of the other image in the entry point check
+
+def create_cells(size, n_cells, cell_size=(24, 10)):
+	"""Label image with rectangular cells on a grid. :return: A tuple (labels, list of (x0, y0, x1, y1))."""
+	columns = max(1, int(np.sqrt(n_cells * cell_size[1] / float(cell_size[0]))))
+	rows = int(np.ceil(n_cells / float(columns)))
+	pitch_x, pitch_y = size // columns, size // rows
+	if pitch_x <= cell_size[0] + 2 or pitch_y <= cell_size[1] + 2:
+		raise ValueError("{} cells do not fit into {} x {} pixels".format(n_cells, size, size))
+	labels = np.zeros((size, size), dtype=np.int32)
+	boxes = []
+	for cell in range(n_cells):
+		x0 = (cell % columns) * pitch_x + (pitch_x - cell_size[0]) // 2
+		y0 = (cell // columns) * pitch_y + (pitch_y - cell_size[1]) // 2
+		labels[y0:y0 + cell_size[1], x0:x0 + cell_size[0]] = cell + 1
+		boxes.append((x0, y0, x0 + cell_size[0], y0 + cell_size[1]))
+	return labels, boxes
+
+def simulate_tracks(boxes, n_frames, foci_per_cell, step_sigma, rng):
+	"""Random walks confined to the cells. :return: Array of shape (frames, foci, 2) with x, y."""
+	boxes = np.array(boxes, dtype=float)
+	lower = np.repeat(boxes[:, :2] + 2, foci_per_cell, axis=0)
+	upper = np.repeat(boxes[:, 2:] - 3, foci_per_cell, axis=0)
+	positions = np.empty((n_frames, len(lower), 2))
+	positions[0] = lower + rng.random(lower.shape) * (upper - lower)
+	for frame in range(1, n_frames):
+		positions[frame] = np.clip(positions[frame - 1] + rng.normal(0, step_sigma, lower.shape), lower, upper)
+	return positions
+
+def render_frames(positions, size, amplitude, background, noise, rng, sigma=1.2):
+	"""Renders the foci as Gaussian spots (7 x 7 pixels each) with Gaussian noise."""
+	frames = np.full((len(positions), size, size), background, dtype=np.float32)
+	offsets = np.arange(-3, 4)
+	for frame, points in enumerate(positions):
+		cx, cy = np.floor(points[:, 0]).astype(int), np.floor(points[:, 1]).astype(int)
+		xs = cx[:, None, None] + offsets[None, None, :]
+		ys = cy[:, None, None] + offsets[None, :, None]
+		values = amplitude * np.exp(-((xs - points[:, 0, None, None]) ** 2 + (ys - points[:, 1, None, None]) ** 2) / (2 * sigma ** 2))
+		np.add.at(frames[frame], (np.broadcast_to(ys, values.shape).ravel(), np.broadcast_to(xs, values.shape).ravel()), values.ravel())
+	frames += rng.normal(0, noise, frames.shape).astype(np.float32)
+	return frames
+
+def run_benchmark(size, n_frames, n_cells, foci_per_cell, step_sigma, snr, seed):
+	rng = np.random.default_rng(seed)
+	labels, boxes = create_cells(size, n_cells)
+	truth = simulate_tracks(boxes, n_frames, foci_per_cell, step_sigma, rng)
+	frames = render_frames(truth, size, amplitude=snr * 10.0, background=100.0, noise=10.0, rng=rng)
+
+	timings = {}
+	start_time = time.time()
+	parts = []
+	for first in range(0, n_frames, Foci_Engine.BLOCK_FRAMES):
+		block = Foci_Engine.detect_foci(frames[first:first + Foci_Engine.BLOCK_FRAMES])
+		block["frame"] = block.pop("frame_index") + first + 1
+		parts.append(block)
+	foci = Foci_Engine.pd.concat(parts, ignore_index=True)
+	timings["detection"] = time.time() - start_time
+
+	start_time = time.time()
+	rows = np.clip(np.round(foci["y"].to_numpy()).astype(int), 0, size - 1)
+	columns = np.clip(np.round(foci["x"].to_numpy()).astype(int), 0, size - 1)
+	foci["cell"] = labels[rows, columns]
+	timings["assignment"] = time.time() - start_time
+
+	start_time = time.time()
+	foci["track"] = Foci_Engine.link_foci(foci, max_distance=max(2.0, 4 * step_sigma), max_gap=1, same_cell=True)
+	timings["linking"] = time.time() - start_time
+
+	# Match every true focus to the nearest detection within 1.5 pixels
+	matched = np.full(truth.shape[:2], -1)
+	for frame in range(n_frames):
+		selected = np.nonzero(foci["frame"].to_numpy() == frame + 1)[0]
+		if len(selected) == 0:
+			continue
+		distance, nearest = cKDTree(foci[["x", "y"]].to_numpy()[selected]).query(truth[frame], distance_upper_bound=1.5)
+		found = np.isfinite(distance)
+		matched[frame, found] = selected[nearest[found]]
+	recall = np.mean(matched >= 0)
+	tracks = foci["track"].to_numpy()
+	steps = (matched[:-1] >= 0) & (matched[1:] >= 0)
+	correct = tracks[matched[:-1][steps]] == tracks[matched[1:][steps]]
+	link_accuracy = np.mean(correct) if correct.size else float("nan")
+	return timings, len(foci), truth.shape[1], recall, link_accuracy
+
+def write_objects(objects_path, images, boxes, n_frames):
+	"""
+	Objects file as written by "Export Objects", with one object per cell and frame of every image.
+	The axis runs along the middle of the cell and the Dia item across it.
+	:param images: List of (image name, first ObjectID).
+	"""
+	with open(objects_path, "w", newline="") as f:
+		writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+		writer.writerow(Batch_MarkFilaments.OBJECT_COLUMNS)
+		obj = 0
+		for image, (image_name, first_id) in enumerate(images):
+			for frame in range(1, n_frames + 1):
+				for cell, (x0, y0, x1, y1) in enumerate(boxes):
+					obj += 1
+					middle_x, middle_y = (x0 + x1 - 1) / 2.0, (y0 + y1 - 1) / 2.0
+					writer.writerow([image + 1, image_name, frame, frame - 1, 0, x0, middle_y,
+						"{} {}".format(x0, x1 - 1), "{} {}".format(middle_y, middle_y),
+						"{} {}".format(middle_x, middle_x), "{} {}".format(y0, y1),
+						obj, first_id + cell, 1])
+
+def check_entry_point(n_frames, n_cells, foci_per_cell, step_sigma, snr, seed, size=512):
+	"""
+	Runs Foci_Engine.process_hyperstack on a time-lapse with an objects file of two images.
+	:return: A tuple (number of foci, fraction assigned to the right object, number assigned to the other image).
+	"""
+	rng = np.random.default_rng(seed)
+	labels, boxes = create_cells(size, n_cells)
+	truth = simulate_tracks(boxes, n_frames, foci_per_cell, step_sigma, rng)
+	frames = render_frames(truth, size, amplitude=snr * 10.0, background=100.0, noise=10.0, rng=rng)
+	with tempfile.TemporaryDirectory() as folder:
+		image_path = os.path.join(folder, "Benchmark.tif")
+		objects_path = os.path.join(folder, "Benchmark-Objects.txt")
+		tifffile.imwrite(image_path, frames, imagej=True, metadata={"axes": "TYX"})
+		write_objects(objects_path, [("Other.tif", OTHER_IMAGE_OFFSET + 1), (os.path.basename(image_path), 1)], boxes, n_frames)
+		foci = pd.read_csv(Foci_Engine.process_hyperstack(image_path, 1, objects_path=objects_path,
+			max_distance=max(2.0, 4 * step_sigma), same_cell=True))
+	rows = np.clip(np.round(foci["LOCATION.y"].to_numpy()).astype(int), 0, size - 1)
+	columns = np.clip(np.round(foci["LOCATION.x"].to_numpy()).astype(int), 0, size - 1)
+	inside = labels[rows, columns] > 0
+	correct = np.mean(foci["PARENT.id"].to_numpy()[inside] == labels[rows, columns][inside]) if inside.any() else float("nan")
+	return len(foci), correct, int(np.sum(foci["PARENT.id"].to_numpy() > OTHER_IMAGE_OFFSET))
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark of Foci_Engine.py on synthetic tracks")
+	parser.add_argument("--size", type=int, default=2048, help="image width and height in pixels")
+	parser.add_argument("--frames", type=int, default=20)
+	parser.add_argument("--cells", type=int, default=4000)
+	parser.add_argument("--foci-per-cell", type=int, default=2)
+	parser.add_argument("--step", type=float, default=0.5, help="SD of the displacement per frame in pixels")
+	parser.add_argument("--snr", type=float, default=8.0, help="spot amplitude / noise SD")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--check-frames", type=int, default=5, help="frames of the entry point check (0 = skip)")
+	args = parser.parse_args()
+
+	timings, n_detected, n_true, recall, link_accuracy = run_benchmark(args.size, args.frames, args.cells, args.foci_per_cell, args.step, args.snr, args.seed)
+	print("Benchmark: {} frames of {} x {} pixels, {} cells, {} foci per frame".format(args.frames, args.size, args.size, args.cells, n_true))
+	for step, seconds in timings.items():
+		print("{}: {:.2f} s ({:.1f} ms/frame)".format(step.capitalize(), seconds, 1000 * seconds / args.frames))
+	print("Detected: {} foci, recall {:.3f}".format(n_detected, recall))
+	print("Correctly linked steps: {:.3f}".format(link_accuracy))
+
+	if args.check_frames > 0:
+		n_foci, correct, other_image = check_entry_point(args.check_frames, min(args.cells, 200), args.foci_per_cell, args.step, args.snr, args.seed)
+		print("Entry point with objects: {} foci, {:.3f} assigned to the right object, {} to objects of another image".format(n_foci, correct, other_image))
+		if other_image:
+			sys.exit("Foci were assigned to objects of another image")
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,229 @@
+"""
+Collective profiles of a Coli-Inspector map, grouped by time point or cell age.
+
+Computes the same profiles as the macro "Plot Collective Profiles" in Coli-Inspector-03f-KVmod.txt without its
+per-object loops: the profile of every map column is resampled to 101 points (as Array.resample) once per
+channel, after which each time or age group is a masked mean over the resampled profiles. Profiles are
+normalized to a maximum of 1 and can be averaged with their mirror image ("Symmetrical Plots"). Regrouping
+only repeats the masked means, so different groupings of the same map take seconds.
+
+The time point of a cell is its ImgNo, taken from the exported objects (<project>-Objects.txt), from ObjectJ
+results saved as text, or from the cells table of a results store (Results_Store.py). Age groups need the Age
+column of "Update Map-depending Results", from the saved results or the store. Flipping by a leader channel is
+not done here; save the flipped map of the macro instead.
+
+Usage:
+	python Collective_Profiles.py <project>-Map.tif --objects <project>-Objects.txt --time-groups 4 --plot
+	python Collective_Profiles.py <project>-Map.tif --store <store> --experiment <name> --age-groups 3
+
+Requires numpy, pandas and tifffile; matplotlib for --plot.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import Profile_Engine
+
+K100 = 101 # Points per collective profile (0..100 % of the cell axis)
+COLORS = ["magenta", "#00cc00", "#00cccc", "red"]
+
+def resample_profiles(profile_map, channel):
+	"""
+	Resamples the profile of every map column to K100 points with linear interpolation, like Array.resample.
+	:return: A tuple (profiles of shape (columns, K100), mask of columns with a profile).
+	"""
+	columns = np.arange(1, profile_map.shape[2])
+	start = profile_map[channel, 1, columns].astype(int)
+	length = profile_map[channel, 2, columns].astype(int)
+	valid = (start > 0) & (length > 0)
+	x = np.linspace(0, 1, K100)[None, :] * np.maximum(length - 1, 0)[:, None]
+	i1 = np.floor(x).astype(int)
+	i2 = np.minimum(i1 + 1, np.maximum(length - 1, 0)[:, None])
+	fraction = x - i1
+	rows1 = np.clip(start[:, None] + i1, 0, profile_map.shape[1] - 1)
+	rows2 = np.clip(start[:, None] + i2, 0, profile_map.shape[1] - 1)
+	plane = profile_map[channel]
+	profiles = (1 - fraction) * plane[rows1, columns[:, None]] + fraction * plane[rows2, columns[:, None]]
+	profiles[~valid] = 0
+	return profiles, valid
+
+def read_cell_info(objects_path=None, results_path=None, results_key=" ", store_root=None, experiment=None):
+	"""
+	Reads ImgNo and Age of the cells, indexed by object ID.
+	:return: pandas DataFrame with the columns img_no and age (NaN if unknown).
+	"""
+	if store_root is not None:
+		import Results_Store
+		cells = Results_Store.ResultsStore(store_root).read("cells", experiments=[experiment])
+		if cells.empty:
+			sys.exit("Experiment {} not found in {}".format(experiment, store_root))
+	elif objects_path is not None:
+		cells = pd.DataFrame([{"object": cell.obj, "object_id": cell.object_id, "img_no": cell.img_no} for cell in Profile_Engine.read_objects(objects_path)])
+		if results_path is not None:
+			results = pd.read_csv(results_path, sep="\t").rename(columns={results_key: "object"})
+			cells = cells.merge(results, on="object", how="left")
+	else:
+		sys.exit("ImgNo and Age of the cells are needed: give the exported objects or a results store")
+	info = pd.DataFrame({"object_id": cells["object_id"].astype(int)})
+	info["img_no"] = cells["ImgNo"] if "ImgNo" in cells else cells["img_no"]
+	info["age"] = cells["Age"] if "Age" in cells else np.nan
+	return info.drop_duplicates("object_id").set_index("object_id")
+
+def get_time_groups(max_timegroup, n_groups, widths=None):
+	"""
+	Time groups as in the macro: n_groups of equal width, or the given numbers of time points per group.
+	:return: List of (time start, time bin, title) tuples.
+	"""
+	if widths is None:
+		widths = [max_timegroup / float(n_groups)] * n_groups
+	elif len(widths) != n_groups or sum(widths) != max_timegroup:
+		sys.exit("The total number of timepoints in new groups ({}) does not match the number of timepoints in the data ({})".format(sum(widths), max_timegroup))
+	groups = []
+	time_start = 0
+	for time_bin in widths:
+		first, last = int(np.floor(time_start + 1)), int(np.floor(time_start + time_bin))
+		title = "Timepoint={}".format(first) if first == last else "Timepoint={}-{}".format(first, last)
+		groups.append((time_start, time_bin, title))
+		time_start += time_bin
+	return groups
+
+def get_age_groups(n_groups):
+	age_bin = 1.0 / n_groups
+	groups = []
+	for group in range(n_groups):
+		age_start = group * age_bin
+		title = "" if n_groups == 1 else "age={}-{}%".format(int(round(100 * age_start)), int(round(100 * (age_start + age_bin))))
+		groups.append((age_start, age_bin, title))
+	return groups
+
+def in_time_bin(img_no, time_start, time_bin, max_timegroup):
+	"""Cells of a time group; a group spanning (almost) all time points contains all cells, as in collectiveProfile."""
+	if time_bin >= max_timegroup - 1:
+		return np.ones(len(img_no), dtype=bool)
+	return (img_no >= np.floor(time_start)) & (img_no <= np.floor(time_start + time_bin - 1))
+
+def in_age_bin(age, age_start, age_bin):
+	if age_bin >= 1:
+		return np.ones(len(age), dtype=bool)
+	age = age / 100.0
+	return (age >= age_start) & (age < age_start + age_bin)
+
+def collective_profile(profiles, selected, full_symmetry=False, norm_mean=0, norm_max=1):
+	"""
+	Mean profile of the selected columns, normalized like collectiveProfile.
+	Columns without a profile count as cells but add nothing, as in the macro.
+	"""
+	n_cells = int(np.count_nonzero(selected))
+	with np.errstate(invalid="ignore", divide="ignore"):
+		accu = profiles[selected].sum(axis=0) / n_cells
+		if full_symmetry:
+			accu = (accu + accu[::-1]) / 2
+		if norm_mean != 0:
+			accu = accu * norm_mean / accu.mean()
+		elif norm_max != 0:
+			accu = accu * norm_max / accu.max()
+	return accu, n_cells
+
+def collective_profiles(profile_map, info, channels, time_groups=1, time_widths=None, age_groups=1, full_symmetry=False):
+	"""
+	Collective profiles of all groups and channels.
+	:param channels: 1-based map channels to compute.
+	:return: A tuple (DataFrame with one column per channel and group, list of (group title, cell count)).
+	"""
+	if age_groups != 1 and time_groups != 1:
+		sys.exit("Cannot resolve data by both time and age. Choose only one.")
+	ids = profile_map[0, 0, 1:].astype(int)
+	cell_info = info.reindex(ids)
+	# Empty columns (object ID 0) only exist in uncompacted maps
+	used = ids != 0
+	if time_groups > 1:
+		max_timegroup = info["img_no"].max() + 1 # ImgNo is zero indexed
+		groups = get_time_groups(max_timegroup, time_groups, time_widths)
+		masks = [used & in_time_bin(cell_info["img_no"].to_numpy(), start, width, max_timegroup) for start, width, _ in groups]
+	else:
+		if age_groups > 1 and cell_info["age"].isna().all():
+			sys.exit("Age column is missing; choose: ObjectJ> Update Map-depending Results and save the results")
+		groups = get_age_groups(age_groups)
+		masks = [used & in_age_bin(cell_info["age"].to_numpy(), start, width) for start, width, _ in groups]
+
+	table = {}
+	counts = []
+	resampled = dict((chn, resample_profiles(profile_map, chn - 1)[0]) for chn in channels if chn <= profile_map.shape[0])
+	for (_, _, title), mask in zip(groups, masks):
+		n_cells = 0
+		for chn, profiles in resampled.items():
+			table["ch{}_{}".format(chn, title)], n_cells = collective_profile(profiles, mask, full_symmetry)
+		counts.append((title, n_cells))
+	return pd.DataFrame(table), counts
+
+def plot_profiles(table, counts, channels, colors, mirror_channel, full_symmetry, plot_path):
+	"""Saves one plot per group, stacked vertically, like the plot stack of the macro."""
+	import matplotlib
+	matplotlib.use("Agg")
+	import matplotlib.pyplot as plt
+
+	figure, axes = plt.subplots(len(counts), 1, figsize=(6, 2.8 * len(counts)), squeeze=False)
+	positions = np.arange(K100)
+	for ax, (title, n_cells) in zip(axes[:, 0], counts):
+		for chn in channels:
+			column = "ch{}_{}".format(chn, title)
+			if column not in table:
+				continue
+			ax.plot(positions, table[column], color=colors[chn - 1], linewidth=2, label="ch{}".format(chn))
+			if chn == mirror_channel and not full_symmetry:
+				ax.plot(positions, table[column].to_numpy()[::-1], color=colors[chn - 1], linewidth=1)
+		ax.set_xlim(0, 100)
+		ax.set_ylim(0, 1)
+		ax.set_xlabel("Axial Position [%]")
+		ax.set_ylabel("Local brightness")
+		ax.set_title("{}, n={}".format(title, n_cells) if title else "n={}".format(n_cells), loc="left", fontsize=10)
+		ax.legend(loc="lower right", fontsize=8, frameon=False)
+	figure.tight_layout()
+	figure.savefig(plot_path, dpi=100)
+	plt.close(figure)
+
+def main():
+	parser = argparse.ArgumentParser(description="Collective profiles of a Coli-Inspector map grouped by time or age")
+	parser.add_argument("map", help="map saved from the project or written by Profile_Engine.py")
+	parser.add_argument("--objects", help="<project>-Objects.txt written by 'Export Objects' (default: next to the map)")
+	parser.add_argument("--results", help="ObjectJ results saved as text (ImgNo, Age)")
+	parser.add_argument("--results-key", default=" ", help="column of the object index in the results")
+	parser.add_argument("--store", help="results store with the cells table of the experiment")
+	parser.add_argument("--experiment", help="experiment in the results store")
+	parser.add_argument("--channels", default="2, 3", help="channels to be plotted")
+	parser.add_argument("--time-groups", type=int, default=1, help="time intervals to group")
+	parser.add_argument("--time-widths", help="comma separated numbers of time points per group, overriding equal widths")
+	parser.add_argument("--age-groups", type=int, default=1, help="age groups to resolve")
+	parser.add_argument("--symmetric", action="store_true", help="average each profile with its mirror image")
+	parser.add_argument("--mirror", type=int, default=0, help="show mirror plot of channel (0 = disabled)")
+	parser.add_argument("--colors", default=", ".join(COLORS), help="colors of channels 1..4")
+	parser.add_argument("--output", help="table of profiles (default: <map>-CollectiveProfiles.txt)")
+	parser.add_argument("--plot", action="store_true", help="also save the plots as <output>.png")
+	args = parser.parse_args()
+
+	if args.store is not None and args.experiment is None:
+		parser.error("--store needs --experiment")
+	objects_path = args.objects
+	if objects_path is None and args.store is None:
+		objects_path = os.path.abspath(args.map).replace("-Map.tif", "-Objects.txt")
+	channels = [int(chn) for chn in args.channels.replace(",", " ").split()]
+	time_widths = [float(width) for width in args.time_widths.split(",")] if args.time_widths else None
+
+	profile_map = Profile_Engine.read_map(args.map)
+	info = read_cell_info(objects_path, args.results, args.results_key, args.store, args.experiment)
+	table, counts = collective_profiles(profile_map, info, channels, args.time_groups, time_widths, args.age_groups, args.symmetric)
+
+	output = args.output or os.path.splitext(args.map)[0] + "-CollectiveProfiles.txt"
+	table.to_csv(output, sep="\t", index=False, float_format="%.6g")
+	for title, n_cells in counts:
+		print("{}: n={}".format(title or "All cells", n_cells))
+	print("Profiles written to {}".format(output))
+	if args.plot:
+		colors = [color.strip() for color in args.colors.split(",")]
+		plot_profiles(table, counts, channels, colors, args.mirror, args.symmetric, os.path.splitext(output)[0] + ".png")
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,271 @@
+"""
+Object- and pixel-based colocalization per cell and frame of a hyperstack, e.g. RecA-RecN or RecN-DNA.
+
+Object-based colocalization follows the MicrobeJ options COLOCALIZATION_DISTANCE_MODE and COLOCALIZATION_THRESHOLD:
+	- centroid: distance from every focus of channel A to the nearest focus of channel B (KD-tree per frame).
+	- contour: distance from every focus of channel A to the region of channel B (e.g. the nucleoid), taken from the
+	  distance transform of the region mask; foci inside the region have distance 0.
+The distances are stored per focus, so colocalization at other thresholds only needs the summary to be redone
+(--thresholds, or summarize_cells from Python).
+
+Pixel-based colocalization (Pearson's coefficient and Manders' M1/M2) is computed for all cells of a block of
+frames at once from per-cell sums (np.bincount over cell and frame). Manders' thresholds and the region of
+channel B are the Otsu thresholds of the pixels inside cells of each frame, unless given.
+
+Cells come from a label image (one plane per frame or one for all frames) or from the objects exported from
+Coli-Inspector ("Export Objects"), which are drawn as the pixels within half the cell diameter of the cell axis.
+Foci are read from the tables written by Foci_Engine.py (--foci-a, --foci-b) or detected with its defaults.
+
+Output: <image>-Colocalization.csv (one row per cell and frame) and <image>-ColocFoci.csv (one row per focus of channel A).
+
+Usage:
+	python Colocalization.py <hyperstack.tif> --channels 2 3 --objects <project>-Objects.txt --mode centroid --thresholds 0.1,0.2
+
+Requires numpy, pandas, scipy and tifffile.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+import Foci_Engine
+import Profile_Engine
+
+MODES = ["centroid", "contour"]
+THRESHOLD = 0.1 # Colocalization distance in calibrated units, cf. COLOCALIZATION_THRESHOLD
+
+def otsu_threshold(values, bins=256):
+	"""Otsu threshold of a 1D array of pixel values."""
+	values = values[np.isfinite(values)]
+	if values.size == 0 or values.min() == values.max():
+		return float(values.min()) if values.size else 0.0
+	counts, edges = np.histogram(values, bins=bins)
+	centers = (edges[:-1] + edges[1:]) / 2
+	weight1 = np.cumsum(counts)
+	weight2 = weight1[-1] - weight1
+	sum1 = np.cumsum(counts * centers)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		mean1 = sum1 / weight1
+		mean2 = (sum1[-1] - sum1) / weight2
+		variance = weight1 * weight2 * (mean1 - mean2) ** 2
+	return float(centers[np.nanargmax(variance[:-1])])
+
+def rasterize_cells(cells, shape):
+	"""
+	Label image (ObjectID per pixel) of Coli-Inspector cells of one frame: pixels within half the diameter of the
+	nearest axis point belong to the cell of that point.
+	"""
+	owner = np.zeros(shape, dtype=np.int32)
+	radius = np.zeros(shape, dtype=np.float32)
+	for cell in cells:
+		px, py = Profile_Engine.resample_axis(cell.axis_x, cell.axis_y)
+		rows = np.clip(np.round(py).astype(int), 0, shape[0] - 1)
+		columns = np.clip(np.round(px).astype(int), 0, shape[1] - 1)
+		owner[rows, columns] = cell.object_id
+		radius[rows, columns] = cell.get_dia_length() / 2.0
+	if not owner.any():
+		return owner
+	distance, (nearest_rows, nearest_columns) = ndimage.distance_transform_edt(owner == 0, return_indices=True)
+	labels = owner[nearest_rows, nearest_columns]
+	labels[distance > radius[nearest_rows, nearest_columns]] = 0
+	return labels
+
+class CellLabels:
+	"""Label planes per frame from a label image or from Coli-Inspector objects."""
+	def __init__(self, shape, channels, labels_path=None, objects_path=None, image_name=None):
+		self.shape = shape
+		self.labels = None
+		self.by_frame = {}
+		if labels_path:
+			self.labels = tifffile.imread(labels_path)
+			if self.labels.ndim == 2:
+				self.labels = self.labels[None]
+		elif objects_path:
+			for cell in Profile_Engine.read_objects(objects_path):
+				if image_name and cell.image_name != image_name:
+					continue
+				self.by_frame.setdefault((cell.stack_index - 1) // channels + 1, []).append(cell)
+		else:
+			raise ValueError("Cells are needed: give a label image or Coli-Inspector objects")
+
+	def get_frames(self, first, last):
+		"""Labels of frames first..last (1-based) as array of shape (frames, height, width)."""
+		if self.labels is not None:
+			return np.stack([self.labels[min(frame, len(self.labels)) - 1] for frame in range(first, last + 1)]).astype(np.int64)
+		return np.stack([rasterize_cells(self.by_frame.get(frame, []), self.shape) for frame in range(first, last + 1)]).astype(np.int64)
+
+def pixel_colocalization(a, b, labels, threshold_a, threshold_b):
+	"""
+	Pearson's coefficient and Manders' M1/M2 of every cell of a block of frames.
+	:param a, b: Arrays of shape (frames, height, width).
+	:param labels: Cell labels of the same shape, 0 = background.
+	:param threshold_a, threshold_b: Manders' thresholds per frame.
+	:return: DataFrame with the columns frame_index, cell, pixels, pearson, manders_m1 and manders_m2.
+	"""
+	inside = labels > 0
+	frame_index = np.broadcast_to(np.arange(len(a))[:, None, None], a.shape)[inside]
+	cell = labels[inside]
+	# Blocks without cells (e.g. objects only in some frames) give an empty table
+	cells_per_frame = cell.max() + 1 if cell.size else 1
+	key, index = np.unique(frame_index * cells_per_frame + cell, return_inverse=True)
+	a, b = a[inside].astype(np.float64), b[inside].astype(np.float64)
+	above_a, above_b = a > threshold_a[frame_index], b > threshold_b[frame_index]
+	sums = lambda weights: np.bincount(index, weights=weights, minlength=len(key))
+	n = sums(None)
+	sum_a, sum_b = sums(a), sums(b)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		covariance = sums(a * b) / n - sum_a * sum_b / n ** 2
+		variance_a = sums(a * a) / n - (sum_a / n) ** 2
+		variance_b = sums(b * b) / n - (sum_b / n) ** 2
+		pearson = covariance / np.sqrt(variance_a * variance_b)
+		m1 = sums(a * above_b) / sum_a
+		m2 = sums(b * above_a) / sum_b
+	return pd.DataFrame({
+		"frame_index": key // cells_per_frame,
+		"cell": key % cells_per_frame,
+		"pixels": n.astype(int),
+		"pearson": pearson,
+		"manders_m1": m1,
+		"manders_m2": m2
+	})
+
+def read_foci(foci_path, pixel_size):
+	"""Foci written by Foci_Engine.py, with positions converted back to pixels."""
+	table = pd.read_csv(foci_path)
+	return pd.DataFrame({
+		"id": table["NAME.id"].to_numpy(),
+		"frame": table["POSITION.frame"].to_numpy(),
+		"x": table["LOCATION.x"].to_numpy() / pixel_size,
+		"y": table["LOCATION.y"].to_numpy() / pixel_size
+	})
+
+def detect_foci(stack, channel):
+	foci = Foci_Engine.detect_hyperstack(stack, channel)
+	foci.insert(0, "id", np.arange(1, len(foci) + 1))
+	return foci[["id", "frame", "x", "y"]]
+
+def nearest_focus(foci_a, foci_b):
+	"""Distance in pixels and id of the nearest focus of B in the same frame for every focus of A."""
+	distance = np.full(len(foci_a), np.inf)
+	partner = np.zeros(len(foci_a), dtype=int)
+	frames_a, frames_b = foci_a["frame"].to_numpy(), foci_b["frame"].to_numpy()
+	for frame in np.unique(frames_a):
+		selected_a = np.nonzero(frames_a == frame)[0]
+		selected_b = np.nonzero(frames_b == frame)[0]
+		if len(selected_b) == 0:
+			continue
+		d, nearest = cKDTree(foci_b[["x", "y"]].to_numpy()[selected_b]).query(foci_a[["x", "y"]].to_numpy()[selected_a])
+		distance[selected_a] = d
+		partner[selected_a] = foci_b["id"].to_numpy()[selected_b[nearest]]
+	return distance, partner
+
+def region_distance(foci, frame_numbers, region):
+	"""Distance in pixels from foci to the region mask of a block of frames (0 inside)."""
+	distance = np.full(len(foci), np.inf)
+	frames = foci["frame"].to_numpy()
+	for index, frame in enumerate(frame_numbers):
+		selected = np.nonzero(frames == frame)[0]
+		if len(selected) == 0 or not region[index].any():
+			continue
+		transform = ndimage.distance_transform_edt(~region[index])
+		rows = np.clip(np.round(foci["y"].to_numpy()[selected]).astype(int), 0, region.shape[1] - 1)
+		columns = np.clip(np.round(foci["x"].to_numpy()[selected]).astype(int), 0, region.shape[2] - 1)
+		distance[selected] = transform[rows, columns]
+	return distance
+
+def summarize_cells(cells, foci, thresholds):
+	"""
+	Adds the number of foci of channel A and the number colocalized at each threshold to the per-cell table.
+	:param foci: Per-focus table with the columns frame, cell and distance (calibrated).
+	"""
+	inside = foci[foci["cell"] > 0]
+	grouped = inside.groupby(["frame", "cell"])
+	summary = pd.DataFrame({"foci_a": grouped.size(), "mean_distance": grouped["distance"].mean()})
+	for threshold in thresholds:
+		summary["colocalized_{:g}".format(threshold)] = (inside["distance"] <= threshold).groupby([inside["frame"], inside["cell"]]).sum()
+	cells = cells.merge(summary.reset_index(), on=["frame", "cell"], how="left")
+	for column in ["foci_a"] + ["colocalized_{:g}".format(threshold) for threshold in thresholds]:
+		cells[column] = cells[column].fillna(0).astype(int)
+	return cells
+
+def colocalize(image_path, channel_a, channel_b, labels_path=None, objects_path=None, foci_a_path=None, foci_b_path=None,
+		mode="centroid", thresholds=(THRESHOLD,), manders_a=None, manders_b=None):
+	"""
+	Colocalization of channel A with channel B for all cells and frames of a hyperstack.
+	:return: A tuple (per-cell DataFrame, per-focus DataFrame).
+	"""
+	stack = Foci_Engine.Hyperstack(image_path)
+	try:
+		shape = stack.tif.pages[0].shape
+		cell_labels = CellLabels(shape, stack.channels, labels_path, objects_path, os.path.basename(image_path))
+		foci_a = read_foci(foci_a_path, stack.pixel_size) if foci_a_path else detect_foci(stack, channel_a)
+		if mode == "centroid":
+			foci_b = read_foci(foci_b_path, stack.pixel_size) if foci_b_path else detect_foci(stack, channel_b)
+			distance, partner = nearest_focus(foci_a, foci_b)
+		else:
+			distance = np.full(len(foci_a), np.inf)
+			partner = np.zeros(len(foci_a), dtype=int)
+		foci_a["cell"] = 0
+
+		cell_parts = []
+		for first in range(1, stack.frames + 1, Foci_Engine.BLOCK_FRAMES):
+			last = min(first + Foci_Engine.BLOCK_FRAMES - 1, stack.frames)
+			frame_numbers = np.arange(first, last + 1)
+			a = stack.read_frames(channel_a, first, last)
+			b = stack.read_frames(channel_b, first, last)
+			labels = cell_labels.get_frames(first, last)
+			inside = labels > 0
+			threshold_a = np.array([manders_a if manders_a is not None else otsu_threshold(a[i][inside[i]]) for i in range(len(a))])
+			threshold_b = np.array([manders_b if manders_b is not None else otsu_threshold(b[i][inside[i]]) for i in range(len(b))])
+			cells = pixel_colocalization(a, b, labels, threshold_a, threshold_b)
+			cells.insert(0, "frame", cells.pop("frame_index") + first)
+			cell_parts.append(cells)
+
+			in_block = np.nonzero((foci_a["frame"].to_numpy() >= first) & (foci_a["frame"].to_numpy() <= last))[0]
+			rows = np.clip(np.round(foci_a["y"].to_numpy()[in_block]).astype(int), 0, shape[0] - 1)
+			columns = np.clip(np.round(foci_a["x"].to_numpy()[in_block]).astype(int), 0, shape[1] - 1)
+			foci_a.loc[foci_a.index[in_block], "cell"] = labels[foci_a["frame"].to_numpy()[in_block] - first, rows, columns]
+			if mode == "contour":
+				region = (b > threshold_b[:, None, None]) & inside
+				distance[in_block] = region_distance(foci_a.iloc[in_block], frame_numbers, region)
+	finally:
+		stack.close()
+
+	foci_a["distance"] = distance * stack.pixel_size
+	foci_a["partner"] = partner
+	cells = summarize_cells(pd.concat(cell_parts, ignore_index=True), foci_a, thresholds)
+	return cells, foci_a
+
+def main():
+	parser = argparse.ArgumentParser(description="Object- and pixel-based colocalization per cell and frame")
+	parser.add_argument("image", help="hyperstack")
+	parser.add_argument("--channels", type=int, nargs=2, required=True, metavar=("A", "B"), help="channels A (foci) and B (foci or region), 1-based")
+	parser.add_argument("--labels", help="label image of the cells")
+	parser.add_argument("--objects", help="objects exported from Coli-Inspector")
+	parser.add_argument("--foci-a", help="foci of channel A written by Foci_Engine.py (default: detect)")
+	parser.add_argument("--foci-b", help="foci of channel B written by Foci_Engine.py (default: detect)")
+	parser.add_argument("--mode", choices=MODES, default="centroid", help="distance to the nearest focus (centroid) or to the region (contour) of B")
+	parser.add_argument("--thresholds", default=str(THRESHOLD), help="comma separated colocalization distances (calibrated units)")
+	parser.add_argument("--manders-a", type=float, help="Manders' threshold of channel A (default: Otsu per frame)")
+	parser.add_argument("--manders-b", type=float, help="Manders' threshold of channel B (default: Otsu per frame)")
+	args = parser.parse_args()
+	if not args.labels and not args.objects:
+		parser.error("give --labels or --objects")
+
+	thresholds = [float(threshold) for threshold in args.thresholds.split(",")]
+	cells, foci = colocalize(args.image, args.channels[0], args.channels[1], args.labels, args.objects, args.foci_a, args.foci_b,
+		args.mode, thresholds, args.manders_a, args.manders_b)
+	base = os.path.splitext(args.image)[0]
+	cells.to_csv(base + "-Colocalization.csv", index=False)
+	foci.to_csv(base + "-ColocFoci.csv", index=False)
+	print("{}: {} cell frames, {} foci of channel {}".format(os.path.basename(args.image), len(cells), len(foci), args.channels[0]))
+	for threshold in thresholds:
+		inside = foci["cell"] > 0
+		print("Colocalized within {:g}: {:.1%} of foci in cells".format(threshold, (foci["distance"][inside] <= threshold).mean() if inside.any() else 0))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,311 @@
+"""
+Classification of DNA compaction phenotypes for all cells and frames of many hyperstacks, e.g. a whole ImageXpress plate,
+as an alternative to MJtemplate_ClassifyDNAcompactionPhenotypes.xml.
+
+Features of the DNA channel are computed per cell and frame for blocks of frames at once (np.bincount and
+scipy.ndimage reductions over cell and frame):
+	- area, length (extent along the major axis of the cell) and width in pixels,
+	- nucleoid_area_fraction: fraction of the cell above the nucleoid threshold (Otsu of the pixels in cells per frame),
+	- nucleoid_length_ratio: extent of the nucleoid along the cell axis / cell length,
+	- nucleoid_intensity_fraction: fraction of the DNA signal in the nucleoid,
+	- mean, cv, skewness and kurtosis (excess) of the DNA intensity,
+	- maxima1, maxima2: number of maxima of the axial DNA profile that stand out by more than --tolerance, on a coarse
+	  and a fine smoothing of the profile (as the two maxima detections Maxima1 and Maxima2 of the template).
+
+The phenotypes are assigned by rules, i.e. pandas expressions of the features checked in order (the first match
+wins, cells without match are "Other"). The default rules are those of the template and can be read from another
+template (--template) or a tab separated file (--rules, "<phenotype><TAB><expression>" per line). Alternatively, a
+nearest-centroid model trained on annotated cells ("train") classifies the standardized features (--model).
+
+Output: <image>-Compaction.csv (one row per cell and frame) and Compaction_Summary.csv (number and fraction of every
+phenotype per image and frame) in the output folder.
+
+Usage:
+	python Compaction_Classifier.py classify "D:/Plate1/*.tif" --channel 2 --labels "{name}-Labels.tif" --workers 8
+	python Compaction_Classifier.py train annotated.csv --column phenotype --output compaction_model.json
+
+Requires numpy, pandas, scipy and tifffile.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.signal import find_peaks
+
+import Colocalization
+import Foci_Engine
+import MJtemplate_Index
+
+OTHER = "Other" # Phenotype of cells that match no rule, as TITLE[0] of the template
+RULES = [ # Phenotypes and criteria of bacteria/morphology[0]/TYPES[0] in MJtemplate_ClassifyDNAcompactionPhenotypes.xml
+	("MidcellCompaction", "maxima1 == 1"),
+	("MultifocalDistribution", "maxima1 > 2"),
+	("PeriseptalCompaction", "maxima1 == 2 and maxima2 == 1"),
+	("QuarterPositionCompaction", "maxima1 == 2 and maxima2 > 1")
+]
+TOLERANCE = 2000.0 # Minimum prominence of a profile maximum, as maxima TOLERANCE of the template
+SMOOTHING = (2.0, 1.0) # Sigma (pixels) of the axial profile for maxima1 and maxima2
+FEATURES = ["area", "length", "width", "nucleoid_area_fraction", "nucleoid_length_ratio", "nucleoid_intensity_fraction",
+	"mean", "cv", "skewness", "kurtosis", "maxima1", "maxima2"]
+MJ_FEATURES = [(r"MAXIMA\.Maxima(\d)\.count\.total", r"maxima\1")] # MicrobeJ criteria names and the feature columns
+
+def axial_profiles(index, position, values, n_cells):
+	"""
+	Mean intensity per 1-pixel bin along the axis of every cell.
+	:return: Array of shape (cells, longest cell), NaN beyond the cell.
+	"""
+	bins = np.floor(position).astype(int)
+	width = bins.max() + 1 if len(bins) else 0
+	flat = index * width + bins
+	sums = np.bincount(flat, weights=values, minlength=n_cells * width).reshape(n_cells, width)
+	counts = np.bincount(flat, minlength=n_cells * width).reshape(n_cells, width)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return sums / counts
+
+def count_maxima(profiles, sigma, tolerance):
+	"""Number of maxima with a prominence of at least tolerance in every profile."""
+	lengths = np.isfinite(profiles).sum(axis=1)
+	# Gaps (bins without pixels) are filled from the left before smoothing
+	filled = pd.DataFrame(profiles).ffill(axis=1).bfill(axis=1).to_numpy()
+	smoothed = ndimage.gaussian_filter1d(np.nan_to_num(filled), sigma, axis=1, mode="nearest") if sigma > 0 else filled
+	counts = np.zeros(len(profiles), dtype=int)
+	for i, length in enumerate(lengths):
+		if length > 2:
+			# Padding with the edge minimum lets maxima at the cell poles count
+			row = smoothed[i, :length]
+			counts[i] = len(find_peaks(np.concatenate(([row.min()], row, [row.min()])), prominence=tolerance)[0])
+	return counts
+
+def cell_features(dna, labels, threshold, tolerance=TOLERANCE, smoothing=SMOOTHING):
+	"""
+	Features of every cell of a block of frames.
+	:param dna: DNA channel, array of shape (frames, height, width).
+	:param labels: Cell labels of the same shape, 0 = background.
+	:param threshold: Nucleoid threshold per frame.
+	:return: DataFrame with the columns frame_index, cell and FEATURES.
+	"""
+	inside = labels > 0
+	frame_index = np.broadcast_to(np.arange(len(dna))[:, None, None], dna.shape)[inside]
+	rows, columns = np.nonzero(inside)[1:]
+	cell = labels[inside]
+	key, index = np.unique(frame_index * (cell.max() + 1) + cell, return_inverse=True)
+	values = dna[inside].astype(np.float64)
+	nucleoid = values > threshold[frame_index]
+	sums = lambda weights: np.bincount(index, weights=weights, minlength=len(key))
+	n = sums(None)
+
+	# Orientation from the second moments of the cell pixels
+	mean_x, mean_y = sums(columns) / n, sums(rows) / n
+	dx, dy = columns - mean_x[index], rows - mean_y[index]
+	angle = 0.5 * np.arctan2(2 * sums(dx * dy), sums(dx * dx) - sums(dy * dy))
+	along = dx * np.cos(angle[index]) + dy * np.sin(angle[index])
+	across = -dx * np.sin(angle[index]) + dy * np.cos(angle[index])
+	reduce = lambda function, weights, selected=None: np.asarray(function(weights if selected is None else weights[selected],
+		index + 1 if selected is None else index[selected] + 1, np.arange(1, len(key) + 1)), dtype=float)
+	start = reduce(ndimage.minimum, along)
+	length = reduce(ndimage.maximum, along) - start + 1
+	width = reduce(ndimage.maximum, across) - reduce(ndimage.minimum, across) + 1
+	nucleoid_length = np.where(sums(nucleoid) > 0, reduce(ndimage.maximum, along, nucleoid) - reduce(ndimage.minimum, along, nucleoid) + 1, 0)
+
+	with np.errstate(invalid="ignore", divide="ignore"):
+		mean = sums(values) / n
+		deviation = values - mean[index]
+		variance = sums(deviation ** 2) / n
+		features = pd.DataFrame({
+			"frame_index": key // (cell.max() + 1),
+			"cell": key % (cell.max() + 1),
+			"area": n.astype(int),
+			"length": length,
+			"width": width,
+			"nucleoid_area_fraction": sums(nucleoid) / n,
+			"nucleoid_length_ratio": nucleoid_length / length,
+			"nucleoid_intensity_fraction": sums(values * nucleoid) / sums(values),
+			"mean": mean,
+			"cv": np.sqrt(variance) / mean,
+			"skewness": sums(deviation ** 3) / n / variance ** 1.5,
+			"kurtosis": sums(deviation ** 4) / n / variance ** 2 - 3
+		})
+	profiles = axial_profiles(index, along - start[index], values, len(key))
+	features["maxima1"] = count_maxima(profiles, smoothing[0], tolerance)
+	features["maxima2"] = count_maxima(profiles, smoothing[1], tolerance)
+	return features
+
+def rules_from_template(template_path):
+	"""
+	Phenotypes and criteria of the first bacteria type of a MicrobeJ template, translated to pandas expressions.
+	:return: A tuple (rules, title of cells without match).
+	"""
+	values = dict((parameter.key, parameter.value) for parameter in MJtemplate_Index.load_index(template_path))
+	prefix = "bacteria/morphology[0]/TYPES[0]/"
+	rules = []
+	index = 1
+	while prefix + "TITLE[{}]".format(index) in values:
+		criterium = values.get(prefix + "CRITERIUM[{}]".format(index), "")
+		if criterium:
+			for pattern, replacement in MJ_FEATURES:
+				criterium = re.sub(pattern, replacement, criterium)
+			rules.append((values[prefix + "TITLE[{}]".format(index)], re.sub(r"(?<![<>!=])=(?!=)", "==", criterium)))
+		index += 1
+	return rules, values.get(prefix + "TITLE[0]") or OTHER
+
+def read_rules(rules_path):
+	"""Rules from a tab separated file with the columns phenotype and expression."""
+	with open(rules_path) as f:
+		return [tuple(line.rstrip("\n").split("\t", 1)) for line in f if line.strip() and not line.startswith("#")]
+
+def apply_rules(features, rules, other=OTHER):
+	"""Phenotype of every row: the first rule whose expression is true."""
+	phenotype = pd.Series(other, index=features.index, dtype=object)
+	unassigned = np.ones(len(features), dtype=bool)
+	for title, expression in rules:
+		matched = features.eval(expression).to_numpy(dtype=bool) & unassigned
+		phenotype[matched] = title
+		unassigned &= ~matched
+	return phenotype
+
+def train_model(features, phenotypes, columns=FEATURES):
+	"""Nearest-centroid model of the standardized features."""
+	values = features[columns].to_numpy(dtype=float)
+	valid = np.isfinite(values).all(axis=1) & phenotypes.notna().to_numpy()
+	mean, std = values[valid].mean(axis=0), values[valid].std(axis=0)
+	std[std == 0] = 1
+	scaled = (values[valid] - mean) / std
+	labels = phenotypes[valid].astype(str).to_numpy()
+	titles = sorted(set(labels))
+	return {
+		"features": list(columns),
+		"mean": mean.tolist(),
+		"std": std.tolist(),
+		"phenotypes": titles,
+		"centroids": [scaled[labels == title].mean(axis=0).tolist() for title in titles]
+	}
+
+def apply_model(features, model, other=OTHER):
+	"""Phenotype of the nearest centroid; rows with missing features are "Other"."""
+	values = (features[model["features"]].to_numpy(dtype=float) - np.array(model["mean"])) / np.array(model["std"])
+	distances = ((values[:, None, :] - np.array(model["centroids"])[None]) ** 2).sum(axis=2)
+	valid = np.isfinite(distances).all(axis=1)
+	nearest = np.argmin(np.where(valid[:, None], distances, 0), axis=1)
+	return pd.Series(np.where(valid, np.array(model["phenotypes"], dtype=object)[nearest], other), index=features.index)
+
+def classify_hyperstack(image_path, channel, labels_path=None, objects_path=None, threshold=None, tolerance=TOLERANCE,
+		rules=RULES, other=OTHER, model=None):
+	"""
+	Features and phenotypes of all cells and frames of a hyperstack.
+	:return: DataFrame with the columns image, frame, cell, FEATURES and phenotype.
+	"""
+	stack = Foci_Engine.Hyperstack(image_path)
+	try:
+		cell_labels = Colocalization.CellLabels(stack.tif.pages[0].shape, stack.channels, labels_path, objects_path, os.path.basename(image_path))
+		parts = []
+		for first in range(1, stack.frames + 1, Foci_Engine.BLOCK_FRAMES):
+			last = min(first + Foci_Engine.BLOCK_FRAMES - 1, stack.frames)
+			dna = stack.read_frames(channel, first, last)
+			labels = cell_labels.get_frames(first, last)
+			if not labels.any():
+				continue
+			inside = labels > 0
+			thresholds = np.array([threshold if threshold is not None else Colocalization.otsu_threshold(dna[i][inside[i]]) for i in range(len(dna))])
+			features = cell_features(dna, labels, thresholds, tolerance)
+			features.insert(0, "frame", features.pop("frame_index") + first)
+			parts.append(features)
+	finally:
+		stack.close()
+	cells = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["frame", "cell"] + FEATURES)
+	cells.insert(0, "image", os.path.basename(image_path))
+	cells["phenotype"] = apply_model(cells, model, other) if model else apply_rules(cells, rules, other)
+	return cells
+
+def summarize(cells, phenotypes):
+	"""Number and fraction of cells of every phenotype per image and frame."""
+	counts = pd.crosstab([cells["image"], cells["frame"]], cells["phenotype"]).reindex(columns=phenotypes, fill_value=0)
+	fractions = counts.div(counts.sum(axis=1), axis=0).add_suffix("_fraction")
+	summary = pd.concat([counts.sum(axis=1).rename("cells"), counts, fractions], axis=1)
+	return summary.reset_index()
+
+def get_labels_path(pattern, image_path):
+	"""Label image of a hyperstack: {name} is replaced by the image name without extension, relative to the image folder."""
+	if not pattern:
+		return None
+	path = pattern.replace("{name}", os.path.splitext(os.path.basename(image_path))[0])
+	return path if os.path.isabs(path) else os.path.join(os.path.dirname(image_path), path)
+
+def run_image(job):
+	image_path, output_dir, options = job
+	cells = classify_hyperstack(image_path, labels_path=get_labels_path(options.pop("labels"), image_path), **options)
+	cells.to_csv(os.path.join(output_dir, os.path.splitext(os.path.basename(image_path))[0] + "-Compaction.csv"), index=False)
+	return cells
+
+def main():
+	parser = argparse.ArgumentParser(description="Classification of DNA compaction phenotypes")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	classify = subparsers.add_parser("classify", help="classify all cells and frames of hyperstacks")
+	classify.add_argument("images", nargs="+", help="hyperstacks or glob patterns")
+	classify.add_argument("--channel", type=int, required=True, help="DNA channel (1-based)")
+	classify.add_argument("--labels", help="label image of the cells, {name} = image name without extension, e.g. {name}-Labels.tif")
+	classify.add_argument("--objects", help="objects exported from Coli-Inspector")
+	classify.add_argument("--threshold", type=float, help="nucleoid threshold (default: Otsu of the pixels in cells per frame)")
+	classify.add_argument("--tolerance", type=float, default=TOLERANCE, help="minimum prominence of the maxima of the axial DNA profile")
+	rules = classify.add_mutually_exclusive_group()
+	rules.add_argument("--template", help="read the rules from a MicrobeJ template")
+	rules.add_argument("--rules", help="tab separated file of phenotypes and pandas expressions")
+	rules.add_argument("--model", help="nearest-centroid model written by 'train'")
+	classify.add_argument("--output", help="output folder (default: folder of every image)")
+	classify.add_argument("--workers", type=int, default=1, help="images processed in parallel")
+	train = subparsers.add_parser("train", help="train a nearest-centroid model on annotated cells")
+	train.add_argument("tables", nargs="+", help="-Compaction.csv tables with an annotation column")
+	train.add_argument("--column", default="phenotype", help="column with the annotated phenotypes")
+	train.add_argument("--features", default=",".join(FEATURES), help="comma separated features")
+	train.add_argument("--output", required=True, help="model file (.json)")
+	args = parser.parse_args()
+
+	if args.command == "train":
+		table = pd.concat([pd.read_csv(path) for path in args.tables], ignore_index=True)
+		model = train_model(table, table[args.column], args.features.split(","))
+		with open(args.output, "w") as f:
+			json.dump(model, f, indent=1)
+		print("Model of {} phenotypes from {} cells: {}".format(len(model["phenotypes"]), table[args.column].notna().sum(), args.output))
+		return
+
+	if not args.labels and not args.objects:
+		parser.error("give --labels or --objects")
+	images = [path for pattern in args.images for path in (sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])]
+	if not images:
+		sys.exit("No images found")
+	model = None
+	other = OTHER
+	if args.template:
+		rule_list, other = rules_from_template(args.template)
+	elif args.rules:
+		rule_list = read_rules(args.rules)
+	else:
+		rule_list = RULES
+	if args.model:
+		with open(args.model) as f:
+			model = json.load(f)
+	phenotypes = [other] + (model["phenotypes"] if model else [title for title, expression in rule_list])
+
+	options = {"channel": args.channel, "labels": args.labels, "objects_path": args.objects, "threshold": args.threshold,
+		"tolerance": args.tolerance, "rules": rule_list, "other": other, "model": model}
+	jobs = [(path, args.output or os.path.dirname(os.path.abspath(path)), dict(options)) for path in images]
+	if args.output and not os.path.isdir(args.output):
+		os.makedirs(args.output)
+	tables = []
+	with ProcessPoolExecutor(max_workers=args.workers) as executor:
+		for image_path, cells in zip(images, executor.map(run_image, jobs)):
+			print("{}: {} cell frames".format(os.path.basename(image_path), len(cells)))
+			tables.append(cells)
+	summary = summarize(pd.concat(tables, ignore_index=True), list(dict.fromkeys(phenotypes)))
+	summary_dir = args.output or os.path.dirname(os.path.abspath(images[0]))
+	summary.to_csv(os.path.join(summary_dir, "Compaction_Summary.csv"), index=False)
+	print(summary[[column for column in summary.columns if column.endswith("_fraction")]].mean().to_string())
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,297 @@
+"""
+Detection, cell assignment and tracking of fluorescent foci (e.g. GFP-RecN, RecA-mCherry) in preprocessed hyperstacks.
+
+Replaces the maxima detection and tracking of the MicrobeJ templates MJtemplate_RecNinDNA_tracking.xml and
+MJtemplate_RecAcolRecN_tracking.xml for large batches:
+	- Detection: a Laplacian of Gaussian filter is applied to a block of frames at once and foci are the local maxima
+	  of the filter response above median + threshold_z x MAD of the frame (cf. ADJUSTED_ZSCORE). Positions are
+	  refined to subpixel precision by a parabola through the neighbouring pixels.
+	- Cell assignment: from a label image (one label per cell, one plane per frame or one for all frames) or from the
+	  objects exported from Coli-Inspector ("Export Objects"). For objects, the nearest axis point of all cells of a
+	  frame is found with a KD-tree and foci within half the cell diameter (+ margin) belong to the cell.
+	- Linking: foci are linked to the track ends of the previous frames (up to max_gap frames back) by a linear
+	  assignment over the candidate pairs within max_distance. The candidates come from KD-trees and are split into
+	  independent groups, so frames with thousands of foci only solve many small assignment problems.
+
+The results are written as <image>-Foci.csv with columns named like the maxima results of MicrobeJ
+(NAME.id, PARENT.id, POSITION.frame, LOCATION.x, LOCATION.y, INTENSITY.max, TRAJECTORY.id, ...). They can be
+added to a results store with: python Results_Store.py ingest-table <store> foci <experiment> <image>-Foci.csv --frame-column POSITION.frame
+
+Usage:
+	python Foci_Engine.py <hyperstack.tif> [...] --channel 2 --sigma 1.5 --threshold-z 6 --objects <project>-Objects.txt
+
+Requires numpy, pandas, scipy and tifffile.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import ndimage
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+import Profile_Engine
+
+SIGMA = 1.5 # LoG sigma in pixels, about the radius of a diffraction limited focus
+THRESHOLD_Z = 6.0 # Minimum LoG response in robust standard deviations above the frame median
+MIN_DISTANCE = 2 # Minimum distance between foci in pixels
+MAX_DISTANCE = 3.0 # Maximum displacement between linked foci in pixels
+MAX_GAP = 1 # Frames a focus may be missing within a track
+CELL_MARGIN = 1.0 # Pixels added to the cell radius for the assignment of foci to Coli-Inspector objects
+BLOCK_FRAMES = 16 # Frames filtered at once
+
+class Hyperstack:
+	"""Reads planes of an ImageJ hyperstack by channel and frame without loading the whole file."""
+	def __init__(self, path):
+		self.path = path
+		self.tif = tifffile.TiffFile(path)
+		metadata = self.tif.imagej_metadata or {}
+		self.channels = int(metadata.get("channels", 1))
+		self.slices = int(metadata.get("slices", 1))
+		self.frames = int(metadata.get("frames", len(self.tif.pages) // (self.channels * self.slices)))
+		self.pixel_size, self.unit = get_calibration(self.tif)
+
+	def read_frames(self, channel, first, last):
+		"""
+		:param channel: 1-based channel.
+		:return: Array of shape (last - first + 1, height, width) of the first slice of frames first..last (1-based).
+		"""
+		return np.stack([self.tif.pages[(frame - 1) * self.channels * self.slices + channel - 1].asarray() for frame in range(first, last + 1)]).astype(np.float32)
+
+	def close(self):
+		self.tif.close()
+
+def get_calibration(tif):
+	"""Pixel width and unit of an ImageJ TIFF, or (1, "pixel") if uncalibrated."""
+	metadata = tif.imagej_metadata or {}
+	tags = tif.pages[0].tags
+	if "XResolution" in tags:
+		numerator, denominator = tags["XResolution"].value
+		if numerator > 0 and denominator > 0 and numerator != denominator:
+			return denominator / float(numerator), metadata.get("unit", "micron")
+	return 1.0, "pixel"
+
+def detect_foci(frames, sigma=SIGMA, threshold_z=THRESHOLD_Z, min_distance=MIN_DISTANCE):
+	"""
+	Detects foci in a block of frames at once.
+	:param frames: Array of shape (frames, height, width).
+	:return: DataFrame with the columns frame_index (0-based within the block), x, y (subpixel), peak and response.
+	"""
+	# Laplacian in x and y only (gaussian_laplace would also differentiate along the frames)
+	response = -(ndimage.gaussian_filter(frames, (0, sigma, sigma), order=(0, 2, 0)) + ndimage.gaussian_filter(frames, (0, sigma, sigma), order=(0, 0, 2))) * sigma ** 2
+	size = 2 * min_distance + 1
+	peaks = response == ndimage.maximum_filter(response, size=(1, size, size), mode="nearest")
+	# Background statistics from every 4th pixel in x and y, which is plenty for the median and MAD
+	sample = response[:, ::4, ::4]
+	median = np.median(sample, axis=(1, 2))
+	mad = np.median(np.abs(sample - median[:, None, None]), axis=(1, 2)) * 1.4826
+	peaks &= response > (median + threshold_z * np.maximum(mad, 1e-6))[:, None, None]
+	peaks[:, [0, -1], :] = False
+	peaks[:, :, [0, -1]] = False
+	t, y, x = np.nonzero(peaks)
+
+	center = response[t, y, x]
+	left, right = response[t, y, x - 1], response[t, y, x + 1]
+	up, down = response[t, y - 1, x], response[t, y + 1, x]
+	with np.errstate(invalid="ignore", divide="ignore"):
+		dx = np.nan_to_num((left - right) / (2 * (left - 2 * center + right)))
+		dy = np.nan_to_num((up - down) / (2 * (up - 2 * center + down)))
+	return pd.DataFrame({
+		"frame_index": t,
+		"x": x + np.clip(dx, -0.5, 0.5),
+		"y": y + np.clip(dy, -0.5, 0.5),
+		"peak": frames[t, y, x],
+		"response": center
+	})
+
+def detect_hyperstack(stack, channel, sigma=SIGMA, threshold_z=THRESHOLD_Z, min_distance=MIN_DISTANCE, block_frames=BLOCK_FRAMES):
+	"""Detects foci on all frames of a channel, block by block. Frames are 1-based in the result."""
+	parts = []
+	for first in range(1, stack.frames + 1, block_frames):
+		last = min(first + block_frames - 1, stack.frames)
+		foci = detect_foci(stack.read_frames(channel, first, last), sigma, threshold_z, min_distance)
+		foci["frame"] = foci.pop("frame_index") + first
+		parts.append(foci)
+	foci = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["x", "y", "peak", "response", "frame"])
+	return foci.sort_values(["frame", "y", "x"], ignore_index=True)
+
+def assign_labels(foci, labels_path):
+	"""Cell of each focus from a label image with one plane per frame, or one plane for all frames."""
+	labels = tifffile.imread(labels_path)
+	if labels.ndim == 2:
+		labels = labels[None]
+	planes = np.minimum(foci["frame"].to_numpy() - 1, labels.shape[0] - 1)
+	rows = np.clip(np.round(foci["y"].to_numpy()).astype(int), 0, labels.shape[1] - 1)
+	columns = np.clip(np.round(foci["x"].to_numpy()).astype(int), 0, labels.shape[2] - 1)
+	return labels[planes, rows, columns].astype(int)
+
+def assign_objects(foci, objects_path, channels, image_name=None, margin=CELL_MARGIN):
+	"""
+	Cell (ObjectID) of each focus from Coli-Inspector objects; 0 outside of all cells.
+	The frame of an object is taken from its stack index and the number of channels of the hyperstack.
+	:param image_name: File name of the hyperstack; objects of the other linked images are ignored.
+	"""
+	by_frame = {}
+	for cell in Profile_Engine.read_objects(objects_path):
+		if image_name and cell.image_name != image_name:
+			continue
+		by_frame.setdefault((cell.stack_index - 1) // channels + 1, []).append(cell)
+	cells = np.zeros(len(foci), dtype=int)
+	frames = foci["frame"].to_numpy()
+	for frame, frame_cells in by_frame.items():
+		selected = np.nonzero(frames == frame)[0]
+		if len(selected) == 0:
+			continue
+		points, owners, radii = [], [], []
+		for cell in frame_cells:
+			px, py = Profile_Engine.resample_axis(cell.axis_x, cell.axis_y)
+			points.append(np.column_stack((px, py)))
+			owners.append(np.full(len(px), cell.object_id))
+			radii.append(np.full(len(px), cell.get_dia_length() / 2.0 + margin))
+		distance, nearest = cKDTree(np.concatenate(points)).query(foci[["x", "y"]].to_numpy()[selected])
+		inside = distance <= np.concatenate(radii)[nearest]
+		cells[selected[inside]] = np.concatenate(owners)[nearest[inside]]
+	return cells
+
+def link_foci(foci, max_distance=MAX_DISTANCE, max_gap=MAX_GAP, same_cell=False):
+	"""
+	Links foci of consecutive frames into tracks.
+	:param foci: DataFrame with the columns frame, x, y and optionally cell.
+	:param same_cell: Only link foci of the same cell.
+	:return: Array of track IDs (1-based) per focus.
+	"""
+	frames = foci["frame"].to_numpy()
+	xy = foci[["x", "y"]].to_numpy()
+	cells = foci["cell"].to_numpy() if "cell" in foci else np.zeros(len(foci), dtype=int)
+	tracks = np.zeros(len(foci), dtype=int)
+	ends = np.zeros(0, dtype=int) # Index of the last focus of each open track
+	n_tracks = 0
+	for frame in np.unique(frames):
+		current = np.nonzero(frames == frame)[0]
+		ends = ends[frames[ends] >= frame - max_gap - 1]
+		matched = np.zeros(len(current), dtype=bool)
+		if len(ends) and len(current):
+			pairs = cKDTree(xy[ends]).sparse_distance_matrix(cKDTree(xy[current]), max_distance, output_type="coo_matrix")
+			rows, columns, distances = pairs.row, pairs.col, pairs.data
+			if same_cell:
+				keep = cells[ends[rows]] == cells[current[columns]]
+				rows, columns, distances = rows[keep], columns[keep], distances[keep]
+			# Prefer the most recent track end over an equally close end before a gap
+			costs = distances + (frame - frames[ends[rows]] - 1) * max_distance
+			for row, column in solve_assignment(rows, columns, costs, len(ends), len(current)):
+				tracks[current[column]] = tracks[ends[row]]
+				matched[column] = True
+				ends[row] = current[column]
+		new = current[~matched]
+		tracks[new] = np.arange(n_tracks + 1, n_tracks + len(new) + 1)
+		n_tracks += len(new)
+		ends = np.concatenate((ends, new))
+	return tracks
+
+def solve_assignment(rows, columns, costs, n_rows, n_columns):
+	"""
+	Minimum cost matching of the candidate pairs, solved separately for each connected group of candidates.
+	:return: List of (row, column) pairs.
+	"""
+	if len(rows) == 0:
+		return []
+	n_components, component = connected_components(coo_graph(rows, columns, n_rows, n_columns), directed=False)
+	pair_component = component[rows]
+	order = np.argsort(pair_component, kind="stable")
+	boundaries = np.nonzero(np.diff(pair_component[order]))[0] + 1
+	matches = []
+	for group in np.split(order, boundaries):
+		if len(group) == 1:
+			matches.append((rows[group[0]], columns[group[0]]))
+			continue
+		group_rows, row_index = np.unique(rows[group], return_inverse=True)
+		group_columns, column_index = np.unique(columns[group], return_inverse=True)
+		matrix = np.full((len(group_rows), len(group_columns)), 1e9)
+		matrix[row_index, column_index] = costs[group]
+		for i, j in zip(*linear_sum_assignment(matrix)):
+			if matrix[i, j] < 1e9:
+				matches.append((group_rows[i], group_columns[j]))
+	return matches
+
+def coo_graph(rows, columns, n_rows, n_columns):
+	"""Bipartite graph of the candidate pairs; track ends are nodes 0..n_rows-1, foci follow."""
+	n = n_rows + n_columns
+	return coo_matrix((np.ones(len(rows)), (rows, columns + n_rows)), shape=(n, n))
+
+def to_microbej_columns(foci, channel, pixel_size, unit):
+	"""Result table with the key columns of the MicrobeJ maxima results."""
+	return pd.DataFrame({
+		"NAME.id": np.arange(1, len(foci) + 1),
+		"PARENT.id": foci["cell"].to_numpy() if "cell" in foci else 0,
+		"POSITION.channel": channel,
+		"POSITION.frame": foci["frame"].to_numpy(),
+		"LOCATION.x": foci["x"].to_numpy() * pixel_size,
+		"LOCATION.y": foci["y"].to_numpy() * pixel_size,
+		"LOCATION.unit": unit,
+		"INTENSITY.max": foci["peak"].to_numpy(),
+		"INTENSITY.log": foci["response"].to_numpy(),
+		"TRAJECTORY.id": foci["track"].to_numpy() if "track" in foci else 0
+	})
+
+def process_hyperstack(image_path, channel, sigma=SIGMA, threshold_z=THRESHOLD_Z, min_distance=MIN_DISTANCE, labels_path=None,
+		objects_path=None, max_distance=MAX_DISTANCE, max_gap=MAX_GAP, same_cell=False, inside_only=False, output_path=None):
+	"""
+	Detects, assigns and links the foci of one hyperstack and writes the result table.
+	:return: Path of the result table.
+	"""
+	start_time = time.time()
+	stack = Hyperstack(image_path)
+	try:
+		if not 1 <= channel <= stack.channels:
+			sys.exit("{}: channel {} not found ({} channels)".format(image_path, channel, stack.channels))
+		foci = detect_hyperstack(stack, channel, sigma, threshold_z, min_distance)
+		detect_seconds = time.time() - start_time
+		if labels_path:
+			foci["cell"] = assign_labels(foci, labels_path)
+		elif objects_path:
+			foci["cell"] = assign_objects(foci, objects_path, stack.channels, os.path.basename(image_path))
+		if inside_only and "cell" in foci:
+			foci = foci[foci["cell"] != 0].reset_index(drop=True)
+		foci["track"] = link_foci(foci, max_distance, max_gap, same_cell)
+		table = to_microbej_columns(foci, channel, stack.pixel_size, stack.unit)
+	finally:
+		stack.close()
+	output_path = output_path or os.path.splitext(image_path)[0] + "-Foci.csv"
+	table.to_csv(output_path, index=False)
+	print("{}: {} foci in {} frames, {} tracks (detection {:.1f} s, total {:.1f} s)".format(
+		os.path.basename(image_path), len(table), stack.frames, foci["track"].nunique(), detect_seconds, time.time() - start_time))
+	return output_path
+
+def main():
+	parser = argparse.ArgumentParser(description="Detection and tracking of foci in preprocessed hyperstacks")
+	parser.add_argument("images", nargs="+", help="hyperstacks or glob patterns")
+	parser.add_argument("--channel", type=int, required=True, help="channel of the foci (1-based)")
+	parser.add_argument("--sigma", type=float, default=SIGMA, help="LoG sigma in pixels")
+	parser.add_argument("--threshold-z", type=float, default=THRESHOLD_Z, help="minimum LoG response in robust SD above the median")
+	parser.add_argument("--min-distance", type=int, default=MIN_DISTANCE, help="minimum distance between foci in pixels")
+	parser.add_argument("--labels", help="label image of the cells (single image only)")
+	parser.add_argument("--objects", help="objects exported from Coli-Inspector (single image only)")
+	parser.add_argument("--inside-only", action="store_true", help="discard foci outside of cells")
+	parser.add_argument("--max-distance", type=float, default=MAX_DISTANCE, help="maximum displacement per frame in pixels")
+	parser.add_argument("--max-gap", type=int, default=MAX_GAP, help="frames a focus may be missing within a track")
+	parser.add_argument("--same-cell", action="store_true", help="only link foci within the same cell")
+	args = parser.parse_args()
+
+	images = []
+	for pattern in args.images:
+		images.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+	if len(images) > 1 and (args.labels or args.objects):
+		parser.error("--labels and --objects can only be used with a single image")
+	for image in images:
+		process_hyperstack(image, args.channel, args.sigma, args.threshold_z, args.min_distance, args.labels, args.objects,
+			args.max_distance, args.max_gap, args.same_cell, args.inside_only)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,225 @@
+"""
+Average kymographs, single-cell kymographs and demographs from Coli-Inspector cell axes and the preprocessed hyperstacks.
+
+The fluorescence profile of every cell is sampled along its axis in one pass per image plane, with the wide-line
+sampling of Profile_Engine.py (as getFluorProfiles), and resampled to a normalized axis of --points positions.
+The profiles are cached in <objects>-Kymo-ch<channel>.npz; as long as the objects, the images and the sampling
+settings are unchanged, other time bins or normalizations only regroup the cached profiles.
+
+Outputs (32-bit ImageJ TIFFs):
+	- <objects>-AvgKymograph.tif: mean normalized profile per time bin (rows) along the relative cell axis (columns),
+	  as the average kymographs of MJtemplate_AvgKymograph.xml.
+	- <objects>-Demograph.tif: one slice per time bin with the profiles of all cells sorted by length and centered.
+	- <objects>-CellKymographs.tif: one slice per tracked cell with its profile (centered, in pixels) per frame, as the
+	  SingleCell_Kymograph templates. Cells are followed over frames by linking the axis midpoints (Foci_Engine.link_foci).
+
+Usage:
+	python Kymograph_Engine.py <project>-Objects.txt --channel 2 --time-bin 5
+
+Requires numpy, pandas, scipy and tifffile.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+import Foci_Engine
+import Profile_Engine
+
+POINTS = 101 # Positions along the normalized axis, as collectiveProfile
+CACHE_VERSION = 1
+
+def resample_profiles(profiles, points=POINTS):
+	"""Resamples profiles of different lengths to the same number of points with linear interpolation (Array.resample)."""
+	lengths = np.array([len(profile) for profile in profiles])
+	result = np.full((len(profiles), points), np.nan)
+	valid = lengths > 1
+	if not valid.any():
+		return result
+	values = np.concatenate([profiles[i] for i in np.nonzero(valid)[0]])
+	offsets = np.concatenate(([0], np.cumsum(lengths[valid])[:-1]))
+	x = np.linspace(0, 1, points)[None, :] * (lengths[valid] - 1)[:, None]
+	i1 = np.floor(x).astype(int)
+	i2 = np.minimum(i1 + 1, (lengths[valid] - 1)[:, None])
+	fraction = x - i1
+	result[valid] = (1 - fraction) * values[offsets[:, None] + i1] + fraction * values[offsets[:, None] + i2]
+	return result
+
+def extract_profiles(cells, image_dir, channel, extra_width=Profile_Engine.EXTRA_WIDTH):
+	"""
+	Fluorescence profiles of all cells, sampled plane by plane.
+	:return: A tuple (list of profiles in cell order, array of frame numbers).
+	"""
+	profiles = [np.zeros(0)] * len(cells)
+	frames = np.zeros(len(cells), dtype=int)
+	by_image = {}
+	for i, cell in enumerate(cells):
+		by_image.setdefault(cell.image_name, {}).setdefault(cell.stack_index, []).append(i)
+	for image_name, planes in sorted(by_image.items()):
+		with tifffile.TiffFile(os.path.join(image_dir, image_name)) as tif:
+			channels = Profile_Engine.get_channels(tif)
+			for stack_index, indexes in sorted(planes.items()):
+				frames[indexes] = (stack_index - 1) // channels + 1
+				plane = tif.pages[stack_index + channel - 2].asarray()
+				plane_cells = [cells[i] for i in indexes]
+				for i, profile in zip(indexes, Profile_Engine.fluorescence_profiles(plane, plane_cells, plane_cells[0].pixel_size, extra_width)):
+					profiles[i] = profile
+	return profiles, frames
+
+def get_signature(objects_path, image_dir, cells, channel, extra_width, points):
+	files = [objects_path] + [os.path.join(image_dir, name) for name in sorted(set(cell.image_name for cell in cells))]
+	return np.array([CACHE_VERSION, channel, extra_width, points] + [value for path in files for value in (os.path.getsize(path), os.path.getmtime(path))])
+
+def load_profiles(objects_path, channel, image_dir=None, extra_width=Profile_Engine.EXTRA_WIDTH, points=POINTS, use_cache=True):
+	"""
+	Profiles of all cells, from the cache if it is up to date.
+	:return: Dict with the arrays object_id, image, frame, x, y (axis midpoint), length (pixels), offsets and values
+	(raw profiles concatenated) and normalized (cells x points).
+	"""
+	cells = Profile_Engine.read_objects(objects_path)
+	image_dir = image_dir or os.path.dirname(os.path.abspath(objects_path))
+	cache_path = os.path.splitext(objects_path)[0] + "-Kymo-ch{}.npz".format(channel)
+	signature = get_signature(objects_path, image_dir, cells, channel, extra_width, points)
+	if use_cache and os.path.exists(cache_path):
+		with np.load(cache_path) as cached:
+			if np.array_equal(cached["signature"], signature):
+				return dict(cached)
+
+	profiles, frames = extract_profiles(cells, image_dir, channel, extra_width)
+	midpoints = []
+	for cell in cells:
+		px, py = Profile_Engine.resample_axis(cell.axis_x, cell.axis_y)
+		midpoints.append((px[len(px) // 2], py[len(py) // 2]) if len(px) else (np.nan, np.nan))
+	lengths = np.array([len(profile) for profile in profiles])
+	data = {
+		"signature": signature,
+		"object_id": np.array([cell.object_id for cell in cells]),
+		"image": np.array([cell.image for cell in cells]),
+		"frame": frames,
+		"x": np.array([point[0] for point in midpoints]),
+		"y": np.array([point[1] for point in midpoints]),
+		"length": lengths,
+		"offsets": np.concatenate(([0], np.cumsum(lengths)[:-1])),
+		"values": np.concatenate(profiles) if lengths.sum() else np.zeros(0),
+		"normalized": resample_profiles(profiles, points)
+	}
+	if use_cache:
+		np.savez(cache_path, **data)
+	return data
+
+def normalize_rows(profiles, normalization):
+	"""Scales each profile to a maximum or mean of 1 ("none" keeps the intensities)."""
+	if normalization == "none":
+		return profiles
+	with np.errstate(invalid="ignore", divide="ignore"):
+		scale = np.nanmax(profiles, axis=1) if normalization == "max" else np.nanmean(profiles, axis=1)
+		return profiles / scale[:, None]
+
+def get_raw_profile(data, i):
+	return data["values"][data["offsets"][i]:data["offsets"][i] + data["length"][i]]
+
+def centered_rows(data, indexes, width):
+	"""Raw profiles placed in the middle of rows of the given width (NaN outside of the cell)."""
+	rows = np.full((len(indexes), width), np.nan)
+	for row, i in enumerate(indexes):
+		profile = get_raw_profile(data, i)[:width]
+		start = (width - len(profile)) // 2
+		rows[row, start:start + len(profile)] = profile
+	return rows
+
+def average_kymograph(data, time_bin=1, normalization="max"):
+	"""
+	Mean normalized profile per time bin.
+	:return: A tuple (array of shape (bins, points), cell counts per bin, first frame of each bin).
+	"""
+	profiles = normalize_rows(data["normalized"], normalization)
+	valid = np.isfinite(profiles).all(axis=1)
+	bins = (data["frame"] - 1) // time_bin
+	n_bins = bins.max() + 1 if len(bins) else 0
+	sums = np.zeros((n_bins, profiles.shape[1]))
+	np.add.at(sums, bins[valid], profiles[valid])
+	counts = np.bincount(bins[valid], minlength=n_bins)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return sums / counts[:, None], counts, np.arange(n_bins) * time_bin + 1
+
+def demographs(data, time_bin=0):
+	"""
+	Length-sorted demographs, one per time bin (time_bin 0 = all frames together).
+	:return: Array of shape (bins, cells of the largest bin, longest cell), NaN where empty.
+	"""
+	bins = (data["frame"] - 1) // time_bin if time_bin else np.zeros(len(data["frame"]), dtype=int)
+	width = int(data["length"].max()) if len(data["length"]) else 0
+	groups = [np.nonzero(bins == group)[0] for group in range(bins.max() + 1 if len(bins) else 0)]
+	height = max([len(group) for group in groups] + [0])
+	stack = np.full((len(groups), height, width), np.nan)
+	for slice_index, group in enumerate(groups):
+		order = group[np.argsort(data["length"][group], kind="stable")]
+		stack[slice_index, :len(order)] = centered_rows(data, order, width)
+	return stack
+
+def cell_kymographs(data, max_distance=10.0, min_frames=3):
+	"""
+	Kymographs of single cells followed over frames.
+	:return: A tuple (array of shape (tracks, frames, longest cell), DataFrame of the cells in each track).
+	"""
+	cells = pd.DataFrame({"frame": data["frame"], "x": data["x"], "y": data["y"], "cell": data["image"]})
+	# Cells are only linked within the same image
+	cells["track"] = Foci_Engine.link_foci(cells, max_distance=max_distance, max_gap=0, same_cell=True)
+	cells["object_id"] = data["object_id"]
+	lengths = cells.groupby("track")["frame"].agg(["min", "max", "size"])
+	tracks = lengths.index[lengths["size"] >= min_frames]
+	n_frames = int((lengths.loc[tracks, "max"] - lengths.loc[tracks, "min"]).max() + 1) if len(tracks) else 0
+	width = int(data["length"].max()) if len(data["length"]) else 0
+	stack = np.full((len(tracks), n_frames, width), np.nan)
+	for slice_index, track in enumerate(tracks):
+		members = np.nonzero(cells["track"].to_numpy() == track)[0]
+		rows = data["frame"][members] - lengths.loc[track, "min"]
+		stack[slice_index, rows] = centered_rows(data, members, width)
+	selected = cells[cells["track"].isin(tracks)][["track", "frame", "object_id"]]
+	selected["slice"] = selected["track"].map(dict((track, i + 1) for i, track in enumerate(tracks)))
+	return stack, selected.sort_values(["slice", "frame"])
+
+def save_image(stack, path, labels=None):
+	metadata = {"axes": "ZYX" if stack.ndim == 3 else "YX"}
+	if labels:
+		metadata["Labels"] = labels
+	tifffile.imwrite(path, np.nan_to_num(stack).astype(np.float32), imagej=True, metadata=metadata)
+
+def main():
+	parser = argparse.ArgumentParser(description="Average kymographs, single-cell kymographs and demographs")
+	parser.add_argument("objects", help="<project>-Objects.txt written by 'Export Objects'")
+	parser.add_argument("--channel", type=int, required=True, help="channel of the profiles (1-based)")
+	parser.add_argument("--images", help="folder of the linked images (default: folder of the objects file)")
+	parser.add_argument("--time-bin", type=int, default=1, help="frames per row of the average kymograph and per demograph slice (1: one demograph of all frames)")
+	parser.add_argument("--normalize", choices=["max", "mean", "none"], default="max", help="normalization of each cell profile")
+	parser.add_argument("--points", type=int, default=POINTS, help="positions along the normalized axis")
+	parser.add_argument("--extra-width", type=float, default=Profile_Engine.EXTRA_WIDTH, help="um added to the cell diameter for the line width")
+	parser.add_argument("--max-distance", type=float, default=10.0, help="maximum movement of a cell midpoint between frames (pixels)")
+	parser.add_argument("--min-frames", type=int, default=3, help="minimum number of frames of a single-cell kymograph")
+	parser.add_argument("--no-cache", action="store_true", help="sample the profiles again")
+	args = parser.parse_args()
+
+	data = load_profiles(args.objects, args.channel, args.images, args.extra_width, args.points, not args.no_cache)
+	base = os.path.splitext(args.objects)[0].replace("-Objects", "")
+
+	kymograph, counts, first_frames = average_kymograph(data, args.time_bin, args.normalize)
+	save_image(kymograph, base + "-AvgKymograph.tif")
+	table = pd.DataFrame(kymograph, columns=["{:g}%".format(100.0 * i / (args.points - 1)) for i in range(args.points)])
+	table.insert(0, "cells", counts)
+	table.insert(0, "first_frame", first_frames)
+	table.to_csv(base + "-AvgKymograph.csv", index=False)
+
+	demograph = demographs(data, args.time_bin if args.time_bin > 1 else 0)
+	save_image(demograph, base + "-Demograph.tif")
+
+	kymographs, tracks = cell_kymographs(data, args.max_distance, args.min_frames)
+	if len(kymographs):
+		save_image(kymographs, base + "-CellKymographs.tif", ["Cell {}".format(i + 1) for i in range(len(kymographs))])
+		tracks.to_csv(base + "-CellKymographs.csv", index=False)
+	print("{} cells in {} frames: average kymograph of {} time bins, {} single-cell kymographs".format(
+		len(data["frame"]), len(np.unique(data["frame"])), len(kymograph), len(kymographs)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,357 @@
+"""
+Parameter index, diff and batch editing of MicrobeJ templates (MJtemplate_*.xml).
+
+A template is parsed in one streaming pass into a flat table of parameters. The key of a parameter is the
+path of element ids from the root, with the index of array elements in brackets, e.g.
+bacteria/morphology[0]/MAX_WIDTH or maxima[1]/TRACKING/TRACKING_MODE. Attributes other than id and index
+(calibration, fonts, segmentation methods) are keys of their own, e.g. CALIBRATION@pixelWidth. The table
+also holds the position of every parameter in the file, so edits only replace those characters and leave
+the rest of the template as MicrobeJ wrote it. Tables are cached per template and reused while the
+template is unchanged.
+
+In --set, --param and --grep a key without "/" matches that id in every section (e.g. TRACKING_MODE),
+other keys are matched as a whole and may contain the wildcards * and ?.
+
+Usage:
+	python MJtemplate_Index.py index MJtemplate_RecNinDNA_tracking.xml --grep "*COLOCALIZATION*"
+	python MJtemplate_Index.py diff MJtemplate_SingleCell_Kymograph_RecNinDNA_tracking.xml MJtemplate_SingleCell_RecAcolRecN_tracking.xml
+	python MJtemplate_Index.py set MJtemplate_*.xml --set FEATURE_TOLERANCE_MAXIMA=60 --output edited
+	python MJtemplate_Index.py sweep MJtemplate_RecNinDNA_tracking.xml --param FEATURE_TOLERANCE_MAXIMA=40,60,80 --output sweep
+
+Requires Python 3 only.
+"""
+import argparse
+import csv
+import fnmatch
+import glob
+import hashlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+
+INDEX_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "MJtemplate_index")
+IGNORED_ATTRIBUTES = ("id", "index", "class", "type")
+
+class Parameter:
+	"""One parameter of a template. start and end are the byte offsets of its element in the template file."""
+	def __init__(self, key, value, start, end, attribute=None):
+		self.key = key
+		self.value = value
+		self.start = start
+		self.end = end
+		self.attribute = attribute
+
+	def to_list(self):
+		return [self.key, self.value, self.start, self.end, self.attribute]
+
+def read_template(template_path):
+	with open(template_path, "rb") as f:
+		return f.read()
+
+def get_tag_end(data, position):
+	"""
+	Offset after the tag starting at position; ">" inside quoted attribute values does not end the tag.
+	:param data: bytes or str.
+	"""
+	quotes, close = ((b'"', b"'"), b">") if isinstance(data, bytes) else (('"', "'"), ">")
+	quote = None
+	for i in range(position, len(data)):
+		char = data[i:i + 1]
+		if quote is not None:
+			if char == quote:
+				quote = None
+		elif char in quotes:
+			quote = char
+		elif char == close:
+			return i + 1
+	raise ValueError("Unterminated tag at byte {}".format(position))
+
+def get_path(segments):
+	"""Key from the ids of the enclosing elements; array indices are appended to the id of their array."""
+	path = ""
+	for segment in segments:
+		if segment.startswith("[") or not path:
+			path += segment
+		elif segment:
+			path += "/" + segment
+	return path
+
+def parse_template(data):
+	"""
+	Flattens a template in one pass with expat.
+	:param data: Template file content as bytes.
+	:return: List of Parameter in file order.
+	"""
+	parser = expat.ParserCreate()
+	stack = [] # [segment, attributes, start offset, text parts, has children]
+	parameters = []
+	keys = {}
+
+	def position():
+		return parser.CurrentByteIndex
+
+	def unique_key(key):
+		count = keys.get(key, 0) + 1
+		keys[key] = count
+		return key if count == 1 else "{}#{}".format(key, count)
+
+	def start_element(name, attributes):
+		if stack:
+			stack[-1][4] = True
+		segment = attributes.get("id", "")
+		if "index" in attributes:
+			segment += "[{}]".format(attributes["index"])
+		stack.append([segment, attributes, position(), [], False])
+
+	def end_element(name):
+		segment, attributes, start, text_parts, has_children = stack.pop()
+		end = get_tag_end(data, start)
+		if data[end - 2:end] != b"/>":
+			end = get_tag_end(data, position()) # End of the closing tag
+		path = get_path([entry[0] for entry in stack] + [segment])
+		value_attributes = [attribute for attribute in sorted(attributes) if attribute not in IGNORED_ATTRIBUTES]
+		for attribute in value_attributes:
+			parameters.append(Parameter(unique_key("{}@{}".format(path, attribute)), attributes[attribute], start, end, attribute))
+		value = "".join(text_parts).strip()
+		# Elements holding their values in attributes (calibration, font, ...) have no value of their own
+		if segment and not has_children and (value or not value_attributes or "dimension" in attributes):
+			parameters.append(Parameter(unique_key(path), value, start, end))
+
+	def character_data(data):
+		if stack:
+			stack[-1][3].append(data)
+
+	parser.StartElementHandler = start_element
+	parser.EndElementHandler = end_element
+	parser.CharacterDataHandler = character_data
+	parser.Parse(data, True)
+	return parameters
+
+def get_cache_path(template_path, cache_dir):
+	digest = hashlib.sha1(os.path.abspath(template_path).encode("utf-8")).hexdigest()[:16]
+	return os.path.join(cache_dir, "{}_{}.json".format(os.path.splitext(os.path.basename(template_path))[0], digest))
+
+def load_index(template_path, cache_dir=DEFAULT_CACHE_DIR):
+	"""
+	Parameters of a template, from the cache if the template has not changed since it was indexed.
+	:return: List of Parameter in file order.
+	"""
+	stat = os.stat(template_path)
+	signature = [INDEX_VERSION, stat.st_size, stat.st_mtime]
+	cache_path = get_cache_path(template_path, cache_dir) if cache_dir else None
+	if cache_path and os.path.exists(cache_path):
+		with open(cache_path) as f:
+			cached = json.load(f)
+		if cached["signature"] == signature:
+			return [Parameter(*entry) for entry in cached["parameters"]]
+	parameters = parse_template(read_template(template_path))
+	if cache_path:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		with open(cache_path + ".tmp", "w") as f:
+			json.dump({"signature": signature, "parameters": [parameter.to_list() for parameter in parameters]}, f)
+		os.replace(cache_path + ".tmp", cache_path)
+	return parameters
+
+def key_matches(key, pattern):
+	if "/" not in pattern:
+		key = key.rsplit("/", 1)[-1]
+	# Only * and ? are wildcards; brackets are array indices
+	return fnmatch.fnmatchcase(key.split("#")[0], pattern.replace("[", "[[]"))
+
+def select(parameters, pattern):
+	return [parameter for parameter in parameters if key_matches(parameter.key, pattern)]
+
+def expand_templates(patterns):
+	templates = []
+	for pattern in patterns:
+		matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+		for path in matches:
+			if not os.path.isfile(path):
+				sys.exit("Template not found: {}".format(path))
+			templates.append(path)
+	return templates
+
+def build_table(templates, cache_dir, pattern=None):
+	"""
+	Values of all templates side by side.
+	:return: A tuple (keys in order of first occurrence, list of {key: value} per template).
+	"""
+	keys = []
+	seen = set()
+	values = []
+	for template in templates:
+		parameters = load_index(template, cache_dir)
+		if pattern:
+			parameters = select(parameters, pattern)
+		values.append(dict((parameter.key, parameter.value) for parameter in parameters))
+		for parameter in parameters:
+			if parameter.key not in seen:
+				seen.add(parameter.key)
+				keys.append(parameter.key)
+	return keys, values
+
+def diff_templates(templates, cache_dir, pattern=None):
+	"""
+	:return: List of rows [key, value in template 1, ...] for keys that differ or are missing in some templates.
+	"""
+	keys, values = build_table(templates, cache_dir, pattern)
+	rows = []
+	for key in keys:
+		row = [template_values.get(key) for template_values in values]
+		if len(set(row)) > 1:
+			rows.append([key] + ["<missing>" if value is None else value for value in row])
+	return rows
+
+def edit_template(data, parameters, edits):
+	"""
+	Applies edits to a template.
+	:param data: Template file content as bytes.
+	:param edits: List of (key pattern, new value).
+	:return: A tuple (new content, list of (key, old value, new value), patterns without a match).
+	"""
+	replacements = {}
+	changes = []
+	missing = []
+	for pattern, value in edits:
+		matched = select(parameters, pattern)
+		if not matched:
+			missing.append(pattern)
+		for parameter in matched:
+			element = replacements.get(parameter.start, (parameter.end, data[parameter.start:parameter.end].decode("utf-8")))[1]
+			replacements[parameter.start] = (parameter.end, replace_value(element, parameter, value))
+			if parameter.value != value:
+				changes.append((parameter.key, parameter.value, value))
+	parts = []
+	position = 0
+	for start in sorted(replacements):
+		end, element = replacements[start]
+		parts.append(data[position:start])
+		parts.append(element.encode("utf-8"))
+		position = end
+	parts.append(data[position:])
+	return b"".join(parts), changes, missing
+
+def replace_value(element, parameter, value):
+	"""Replaces the text or an attribute of one element, given as its source text."""
+	start_tag_end = get_tag_end(element, 0) - 1
+	if parameter.attribute is not None:
+		start_tag = element[:start_tag_end]
+		marker = " {}=".format(parameter.attribute)
+		i = start_tag.index(marker) + len(marker)
+		quote = start_tag[i]
+		j = start_tag.index(quote, i + 1)
+		return start_tag[:i] + quoteattr(value) + start_tag[j + 1:] + element[start_tag_end:]
+	name = element[1:].split(None, 1)[0].rstrip("/>")
+	start_tag = element[:start_tag_end].rstrip("/").rstrip() if element[start_tag_end - 1] == "/" else element[:start_tag_end]
+	if value == "":
+		return start_tag + "/>"
+	return "{}>{}</{}>".format(start_tag, escape(value), name)
+
+def parse_assignments(assignments):
+	edits = []
+	for assignment in assignments:
+		if "=" not in assignment:
+			sys.exit("Expected KEY=VALUE: {}".format(assignment))
+		edits.append(tuple(assignment.split("=", 1)))
+	return edits
+
+def write_edited(template, edits, output_path, cache_dir):
+	data = read_template(template)
+	parameters = load_index(template, cache_dir)
+	new_data, changes, missing = edit_template(data, parameters, edits)
+	for pattern in missing:
+		print("{}: no parameter matches {}".format(template, pattern))
+	with open(output_path, "wb") as f:
+		f.write(new_data)
+	return changes
+
+def get_template_titles(templates):
+	"""Column titles: the file names, or the paths if file names repeat."""
+	names = [os.path.basename(template) for template in templates]
+	return names if len(set(names)) == len(names) else templates
+
+def print_rows(header, rows, output=None):
+	if output:
+		with open(output, "w", newline="") as f:
+			writer = csv.writer(f)
+			writer.writerow(header)
+			writer.writerows(rows)
+		print("{} rows written to {}".format(len(rows), output))
+		return
+	writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+	writer.writerow(header)
+	writer.writerows(rows)
+
+def main():
+	parser = argparse.ArgumentParser(description="Index, diff and batch edit MicrobeJ templates")
+	parser.add_argument("--cache", default=DEFAULT_CACHE_DIR, help="folder of cached template indexes ('' = no cache)")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	index = subparsers.add_parser("index", help="table of all parameters of one or more templates")
+	index.add_argument("templates", nargs="+")
+	index.add_argument("--grep", help="only keys matching this pattern")
+	index.add_argument("--output", help="CSV file (default: print)")
+
+	diff = subparsers.add_parser("diff", help="parameters that differ between templates")
+	diff.add_argument("templates", nargs="+")
+	diff.add_argument("--grep", help="only keys matching this pattern")
+	diff.add_argument("--output", help="CSV file (default: print)")
+
+	edit = subparsers.add_parser("set", help="set parameters in many templates")
+	edit.add_argument("templates", nargs="+")
+	edit.add_argument("--set", dest="assignments", action="append", required=True, metavar="KEY=VALUE")
+	edit.add_argument("--output", help="folder of the edited templates")
+	edit.add_argument("--in-place", action="store_true", help="overwrite the templates")
+
+	sweep = subparsers.add_parser("sweep", help="one template variant per combination of parameter values")
+	sweep.add_argument("template")
+	sweep.add_argument("--param", action="append", required=True, metavar="KEY=VALUE1,VALUE2,...")
+	sweep.add_argument("--output", required=True, help="folder of the template variants")
+	args = parser.parse_args()
+	cache_dir = args.cache or None
+
+	if args.command == "index":
+		templates = expand_templates(args.templates)
+		keys, values = build_table(templates, cache_dir, args.grep)
+		rows = [[key] + [template_values.get(key, "<missing>") for template_values in values] for key in keys]
+		print_rows(["key"] + get_template_titles(templates), rows, args.output)
+	elif args.command == "diff":
+		templates = expand_templates(args.templates)
+		if len(templates) < 2:
+			parser.error("diff needs at least two templates")
+		rows = diff_templates(templates, cache_dir, args.grep)
+		print_rows(["key"] + get_template_titles(templates), rows, args.output)
+	elif args.command == "set":
+		if not args.output and not args.in_place:
+			parser.error("give --output or --in-place")
+		edits = parse_assignments(args.assignments)
+		for template in expand_templates(args.templates):
+			if args.in_place:
+				output_path = template
+			else:
+				if not os.path.isdir(args.output):
+					os.makedirs(args.output)
+				output_path = os.path.join(args.output, os.path.basename(template))
+			changes = write_edited(template, edits, output_path, cache_dir)
+			print("{}: {} value(s) changed".format(output_path, len(changes)))
+	elif args.command == "sweep":
+		params = [(key, values.split(",")) for key, values in parse_assignments(args.param)]
+		if not os.path.isdir(args.output):
+			os.makedirs(args.output)
+		base = os.path.splitext(os.path.basename(args.template))[0]
+		rows = []
+		for number, combination in enumerate(itertools.product(*[values for _, values in params]), start=1):
+			edits = list(zip([key for key, _ in params], combination))
+			output_path = os.path.join(args.output, "{}_variant{}.xml".format(base, number))
+			write_edited(args.template, edits, output_path, cache_dir)
+			rows.append([os.path.basename(output_path)] + list(combination))
+		print_rows(["template"] + [key for key, _ in params], rows, os.path.join(args.output, "variants.csv"))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,284 @@
+"""
+Batch extraction of the Coli-Inspector profile map (diameter and fluorescence profiles along the cell axes).
+
+Replaces the per-object loops of getDiaProfiles and getFluorProfiles in Coli-Inspector-03f-KVmod.txt.
+The sampling coordinates of all cells in a plane are computed at once, following ImageJ's Straightener:
+the axis is resampled at 1 pixel spacing and sampled perpendicularly over the line width. All samples of
+a plane are then read in one bilinear interpolation pass. The result is written as <project>-Map.tif with
+the same layout as the map of the macro. Each object has one column (its object index). Row 0 holds the
+object ID, row 1 the first profile row and row 2 the profile length. Slice 1 holds the diameter in um and
+slices 2.. the fluorescence of channels 2...
+
+Usage:
+	1. In the project run "Export Objects" (writes <project>-Objects.txt).
+	2. python Profile_Engine.py <project>-Objects.txt
+	3. In the project run "Compact and Show Map".
+
+Requires numpy, scipy and tifffile.
+"""
+import argparse
+import csv
+import os
+
+import numpy as np
+import tifffile
+from scipy import ndimage
+from scipy.interpolate import CubicSpline
+
+# Defaults of the user defined parameters of the macro
+MAP_HEIGHT = 200 # mapHeight = maxLength
+MAX_DIA = 1.5 # maxDia (um), sets the slit width for diameter profiles
+EXTRA_WIDTH = 0.3 # extraWidth (um) added to the diameter for fluorescence profiles
+THR_FRACTION = 0.4 # thrFraction, only used for objects without stored threshold
+
+class CellAxis:
+	def __init__(self, row):
+		self.image = int(row["Image"])
+		self.image_name = row["ImageName"]
+		self.stack_index = int(row["StackIndex"])
+		self.img_no = float(row["ImgNo"])
+		self.thr = float(row["Thr"])
+		self.start_x = float(row["StartX"])
+		self.start_y = float(row["StartY"])
+		self.axis_x = np.array(row["AxisX"].split(), dtype=float)
+		self.axis_y = np.array(row["AxisY"].split(), dtype=float)
+		self.dia_x = np.array(row["DiaX"].split(), dtype=float)
+		self.dia_y = np.array(row["DiaY"].split(), dtype=float)
+		self.obj = int(row["Object"])
+		self.object_id = int(float(row["ObjectID"]))
+		self.pixel_size = float(row["PixelSize"])
+
+	def get_dia_length(self):
+		"""Length of the Dia item in pixels, as ojGetItemLength."""
+		return float(np.sum(np.hypot(np.diff(self.dia_x), np.diff(self.dia_y))))
+
+def read_objects(objects_path):
+	"""Reads the objects written by the macro "Export Objects"."""
+	with open(objects_path, newline="") as f:
+		return [CellAxis(row) for row in csv.DictReader(f, delimiter="\t")]
+
+def ij_round(value):
+	"""Rounds half up like round() of the ImageJ macro language."""
+	return int(np.floor(value + 0.5))
+
+def resample_axis(xs, ys):
+	"""
+	Fits a cubic spline through the axis vertices and resamples it at 1 pixel spacing, as
+	PolygonRoi.fitSplineForStraightening before a wide-line profile.
+	:return: Arrays (x, y) of the resampled points.
+	"""
+	keep = np.concatenate(([True], np.hypot(np.diff(xs), np.diff(ys)) > 0))
+	xs, ys = xs[keep], ys[keep]
+	if len(xs) < 2:
+		return xs, ys
+	chord = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(xs), np.diff(ys)))))
+	if len(xs) > 2:
+		dense_t = np.linspace(0, chord[-1], max(2, int(chord[-1] * 4)))
+		dense_x = CubicSpline(chord, xs, bc_type="natural")(dense_t)
+		dense_y = CubicSpline(chord, ys, bc_type="natural")(dense_t)
+	else:
+		dense_x, dense_y = xs, ys
+	arc = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(dense_x), np.diff(dense_y)))))
+	spaced = np.arange(0, int(arc[-1]) + 1, dtype=float)
+	return np.interp(spaced, arc, dense_x), np.interp(spaced, arc, dense_y)
+
+def straighten_coordinates(px, py, width):
+	"""
+	Sampling coordinates of a wide line along the points (px, py), as Straightener.straightenLine:
+	the direction at each point is taken from the previous point and the samples start width/2 to the left.
+	:return: Arrays (x, y) of shape (number of points, width).
+	"""
+	prev_x = np.concatenate(([px[0] - (px[1] - px[0])], px[:-1]))
+	prev_y = np.concatenate(([py[0] - (py[1] - py[0])], py[:-1]))
+	dx = px - prev_x
+	dy = prev_y - py
+	length = np.hypot(dx, dy)
+	length[length == 0] = 1
+	dx /= length
+	dy /= length
+	steps = np.arange(width, dtype=float)
+	x = (px - dy * width / 2.0)[:, None] + steps[None, :] * dy[:, None]
+	y = (py - dx * width / 2.0)[:, None] + steps[None, :] * dx[:, None]
+	return x, y
+
+def bilinear_weights(shape, x, y):
+	"""
+	Corner indices and weights of bilinear interpolation with the edge handling of
+	ImageProcessor.getInterpolatedValue: zero outside the image, clamped at the border.
+	"""
+	height, width = shape
+	inside = (x >= -1) & (x < width) & (y >= -1) & (y < height)
+	x = np.clip(x, 0, width - 1.001)
+	y = np.clip(y, 0, height - 1.001)
+	x0 = np.floor(x).astype(np.intp)
+	y0 = np.floor(y).astype(np.intp)
+	fx = x - x0
+	fy = y - y0
+	corners = [(y0, x0), (y0, x0 + 1), (y0 + 1, x0), (y0 + 1, x0 + 1)]
+	weights = [(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy]
+	return corners, [w * inside for w in weights]
+
+def interpolate(plane, x, y):
+	"""Bilinear interpolation of plane at all coordinates in one pass."""
+	corners, weights = bilinear_weights(plane.shape, x, y)
+	return sum(plane[iy, ix] * w for (iy, ix), w in zip(corners, weights))
+
+def calc_threshold(plane, thr_fraction=THR_FRACTION):
+	"""Custom threshold of calcThreshold, as Segmentation_Engine.calc_thresholds for a single plane."""
+	import Segmentation_Engine # Not imported at the top, as Segmentation_Engine imports this module
+	return float(Segmentation_Engine.calc_thresholds(plane[None].astype(np.float64), "Custom", thr_fraction)[0])
+
+def segment_means(values, lengths):
+	"""Means over consecutive segments of the given lengths."""
+	starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+	return np.add.reduceat(values, starts) / lengths
+
+def sample_profiles(plane, cells, widths, values=None):
+	"""
+	Samples wide-line profiles of several cells in one pass.
+	:param widths: Line width in pixels for each cell.
+	:param values: Optional function (corner rows, corner columns, cell number of each sample) -> corner values,
+	replacing the pixel values of plane (used for the diameter mask).
+	:return: List of profiles (mean over the line width at each axis point).
+	"""
+	xs, ys, point_widths, owners, n_points = [], [], [], [], []
+	for i, (cell, width) in enumerate(zip(cells, widths)):
+		px, py = resample_axis(cell.axis_x, cell.axis_y)
+		if len(px) < 2:
+			n_points.append(0)
+			continue
+		x, y = straighten_coordinates(px, py, width)
+		xs.append(x.ravel())
+		ys.append(y.ravel())
+		point_widths.append(np.full(len(px), width))
+		owners.append(np.full(x.size, i))
+		n_points.append(len(px))
+	if not xs:
+		return [np.zeros(0) for _ in cells]
+	x, y = np.concatenate(xs), np.concatenate(ys)
+	if values is None:
+		sampled = interpolate(plane, x, y)
+	else:
+		corners, weights = bilinear_weights(plane.shape, x, y)
+		owner = np.concatenate(owners)
+		sampled = sum(values(iy, ix, owner) * w for (iy, ix), w in zip(corners, weights))
+	means = segment_means(sampled, np.concatenate(point_widths))
+	profiles = []
+	offset = 0
+	for n in n_points:
+		profiles.append(means[offset:offset + n])
+		offset += n
+	return profiles
+
+def diameter_profiles(plane, cells, pixel_size, max_dia=MAX_DIA):
+	"""
+	Diameter profiles in um, as getDiaProfiles: the plane is thresholded at the stored threshold, the
+	cell containing its start point is set to 255 and other particles to 1, and the mean over a line
+	of maxDia * 1.5 um is converted back to a width.
+	"""
+	width30 = ij_round(max_dia * 1.5 / pixel_size)
+	profiles = [None] * len(cells)
+	by_threshold = {}
+	for i, cell in enumerate(cells):
+		thr = cell.thr if not np.isnan(cell.thr) else calc_threshold(plane)
+		by_threshold.setdefault(thr, []).append(i)
+	for thr, indexes in by_threshold.items():
+		labels, _ = ndimage.label(plane <= thr, structure=np.ones((3, 3)))
+		own = np.array([labels[min(max(ij_round(cells[i].start_y), 0), plane.shape[0] - 1), min(max(ij_round(cells[i].start_x), 0), plane.shape[1] - 1)] for i in indexes])
+		def mask_values(iy, ix, owner):
+			label = labels[iy, ix]
+			return np.where((label == own[owner]) & (label > 0), 255.0, np.where(label > 0, 1.0, 0.0))
+		sampled = sample_profiles(plane, [cells[i] for i in indexes], [width30] * len(indexes), mask_values)
+		for i, profile in zip(indexes, sampled):
+			profiles[i] = profile * pixel_size * width30 / 255.0
+	return profiles
+
+def fluorescence_profiles(plane, cells, pixel_size, extra_width=EXTRA_WIDTH, int_fluor=False):
+	"""Fluorescence profiles as getFluorProfiles: mean over a line as wide as the Dia item plus extraWidth."""
+	widths = [ij_round(cell.get_dia_length() + extra_width / pixel_size) for cell in cells]
+	profiles = sample_profiles(plane.astype(float), cells, widths)
+	if int_fluor:
+		profiles = [profile * width / 100.0 for profile, width in zip(profiles, widths)]
+	return profiles
+
+def get_channels(tif):
+	metadata = tif.imagej_metadata or {}
+	return int(metadata.get("channels", 1))
+
+def put_profile(profile_map, channel, slot, object_id, profile):
+	"""Writes one profile into its map column like appendProfile; rows outside the map are dropped."""
+	map_height = profile_map.shape[1]
+	length = len(profile)
+	start = ij_round((map_height - length) / 2.0)
+	rows = np.arange(start, start + length)
+	valid = (rows >= 0) & (rows < map_height)
+	profile_map[channel, rows[valid], slot] = profile[valid]
+	profile_map[channel, 0, slot] = object_id
+	profile_map[channel, 1, slot] = start
+	profile_map[channel, 2, slot] = length
+
+def build_map(cells, image_dir, map_height=MAP_HEIGHT, max_dia=MAX_DIA, extra_width=EXTRA_WIDTH, int_fluor=False, profile_map=None):
+	"""
+	Extracts the profiles of all cells, plane by plane.
+	:param profile_map: Optional existing map to update; only the columns of the given cells are replaced.
+	:return: Map array of shape (channels, map_height, width).
+	"""
+	width = (max(cell.obj for cell in cells) // 100 + 1) * 100
+	by_image = {}
+	for cell in cells:
+		by_image.setdefault((cell.image, cell.image_name), {}).setdefault(cell.stack_index, []).append(cell)
+	for (image, image_name), planes in sorted(by_image.items()):
+		with tifffile.TiffFile(os.path.join(image_dir, image_name)) as tif:
+			channels = get_channels(tif)
+			if profile_map is None:
+				profile_map = np.zeros((channels, map_height, width), dtype=np.float32)
+			elif profile_map.shape[2] < width:
+				profile_map = np.pad(profile_map, ((0, 0), (0, 0), (0, width - profile_map.shape[2])))
+			for stack_index, plane_cells in sorted(planes.items()):
+				pixel_size = plane_cells[0].pixel_size
+				plane = tif.pages[stack_index - 1].asarray()
+				for cell, profile in zip(plane_cells, diameter_profiles(plane, plane_cells, pixel_size, max_dia)):
+					put_profile(profile_map, 0, cell.obj, cell.object_id, profile)
+				for chn in range(2, min(channels, profile_map.shape[0]) + 1):
+					plane = tif.pages[stack_index + chn - 2].asarray()
+					for cell, profile in zip(plane_cells, fluorescence_profiles(plane, plane_cells, pixel_size, extra_width, int_fluor)):
+						put_profile(profile_map, chn - 1, cell.obj, cell.object_id, profile)
+	return profile_map
+
+def read_map(map_path):
+	"""Reads a map written by the macro or by save_map as array of shape (channels, map_height, width)."""
+	profile_map = tifffile.imread(map_path).astype(np.float32)
+	if profile_map.ndim == 2:
+		profile_map = profile_map[None]
+	return profile_map
+
+def save_map(profile_map, map_path):
+	"""Saves the map as 32-bit ImageJ image with one channel per map slice, labelled like showRawMap."""
+	labels = ["Diameter"] + ["fluorCh{}".format(chn) for chn in range(2, profile_map.shape[0] + 1)]
+	tifffile.imwrite(map_path, profile_map.astype(np.float32), imagej=True, metadata={"axes": "CYX", "Labels": labels})
+
+def get_map_path(objects_path):
+	"""Map path of the project, from the objects file <project>-Objects.txt."""
+	directory, filename = os.path.split(os.path.abspath(objects_path))
+	return os.path.join(directory, filename.replace("-Objects.txt", "") + "-Map.tif")
+
+def main():
+	parser = argparse.ArgumentParser(description="Batch extraction of the Coli-Inspector profile map")
+	parser.add_argument("objects", help="<project>-Objects.txt written by the macro 'Export Objects'")
+	parser.add_argument("--images", help="folder of the linked images (default: folder of the objects file)")
+	parser.add_argument("--output", help="map file (default: <project>-Map.tif next to the objects file)")
+	parser.add_argument("--map-height", type=int, default=MAP_HEIGHT)
+	parser.add_argument("--max-dia", type=float, default=MAX_DIA)
+	parser.add_argument("--extra-width", type=float, default=EXTRA_WIDTH)
+	parser.add_argument("--int-fluor", action="store_true", help="integrated instead of mean fluorescence (intFluorFlag)")
+	args = parser.parse_args()
+
+	cells = read_objects(args.objects)
+	image_dir = args.images or os.path.dirname(os.path.abspath(args.objects))
+	profile_map = build_map(cells, image_dir, args.map_height, args.max_dia, args.extra_width, args.int_fluor)
+	output = args.output or get_map_path(args.objects)
+	save_map(profile_map, output)
+	print("Profiles of {} objects written to {}".format(len(cells), output))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,315 @@
+"""
+Columnar on-disk store for Coli-Inspector and MicrobeJ results.
+
+Per-cell measurements, profiles and foci are written as Parquet datasets, one per table, partitioned by
+experiment (<store>/<table>/experiment=<name>/*.parquet). The rows are sorted by ImgNo and time frame, so the
+statistics of the row groups let queries on img_no and frame skip the other rows without a file per plane.
+Queries stream record batches from disk and only read the needed columns, partitions and row groups, so analyses
+across experiments do not need to fit into memory. Ingesting an experiment again replaces its data.
+
+Usage:
+	python Results_Store.py ingest-coli <store> <experiment> <project>-Objects.txt [--map <project>-Map.tif] [--results <results.txt>]
+	python Results_Store.py ingest-table <store> <table> <experiment> <MicrobeJ results.csv> --frame-column <column>
+	python Results_Store.py group-by-time <store> <table> <column> [<column> ...] --time frame --bin 2
+	python Results_Store.py info <store>
+
+Query from Python:
+	store = ResultsStore("store")
+	summary = store.group_by_time("cells", ["mean_dia_um"], time="img_no", time_bin=3, experiments=["exp1", "exp2"])
+
+Requires numpy, pandas, pyarrow and tifffile.
+"""
+import argparse
+import csv
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import tifffile
+
+import Profile_Engine
+
+TABLES = ["cells", "profiles", "foci"]
+PARTITION_SCHEMA = pa.schema([("experiment", pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+CHUNK_ROWS = 500000 # Rows read at once when ingesting large result tables
+ROW_GROUP_ROWS = 65536 # Rows per Parquet row group, the unit that queries on img_no and frame can skip
+FILE_ROWS = 16 * ROW_GROUP_ROWS # Rows per Parquet file
+
+class ResultsStore:
+	def __init__(self, root):
+		self.root = root
+
+	def get_table_path(self, table):
+		if table not in TABLES:
+			raise ValueError("Unknown table {}, expected one of {}".format(table, ", ".join(TABLES)))
+		return os.path.join(self.root, table)
+
+	def delete_experiment(self, table, experiment):
+		"""Removes all data of an experiment from a table."""
+		path = os.path.join(self.get_table_path(table), "experiment={}".format(experiment))
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+
+	def append(self, table, experiment, data):
+		"""
+		Writes rows of one experiment. The data needs the columns img_no and frame; numeric columns are
+		stored as int64 or float64 so that experiments with different column types can be queried together.
+		:param data: pandas DataFrame or pyarrow Table.
+		"""
+		if isinstance(data, pa.Table):
+			data = data.to_pandas()
+		data = data.copy()
+		for column in ("img_no", "frame"):
+			if column not in data:
+				raise ValueError("Column {} is missing".format(column))
+			data[column] = data[column].astype(np.int32)
+		for column in data.columns:
+			if column in ("img_no", "frame") or pd.api.types.is_bool_dtype(data[column]):
+				continue
+			if pd.api.types.is_integer_dtype(data[column]):
+				data[column] = data[column].astype(np.int64)
+			elif pd.api.types.is_float_dtype(data[column]):
+				data[column] = data[column].astype(np.float64)
+		data["experiment"] = experiment
+		data = data.sort_values(["img_no", "frame"], kind="stable")
+		ds.write_dataset(pa.Table.from_pandas(data, preserve_index=False), self.get_table_path(table), format="parquet",
+			partitioning=PARTITIONING, basename_template="part-{}-{{i}}.parquet".format(uuid.uuid4().hex),
+			existing_data_behavior="overwrite_or_ignore", min_rows_per_group=ROW_GROUP_ROWS,
+			max_rows_per_group=ROW_GROUP_ROWS, max_rows_per_file=FILE_ROWS)
+
+	def write(self, table, experiment, data):
+		"""Replaces the data of an experiment in a table."""
+		self.delete_experiment(table, experiment)
+		self.append(table, experiment, data)
+
+	def dataset(self, table):
+		"""pyarrow dataset of a table, with the schemas of all files unified."""
+		path = self.get_table_path(table)
+		if not os.path.isdir(path):
+			raise ValueError("Table {} is empty".format(table))
+		dataset = ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+		schema = pa.unify_schemas([dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()],
+			promote_options="permissive")
+		return ds.dataset(path, schema=schema, format="parquet", partitioning=PARTITIONING)
+
+	def scan(self, table, columns=None, experiments=None, filter=None):
+		"""
+		Streams record batches of a table.
+		:param experiments: Optional list of experiments to read (other partitions are not opened).
+		:param filter: Optional pyarrow.dataset expression, e.g. ds.field("frame") < 10.
+		"""
+		expression = filter
+		if experiments is not None:
+			selected = ds.field("experiment").isin(list(experiments))
+			expression = selected if expression is None else expression & selected
+		return self.dataset(table).to_batches(columns=columns, filter=expression)
+
+	def read(self, table, columns=None, experiments=None, filter=None):
+		"""Reads a selection of a table into a pandas DataFrame; use scan or group_by_time for large selections."""
+		batches = list(self.scan(table, columns, experiments, filter))
+		if not batches:
+			return pd.DataFrame(columns=columns)
+		return pa.Table.from_batches(batches).to_pandas()
+
+	def group_by_time(self, table, values, time="frame", by=("experiment",), time_bin=1, time_start=0, experiments=None, filter=None):
+		"""
+		Count, mean, standard deviation, minimum and maximum of value columns per time group, computed from
+		partial sums of each record batch so that only the group results are held in memory.
+		Time groups are (time - time_start) // time_bin, as timeStart and timeBin of "Plot Collective Profiles".
+		:return: pandas DataFrame with one row per group.
+		"""
+		keys = list(by) + ["time_group"]
+		columns = sorted(set(list(values) + list(by) + [time]))
+		partials = []
+		for batch in self.scan(table, columns, experiments, filter):
+			frame = batch.to_pandas()
+			if frame.empty:
+				continue
+			frame["time_group"] = (frame[time] - time_start) // time_bin
+			aggregations = {}
+			for value in values:
+				frame[value + "__sq"] = frame[value] ** 2
+				aggregations[value + "_count"] = (value, "count")
+				aggregations[value + "_sum"] = (value, "sum")
+				aggregations[value + "_sumsq"] = (value + "__sq", "sum")
+				aggregations[value + "_min"] = (value, "min")
+				aggregations[value + "_max"] = (value, "max")
+			partials.append(frame.groupby(keys, observed=True).agg(**aggregations))
+		if not partials:
+			return pd.DataFrame()
+		combined = pd.concat(partials)
+		grouped = combined.groupby(level=keys)
+		totals = grouped.sum()
+		result = pd.DataFrame(index=totals.index)
+		for value in values:
+			count = totals[value + "_count"]
+			mean = totals[value + "_sum"] / count
+			variance = (totals[value + "_sumsq"] - count * mean ** 2) / (count - 1)
+			result[value + "_count"] = count
+			result[value + "_mean"] = mean
+			result[value + "_std"] = np.sqrt(variance.clip(lower=0))
+			result[value + "_min"] = grouped[value + "_min"].min()
+			result[value + "_max"] = grouped[value + "_max"].max()
+		result = result.reset_index()
+		result["time_start"] = time_start + result["time_group"] * time_bin
+		return result
+
+def get_image_channels(image_dir, image_name):
+	"""Number of channels of a linked image, or 1 if the image is not found."""
+	path = os.path.join(image_dir, image_name)
+	if not os.path.exists(path):
+		return 1
+	with tifffile.TiffFile(path) as tif:
+		return Profile_Engine.get_channels(tif)
+
+def read_objectj_results(results_path, key):
+	"""Reads results saved from the ObjectJ results window (tab-delimited, one row per object)."""
+	results = pd.read_csv(results_path, sep="\t")
+	results = results.rename(columns={key: "object"})
+	return results
+
+def coli_inspector_tables(objects_path, map_path=None, results_path=None, results_key=" ", image_dir=None):
+	"""
+	Converts the exported objects (and optionally the profile map and ObjectJ results) of a project into
+	cells and profiles tables.
+	:return: A tuple (cells DataFrame, profiles DataFrame or None).
+	"""
+	cells = Profile_Engine.read_objects(objects_path)
+	image_dir = image_dir or os.path.dirname(os.path.abspath(objects_path))
+	channels = dict((name, get_image_channels(image_dir, name)) for name in set(cell.image_name for cell in cells))
+	table = pd.DataFrame({
+		"object": [cell.obj for cell in cells],
+		"object_id": [cell.object_id for cell in cells],
+		"image": [cell.image for cell in cells],
+		"image_name": [cell.image_name for cell in cells],
+		"stack_index": [cell.stack_index for cell in cells],
+		"img_no": [int(cell.img_no) for cell in cells],
+		"frame": [(cell.stack_index - 1) // channels[cell.image_name] + 1 for cell in cells],
+		"axis_length_um": [float(np.sum(np.hypot(np.diff(cell.axis_x), np.diff(cell.axis_y)))) * cell.pixel_size for cell in cells],
+		"dia_length_um": [cell.get_dia_length() * cell.pixel_size for cell in cells],
+		"thr": [cell.thr for cell in cells],
+		"pixel_size": [cell.pixel_size for cell in cells]
+	})
+
+	profiles = None
+	if map_path is not None:
+		profile_map = Profile_Engine.read_map(map_path)
+		columns = np.arange(1, profile_map.shape[2])
+		ids = profile_map[0, 0, columns]
+		column_of_id = dict((int(object_id), column) for object_id, column in zip(ids, columns) if object_id != 0)
+		parts = []
+		for channel in range(profile_map.shape[0]):
+			means = []
+			for cell in cells:
+				column = column_of_id.get(cell.object_id)
+				if column is None:
+					means.append(np.nan)
+					continue
+				start, length = int(profile_map[channel, 1, column]), int(profile_map[channel, 2, column])
+				rows = np.arange(max(start, 3), min(start + length, profile_map.shape[1]))
+				values = profile_map[channel, rows, column]
+				means.append(float(values.mean()) if len(values) else np.nan)
+				parts.append(pd.DataFrame({
+					"object_id": cell.object_id,
+					"img_no": int(cell.img_no),
+					"frame": (cell.stack_index - 1) // channels[cell.image_name] + 1,
+					"channel": channel + 1,
+					"position": rows - start,
+					"rel_position": (rows - start + 0.5) / float(length),
+					"value": values
+				}))
+			table["mean_dia_um" if channel == 0 else "mean_fluor_ch{}".format(channel + 1)] = means
+		profiles = pd.concat(parts, ignore_index=True) if parts else None
+
+	if results_path is not None:
+		results = read_objectj_results(results_path, results_key)
+		table = table.merge(results, on="object", how="left", suffixes=("", "_results"))
+	return table, profiles
+
+def ingest_coli_inspector(store, experiment, objects_path, map_path=None, results_path=None, results_key=" ", image_dir=None):
+	cells, profiles = coli_inspector_tables(objects_path, map_path, results_path, results_key, image_dir)
+	store.write("cells", experiment, cells)
+	print("{}: {} cells".format(experiment, len(cells)))
+	if profiles is not None:
+		store.write("profiles", experiment, profiles)
+		print("{}: {} profile points".format(experiment, len(profiles)))
+
+def ingest_table(store, table, experiment, path, img_no_column=None, frame_column=None, delimiter=None):
+	"""
+	Ingests a results table (e.g. exported from MicrobeJ) in chunks, so that large tables are never fully in memory.
+	Without img_no_column or frame_column, the ImgNo equals the frame or is 0.
+	"""
+	if delimiter is None:
+		with open(path, newline="") as f:
+			delimiter = csv.Sniffer().sniff(f.read(65536), delimiters=",;\t").delimiter
+	store.delete_experiment(table, experiment)
+	rows = 0
+	for chunk in pd.read_csv(path, sep=delimiter, chunksize=CHUNK_ROWS):
+		chunk["frame"] = chunk[frame_column] if frame_column else 1
+		chunk["img_no"] = chunk[img_no_column] if img_no_column else chunk["frame"] - 1 if frame_column else 0
+		store.append(table, experiment, chunk)
+		rows += len(chunk)
+	print("{}: {} rows in {}".format(experiment, rows, table))
+
+def main():
+	parser = argparse.ArgumentParser(description="Columnar store for Coli-Inspector and MicrobeJ results")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	coli = subparsers.add_parser("ingest-coli", help="ingest an exported Coli-Inspector project")
+	coli.add_argument("store")
+	coli.add_argument("experiment")
+	coli.add_argument("objects", help="<project>-Objects.txt written by 'Export Objects'")
+	coli.add_argument("--map", help="<project>-Map.tif")
+	coli.add_argument("--results", help="ObjectJ results saved as text")
+	coli.add_argument("--results-key", default=" ", help="column of the object index in the results (default: first, unnamed column)")
+	coli.add_argument("--images", help="folder of the linked images (default: folder of the objects file)")
+
+	table = subparsers.add_parser("ingest-table", help="ingest a results table, e.g. from MicrobeJ")
+	table.add_argument("store")
+	table.add_argument("table", choices=TABLES)
+	table.add_argument("experiment")
+	table.add_argument("path")
+	table.add_argument("--img-no-column")
+	table.add_argument("--frame-column")
+	table.add_argument("--delimiter")
+
+	query = subparsers.add_parser("group-by-time", help="summary statistics per time group")
+	query.add_argument("store")
+	query.add_argument("table", choices=TABLES)
+	query.add_argument("values", nargs="+")
+	query.add_argument("--time", default="frame", help="time column, e.g. frame or img_no")
+	query.add_argument("--by", nargs="*", default=["experiment"])
+	query.add_argument("--bin", type=int, default=1)
+	query.add_argument("--start", type=int, default=0)
+	query.add_argument("--experiments", nargs="*")
+	query.add_argument("--output", help="CSV file (default: print)")
+
+	info = subparsers.add_parser("info", help="list tables and experiments")
+	info.add_argument("store")
+	args = parser.parse_args()
+
+	store = ResultsStore(args.store)
+	if args.command == "ingest-coli":
+		ingest_coli_inspector(store, args.experiment, args.objects, args.map, args.results, args.results_key, args.images)
+	elif args.command == "ingest-table":
+		ingest_table(store, args.table, args.experiment, args.path, args.img_no_column, args.frame_column, args.delimiter)
+	elif args.command == "group-by-time":
+		result = store.group_by_time(args.table, args.values, args.time, args.by, args.bin, args.start, args.experiments)
+		if args.output:
+			result.to_csv(args.output, index=False)
+		else:
+			print(result.to_string(index=False))
+	elif args.command == "info":
+		for name in TABLES:
+			path = os.path.join(args.store, name)
+			if os.path.isdir(path):
+				experiments = sorted(entry.split("=", 1)[1] for entry in os.listdir(path) if entry.startswith("experiment="))
+				print("{}: {} rows, experiments: {}".format(name, store.dataset(name).count_rows(), ", ".join(experiments)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,280 @@
+"""
+Segmentation of cells on whole hyperstacks, as the particle analysis of Coli-Inspector (getParticleRois).
+
+For every frame of the (median-subtracted) brightfield channel:
+	- the threshold is calculated as calcThreshold with thrMethod "Custom": the frame is scaled down 4 times
+	  (averaging), median filtered (radius 2), and the threshold is set thrFraction below the histogram mode towards
+	  the minimum; "Otsu" uses the Otsu threshold instead,
+	- pixels from 0 to the threshold are cells; particles are 8-connected and their holes are filled (include),
+	- particles touching the image border are excluded, and particles outside minParticleArea-maxParticleArea (um^2)
+	  or with a circularity above maxCirc are rejected.
+Blocks of frames are labelled at once (scipy.ndimage.label without connections between frames), and the region
+properties are computed for all particles of the block with np.bincount. The perimeter for the circularity is the
+traced perimeter of ImageJ (PolygonRoi.getTracedPerimeter) of the outline, which is only traced for the particles
+that pass the border and area filters.
+
+Output:
+	- <image>-Labels.tif: 16-bit label image with one plane per frame (cells numbered per frame in scan order, as the
+	  particle analyzer), e.g. for --labels of Colocalization.py, Foci_Engine.py and Compaction_Classifier.py.
+	- <image>-Regions.csv: area, centroid, fitted ellipse, perimeter, circularity and bounding box of every cell.
+	- <image>-RoiSet.zip (--rois): traced outlines for the ROI Manager, with the frame as ROI position.
+
+Usage:
+	python Segmentation_Engine.py <hyperstack.tif> --channel 1 --rois
+
+Requires numpy, pandas, scipy and tifffile.
+"""
+import argparse
+import os
+import struct
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import ndimage
+
+import Colocalization
+import Foci_Engine
+
+THR_FRACTION = 0.4 # thrFraction: larger value = smaller particle
+THR_METHODS = ["Custom", "Otsu"]
+MIN_PARTICLE_AREA = 3.0 # minParticleArea (um^2)
+MAX_PARTICLE_AREA = 100.0 # maxParticleArea (um^2)
+MAX_CIRC = 0.60 # maxCirc: cells with higher circularity are rejected
+SCALE = 4 # calcThreshold scales the image by 0.25
+MEDIAN_RADIUS = 2 # calcThreshold median radius
+PLANE = np.zeros((3, 3, 3), dtype=bool) # 8-connected within a frame, no connection between frames
+PLANE[1] = True
+PLANE_CROSS = np.zeros((3, 3, 3), dtype=bool) # 4-connected background for filling holes
+PLANE_CROSS[1] = ndimage.generate_binary_structure(2, 1)
+
+def circular_footprint(radius):
+	"""Kernel of the ImageJ RankFilters: pixels with r^2 <= radius^2 + 1."""
+	offsets = np.arange(-int(radius), int(radius) + 1)
+	return offsets[:, None] ** 2 + offsets[None, :] ** 2 <= radius ** 2 + 1
+
+def calc_thresholds(frames, method="Custom", thr_fraction=THR_FRACTION):
+	"""
+	Threshold of every frame, as calcThreshold of Coli-Inspector.
+	:param frames: Array of shape (frames, height, width).
+	"""
+	height, width = frames.shape[1] // SCALE * SCALE, frames.shape[2] // SCALE * SCALE
+	small = frames[:, :height, :width].reshape(len(frames), height // SCALE, SCALE, width // SCALE, SCALE).mean(axis=(2, 4))
+	small = ndimage.median_filter(small, footprint=circular_footprint(MEDIAN_RADIUS)[None], mode="nearest")
+	if method == "Otsu":
+		return np.array([Colocalization.otsu_threshold(plane.ravel()) for plane in small])
+	# getHistogram with 256 bins from the minimum to the maximum; the mode excludes the first and the last two bins
+	minimum = small.min(axis=(1, 2))
+	bin_size = (small.max(axis=(1, 2)) - minimum) / 256.0
+	bin_size[bin_size == 0] = 1
+	bins = np.clip(((small - minimum[:, None, None]) / bin_size[:, None, None]).astype(int), 0, 255)
+	counts = np.bincount((np.arange(len(small))[:, None, None] * 256 + bins).ravel(), minlength=len(small) * 256).reshape(len(small), 256)
+	mode = minimum + (np.argmax(counts[:, 1:254], axis=1) + 1) * bin_size
+	return mode - np.floor(thr_fraction * (mode - minimum) + 0.5)
+
+def label_particles(mask):
+	"""
+	Particles of every frame of a mask block with filled holes.
+	:return: A tuple (labels unique in the block, number of particles), numbered in scan order.
+	"""
+	# Holes are the background regions that do not reach the image border
+	background, n = ndimage.label(~mask, structure=PLANE_CROSS)
+	outside = np.zeros(n + 1, dtype=bool)
+	outside[np.concatenate([background[:, 0].ravel(), background[:, -1].ravel(), background[:, :, 0].ravel(), background[:, :, -1].ravel()])] = True
+	return ndimage.label(mask | ~outside[background], structure=PLANE)
+
+def traced_perimeter(xs, ys):
+	"""
+	Perimeter of a traced outline, as PolygonRoi.getTracedPerimeter: the edge length minus (2 - sqrt(2)) per corner,
+	where of consecutive vertices between sides of one pixel (staircases) only every second one is a corner.
+	:param xs, ys: Polygon vertices of trace_outline.
+	"""
+	sides = np.abs(np.diff(xs, append=xs[0])) + np.abs(np.diff(ys, append=ys[0]))
+	corners = 0
+	corner = False
+	# The side ending at each vertex, starting with the closing side
+	for side in np.roll(sides, 1).tolist():
+		if side > 1 or not corner:
+			corner = True
+			corners += 1
+		else:
+			corner = False
+	return sides.sum() - corners * (2 - np.sqrt(2))
+
+def traced_perimeters(labels, boxes, selected):
+	"""
+	Traced perimeter of the selected particles of a labelled block (NaN for the others).
+	:param boxes: Slices of the particles, as ndimage.find_objects.
+	"""
+	perimeters = np.full(len(boxes), np.nan)
+	for index in np.flatnonzero(selected):
+		perimeters[index] = traced_perimeter(*trace_outline(labels[boxes[index]][0] == index + 1))
+	return perimeters
+
+def region_properties(labels, n, pixel_size, min_area=0, max_area=np.inf):
+	"""
+	Properties of all particles of a labelled block.
+	:param min_area, max_area: Range (um^2) of the particles whose perimeter and circularity are measured.
+	:return: DataFrame with one row per particle in label order.
+	"""
+	inside = labels > 0
+	index = labels[inside] - 1
+	frame_index, rows, columns = np.nonzero(inside)
+	sums = lambda weights: np.bincount(index, weights=weights, minlength=n)
+	area = sums(None)
+	x, y = sums(columns) / area + 0.5, sums(rows) / area + 0.5
+	dx, dy = columns + 0.5 - x[index], rows + 0.5 - y[index]
+	# Second moments of the pixels (with the moment of a pixel itself) give the ellipse of the same area
+	xx, yy, xy = sums(dx * dx) / area + 1 / 12.0, sums(dy * dy) / area + 1 / 12.0, sums(dx * dy) / area
+	root = np.sqrt(((xx - yy) / 2) ** 2 + xy ** 2)
+	major, minor = 4 * np.sqrt((xx + yy) / 2 + root), 4 * np.sqrt(np.maximum((xx + yy) / 2 - root, 0))
+	scale = np.sqrt(area / (np.pi * major * minor / 4))
+	boxes = ndimage.find_objects(labels, n)
+	border = np.zeros(n + 1, dtype=bool)
+	border[np.concatenate([labels[:, 0].ravel(), labels[:, -1].ravel(), labels[:, :, 0].ravel(), labels[:, :, -1].ravel()])] = True
+	perimeter = traced_perimeters(labels, boxes, ~border[1:] & (area * pixel_size ** 2 >= min_area) & (area * pixel_size ** 2 <= max_area))
+	return pd.DataFrame({
+		"frame_index": np.array([box[0].start for box in boxes]),
+		"area": area.astype(int),
+		"area_um2": area * pixel_size ** 2,
+		"x": x,
+		"y": y,
+		"major": major * scale,
+		"minor": minor * scale,
+		"angle": np.degrees(-0.5 * np.arctan2(2 * xy, xx - yy)) % 180,
+		"perimeter": perimeter,
+		"circularity": np.minimum(4 * np.pi * area / perimeter ** 2, 1),
+		"bx": np.array([box[2].start for box in boxes]),
+		"by": np.array([box[1].start for box in boxes]),
+		"width": np.array([box[2].stop - box[2].start for box in boxes]),
+		"height": np.array([box[1].stop - box[1].start for box in boxes]),
+		"border": border[1:]
+	})
+
+def segment_frames(frames, pixel_size, method="Custom", thr_fraction=THR_FRACTION, min_area=MIN_PARTICLE_AREA,
+		max_area=MAX_PARTICLE_AREA, max_circ=MAX_CIRC):
+	"""
+	Segments a block of frames.
+	:return: A tuple (uint16 labels numbered per frame, DataFrame of the accepted cells with frame_index and label).
+	"""
+	thresholds = calc_thresholds(frames, method, thr_fraction)
+	labels, n = label_particles(frames <= thresholds[:, None, None])
+	regions = region_properties(labels, n, pixel_size, min_area, max_area)
+	accepted = ~regions["border"] & (regions["area_um2"] >= min_area) & (regions["area_um2"] <= max_area) & (regions["circularity"] <= max_circ)
+	# ndimage.label numbers the particles in scan order, so the labels per frame follow the particle analyzer
+	regions = regions[accepted]
+	regions.insert(1, "label", regions.groupby("frame_index").cumcount() + 1)
+	lookup = np.zeros(n + 1, dtype=np.uint16)
+	lookup[regions.index.to_numpy() + 1] = regions["label"].to_numpy()
+	regions["threshold"] = thresholds[regions["frame_index"].to_numpy()]
+	return lookup[labels], regions.drop(columns="border").reset_index(drop=True)
+
+def trace_outline(mask):
+	"""
+	Outline of the first particle of a mask in scan order, traced along the pixel edges with 8-connectivity (as the
+	wand of ImageJ), clockwise from the upper left corner.
+	:return: Arrays (x, y) of the polygon vertices.
+	"""
+	mask = np.pad(mask, 1)
+	start_y, start_x = np.unravel_index(np.argmax(mask), mask.shape)
+	# Pixels ahead on the right and on the left of a vertex, for the directions right, down, left and up
+	right = [(0, 0), (-1, 0), (-1, -1), (0, -1)]
+	left = [(0, -1), (0, 0), (-1, 0), (-1, -1)]
+	steps = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+	x, y, direction = start_x, start_y, 0
+	xs, ys = [], []
+	while True:
+		if mask[y + left[direction][1], x + left[direction][0]]:
+			new_direction = (direction + 3) % 4
+		elif mask[y + right[direction][1], x + right[direction][0]]:
+			new_direction = direction
+		else:
+			new_direction = (direction + 1) % 4
+		if new_direction != direction or not xs:
+			xs.append(x - 1)
+			ys.append(y - 1)
+		direction = new_direction
+		x, y = x + steps[direction][0], y + steps[direction][1]
+		if x == start_x and y == start_y:
+			break
+	return np.array(xs), np.array(ys)
+
+def encode_roi(xs, ys, name, frame, channels):
+	"""ImageJ ROI file (RoiEncoder, version 228) of a traced polygon in frame (1-based) of a hyperstack."""
+	left, top = int(xs.min()), int(ys.min())
+	header = bytearray(64)
+	header[0:4] = b"Iout"
+	struct.pack_into(">hBx4hh", header, 4, 228, 8, top, left, int(ys.max()), int(xs.max()), len(xs))
+	coordinates = struct.pack(">{}h".format(2 * len(xs)), *np.concatenate((xs - left, ys - top)).astype(int))
+	header2 = bytearray(64)
+	name_offset = 64 + len(coordinates) + 64
+	struct.pack_into(">iiiii", header2, 4, 1, 1, frame, name_offset, len(name))
+	struct.pack_into(">i", header, 56, (frame - 1) * channels + 1)
+	struct.pack_into(">i", header, 60, 64 + len(coordinates))
+	return bytes(header) + coordinates + bytes(header2) + name.encode("utf-16-be")
+
+def write_roi_set(roi_path, labels, regions, first, channels, mode="a"):
+	"""Adds the outlines of a block of frames to a RoiSet.zip."""
+	with zipfile.ZipFile(roi_path, mode, zipfile.ZIP_DEFLATED) as roi_set:
+		for region in regions.itertuples():
+			box = labels[region.frame_index, region.by:region.by + region.height, region.bx:region.bx + region.width]
+			xs, ys = trace_outline(box == region.label)
+			name = "{:04d}-{:04d}".format(region.frame_index + first, region.label)
+			roi_set.writestr(name + ".roi", encode_roi(xs + region.bx, ys + region.by, name, region.frame_index + first, channels))
+
+def segment_hyperstack(image_path, channel=1, method="Custom", thr_fraction=THR_FRACTION, min_area=MIN_PARTICLE_AREA,
+		max_area=MAX_PARTICLE_AREA, max_circ=MAX_CIRC, rois=False, block_frames=Foci_Engine.BLOCK_FRAMES):
+	"""
+	Segments all frames of a hyperstack and writes the label image, the region table and optionally the ROI set.
+	:return: DataFrame of all cells.
+	"""
+	stack = Foci_Engine.Hyperstack(image_path)
+	base = os.path.splitext(image_path)[0]
+	roi_path = base + "-RoiSet.zip"
+	if rois and os.path.exists(roi_path):
+		os.remove(roi_path)
+	parts = []
+
+	def label_planes():
+		for first in range(1, stack.frames + 1, block_frames):
+			last = min(first + block_frames - 1, stack.frames)
+			labels, regions = segment_frames(stack.read_frames(channel, first, last), stack.pixel_size, method, thr_fraction, min_area, max_area, max_circ)
+			if rois:
+				write_roi_set(roi_path, labels, regions, first, stack.channels)
+			regions.insert(0, "frame", regions.pop("frame_index") + first)
+			parts.append(regions)
+			for plane in labels:
+				yield plane
+
+	try:
+		shape = stack.tif.pages[0].shape
+		tifffile.imwrite(base + "-Labels.tif", label_planes(), shape=(stack.frames,) + shape, dtype=np.uint16, imagej=True,
+			resolution=(1.0 / stack.pixel_size, 1.0 / stack.pixel_size), metadata={"axes": "TYX", "unit": stack.unit})
+	finally:
+		stack.close()
+	cells = pd.concat(parts, ignore_index=True)
+	cells.to_csv(base + "-Regions.csv", index=False)
+	return cells
+
+def main():
+	parser = argparse.ArgumentParser(description="Segmentation of cells on whole hyperstacks")
+	parser.add_argument("images", nargs="+", help="preprocessed hyperstacks")
+	parser.add_argument("--channel", type=int, default=1, help="brightfield channel (1-based)")
+	parser.add_argument("--method", choices=THR_METHODS, default="Custom", help="threshold method (thrMethod)")
+	parser.add_argument("--thr-fraction", type=float, default=THR_FRACTION, help="thrFraction of the Custom threshold")
+	parser.add_argument("--min-area", type=float, default=MIN_PARTICLE_AREA, help="minParticleArea (um^2)")
+	parser.add_argument("--max-area", type=float, default=MAX_PARTICLE_AREA, help="maxParticleArea (um^2)")
+	parser.add_argument("--max-circ", type=float, default=MAX_CIRC, help="maxCirc")
+	parser.add_argument("--rois", action="store_true", help="also write the outlines as <image>-RoiSet.zip")
+	args = parser.parse_args()
+
+	for image_path in args.images:
+		start_time = time.time()
+		cells = segment_hyperstack(image_path, args.channel, args.method, args.thr_fraction, args.min_area, args.max_area, args.max_circ, args.rois)
+		frames = cells["frame"].nunique() if len(cells) else 0
+		print("{}: {} cells in {} frames ({:.1f} s)".format(os.path.basename(image_path), len(cells), frames, time.time() - start_time))
+
+if __name__ == '__main__':
+	main()
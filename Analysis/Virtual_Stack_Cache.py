@@ -0,0 +1,149 @@
+"""
+Prefetching plane cache for browsing huge hyperstacks opened as TIFF virtual stacks in Coli-Inspector.
+
+The macro "<Navigate>Use Virtual Stacks for Browsing" replaces the stack of every linked image by a
+CachedVirtualStack, which keeps the most recently shown planes in memory up to a limit, and navigate()
+(F1/F2) reads the planes of the next objects in the background while the current object is inspected.
+The macro loads this file once as module Virtual_Stack_Cache (imp.load_source) when the cache is installed,
+and afterwards only imports the module and calls the functions at the end of this file through eval("python", ...):
+
+	Virtual_Stack_Cache.install_cache("<image title>", <limit in MB for all images, 0 = default>, <number of linked images>)
+	Virtual_Stack_Cache.prefetch_planes("<image title>", "<space-separated stack indices>")
+
+Requires Fiji (Jython). Place this file next to the ObjectJ project or in the Fiji plugins folder.
+"""
+from ij import IJ, WindowManager, VirtualStack
+from java.lang import Thread, Runnable, Throwable
+from java.util import LinkedHashMap
+import threading
+
+CACHE_FRACTION = 0.25 # Default memory for cached planes of all linked images, as fraction of the Fiji heap
+PREFETCH_FRACTION = 0.5 # Largest part of the cache filled by one read-ahead, so the planes shown last stay cached
+BYTES_PER_PIXEL = {8: 1, 16: 2, 24: 4, 32: 4}
+
+def plane_bytes(ip):
+	return ip.getWidth() * ip.getHeight() * BYTES_PER_PIXEL.get(ip.getBitDepth(), 4)
+
+class PrefetchTask(Runnable):
+	def __init__(self, stack, indices, generation):
+		self.stack = stack
+		self.indices = indices
+		self.generation = generation
+
+	def run(self):
+		try:
+			for n in self.indices:
+				if self.stack.generation != self.generation:
+					return # A newer read-ahead was requested, e.g. the user went on to the next object
+				self.stack.read_plane(n)
+		except (Exception, Throwable) as e:
+			IJ.log("Virtual stack prefetch failed: {}".format(e))
+
+class CachedVirtualStack(VirtualStack):
+	"""
+	Virtual stack that reads its planes from another (e.g. TIFF virtual) stack and keeps them in memory,
+	dropping the least recently used planes above limit_bytes. prefetch() reads planes in a background thread.
+	"""
+	def __init__(self, source, limit_bytes):
+		VirtualStack.__init__(self, source.getWidth(), source.getHeight(), source.getColorModel(), None)
+		self.source = source
+		self.limit_bytes = limit_bytes
+		self.planes = LinkedHashMap(16, 0.75, True) # Stack index -> ImageProcessor, least recently used first
+		self.cached_bytes = 0
+		self.lock = threading.RLock() # Guards planes and cached_bytes
+		self.read_lock = threading.Lock() # The source stack reads one plane at a time
+		self.generation = 0 # Incremented by every prefetch request
+
+	def getSize(self):
+		return self.source.getSize()
+
+	def getSliceLabel(self, n):
+		return self.source.getSliceLabel(n)
+
+	def getBitDepth(self):
+		return self.source.getBitDepth()
+
+	def getProcessor(self, n):
+		# A copy, so drawing on the displayed plane does not change the cached one
+		return self.get_plane(n).duplicate()
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+	def setPixels(self, pixels, n):
+		pass # Planes of virtual stacks are not saved
+
+	def get_plane(self, n):
+		with self.lock:
+			ip = self.planes.get(n)
+		if ip is None:
+			ip = self.read_plane(n)
+		return ip
+
+	def read_plane(self, n):
+		"""Reads a plane from the source stack and caches it, unless it was read meanwhile (e.g. by a prefetch)."""
+		with self.read_lock:
+			with self.lock:
+				ip = self.planes.get(n)
+			if ip is None:
+				ip = self.source.getProcessor(n)
+				self.add_plane(n, ip)
+		return ip
+
+	def add_plane(self, n, ip):
+		with self.lock:
+			self.planes.put(n, ip)
+			self.cached_bytes += plane_bytes(ip)
+			eldest = self.planes.entrySet().iterator()
+			while self.cached_bytes > self.limit_bytes and self.planes.size() > 1:
+				self.cached_bytes -= plane_bytes(eldest.next().getValue())
+				eldest.remove()
+
+	def prefetch(self, indices):
+		"""Reads the planes with the given stack indices in a background thread, in the given order; a newer request stops this one."""
+		max_planes = max(1, int(self.limit_bytes * PREFETCH_FRACTION) // (self.getWidth() * self.getHeight() * BYTES_PER_PIXEL.get(self.getBitDepth(), 4)))
+		with self.lock:
+			self.generation += 1
+			generation = self.generation
+			missing = [n for n in indices[:max_planes] if 1 <= n <= self.getSize() and not self.planes.containsKey(n)]
+		if missing:
+			thread = Thread(PrefetchTask(self, missing, generation), "Virtual stack prefetch")
+			thread.setDaemon(True)
+			thread.start()
+
+def get_cached_stack(title):
+	"""Returns the CachedVirtualStack of an open image, or None."""
+	imp = WindowManager.getImage(title)
+	if imp is None:
+		return None, None
+	stack = imp.getStack()
+	# Installed by an earlier eval, whose CachedVirtualStack class is not this one
+	return imp, (stack if hasattr(stack, "prefetch") else None)
+
+def install_cache(title, limit_mb=0, n_images=1):
+	"""
+	Replaces the stack of an image opened as virtual stack by a CachedVirtualStack.
+	:param limit_mb: Memory for the cached planes of all n_images linked images in MB, or 0 for CACHE_FRACTION of the heap.
+	"""
+	imp, cached_stack = get_cached_stack(title)
+	if imp is None or cached_stack is not None or not imp.getStack().isVirtual():
+		return
+	total_bytes = limit_mb * 1024 * 1024 if limit_mb > 0 else IJ.maxMemory() * CACHE_FRACTION
+	limit_bytes = int(total_bytes / max(1, n_images))
+	imp.setStack(CachedVirtualStack(imp.getStack(), limit_bytes), imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+	IJ.log("Plane cache of {} MB for {}".format(limit_bytes // (1024 * 1024), title))
+
+def prefetch_planes(title, indices):
+	"""
+	Reads the planes of the given positions of an image ahead, with all channels of each position.
+	:param indices: Space-separated stack indices, e.g. of the objects that will be shown next.
+	"""
+	imp, cached_stack = get_cached_stack(title)
+	if cached_stack is None:
+		return
+	channels = imp.getNChannels()
+	planes = []
+	for n in [int(float(index)) for index in indices.split()]:
+		first = n - (n - 1) % channels
+		planes.extend(index for index in range(first, first + channels) if index not in planes)
+	cached_stack.prefetch(planes)
@@ -0,0 +1,41 @@
+"""
+Checks of the traced perimeter and circularity of Segmentation_Engine.py against ImageJ (PolygonRoi.getTracedPerimeter
+and the particle analyzer with wand outlines).
+
+Usage:
+	python -m pytest test_Segmentation_Engine.py
+
+Requires numpy, pandas, scipy, tifffile and pytest.
+"""
+import numpy as np
+import pytest
+
+import Segmentation_Engine
+
+CORNER = 2 - np.sqrt(2)
+
+def measure(mask):
+	"""Perimeter and circularity of the single particle of a mask."""
+	regions = Segmentation_Engine.region_properties(np.pad(mask, 2).astype(np.int32)[None], 1, 1.0)
+	return regions["perimeter"][0], regions["circularity"][0]
+
+@pytest.mark.parametrize("size, perimeter", [
+	(1, 4 - 2 * CORNER), # Examples of the getTracedPerimeter documentation
+	(2, 8 - 4 * CORNER),
+	(10, 40 - 4 * CORNER)
+])
+def test_square(size, perimeter):
+	assert measure(np.ones((size, size), dtype=bool))[0] == pytest.approx(perimeter)
+
+def test_ellipse():
+	# Rod-shaped cell of 40 x 12 pixels, ImageJ: perimeter 92.184, circularity 0.55
+	y, x = np.mgrid[0:13, 0:41]
+	perimeter, circularity = measure(((x - 20) / 20.0) ** 2 + ((y - 6) / 6.0) ** 2 <= 1)
+	assert perimeter == pytest.approx(92.184, abs=1e-3)
+	assert circularity == pytest.approx(0.55, abs=0.01)
+	assert circularity < Segmentation_Engine.MAX_CIRC
+
+def test_circularity_below_one():
+	y, x = np.mgrid[-20:21, -20:21]
+	for mask in (x ** 2 + y ** 2 <= 20 ** 2, np.abs(x) + np.abs(y) <= 15):
+		assert measure(mask)[1] < 0.95
@@ -0,0 +1,107 @@
+from ij import IJ, ImagePlus
+from ij.process import ImageProcessor, ShortProcessor
+from ij.gui import GenericDialog
+from ij.io import DirectoryChooser
+import os
+import sys
+import time
+
+def import_preprocessing_module():
+	"""Imports the DM6000B preprocessing script, which provides the TiffWriter and the brightfield processing used as workload."""
+	try:
+		script_dir = os.path.dirname(os.path.abspath(__file__))
+	except NameError:
+		script_dir = DirectoryChooser("Choose the Preprocessing folder").getDirectory()
+		if script_dir is None:
+			return None
+	if script_dir not in sys.path:
+		sys.path.insert(0, script_dir)
+	import Preprocessing_DM6000B_images
+	return Preprocessing_DM6000B_images
+
+def create_test_image(width, height, seed):
+	"""Creates a 16-bit brightfield-like test image with noise."""
+	ImageProcessor.setRandomSeed(seed)
+	ip = ShortProcessor(width, height)
+	ip.set(20000)
+	ip.noise(2000)
+	return ImagePlus("Benchmark_{}".format(seed), ip)
+
+def make_slow_writer_class(module, latency_ms_per_mb):
+	"""Returns a TiffWriter subclass that adds a fixed delay per megabyte, emulating slow (e.g. network) storage."""
+	class SlowTiffWriter(module.TiffWriter):
+		def write_file(self, imp, path):
+			module.TiffWriter.write_file(self, imp, path)
+			time.sleep(latency_ms_per_mb * os.path.getsize(path) / 1e6 / 1000.0)
+	return SlowTiffWriter
+
+def run_benchmark(module, output_dir, n_images, width, height, latency_ms_per_mb, queue_depth, writer_threads):
+	"""
+	Processes and saves the same test images once with writing on the processing thread and once with the TiffWriter queue.
+	:return: A tuple (synchronous seconds, asynchronous seconds).
+	"""
+	writer_class = make_slow_writer_class(module, latency_ms_per_mb)
+	paths = [os.path.join(output_dir, "Benchmark_AsyncTiffWriter_{}.tif".format(i)) for i in range(n_images)]
+
+	# Writing on the processing thread, as before the writer queue
+	sync_writer = writer_class(1, 1)
+	start_time = time.time()
+	for i, path in enumerate(paths):
+		result = module.process_brightfield(create_test_image(width, height, i))
+		sync_writer.write_file(result, path)
+		sync_writer.written_paths.add(path) # Synced by finish() as in the writer queue
+		result.close()
+	sync_writer.finish()
+	sync_seconds = time.time() - start_time
+
+	# Writing in the background while the next image is processed
+	writer = writer_class(queue_depth, writer_threads)
+	start_time = time.time()
+	try:
+		for i, path in enumerate(paths):
+			writer.submit(module.process_brightfield(create_test_image(width, height, i)), path)
+	finally:
+		writer.finish()
+	async_seconds = time.time() - start_time
+
+	for path in paths:
+		if os.path.exists(path):
+			os.remove(path)
+	return sync_seconds, async_seconds
+
+def main():
+	module = import_preprocessing_module()
+	if module is None:
+		return
+
+	gd = GenericDialog("Benchmark asynchronous TIFF writer")
+	gd.addDirectoryField("Output folder (storage to test):", "")
+	gd.addNumericField("Number of images:", 20, 0)
+	gd.addNumericField("Image width (pixels):", 2048, 0)
+	gd.addNumericField("Image height (pixels):", 2048, 0)
+	gd.addNumericField("Simulated write latency (ms per MB, 0 = none):", 100, 0)
+	gd.addNumericField("Writer queue depth:", module.WRITER_QUEUE_DEPTH, 0)
+	gd.addNumericField("Writer threads:", module.WRITER_THREADS, 0)
+	gd.showDialog()
+	if gd.wasCanceled():
+		return
+	output_dir = gd.getNextString().strip()
+	if not os.path.isdir(output_dir):
+		IJ.error("Folder not found: {}".format(output_dir))
+		return
+	n_images = max(1, int(gd.getNextNumber()))
+	width = max(16, int(gd.getNextNumber()))
+	height = max(16, int(gd.getNextNumber()))
+	latency_ms_per_mb = max(0, gd.getNextNumber())
+	queue_depth = max(1, int(gd.getNextNumber()))
+	writer_threads = max(1, int(gd.getNextNumber()))
+
+	sync_seconds, async_seconds = run_benchmark(module, output_dir, n_images, width, height, latency_ms_per_mb, queue_depth, writer_threads)
+	print("Benchmark: {} images of {} x {} pixels, {} ms/MB simulated latency, queue depth {}, {} writer thread(s)".format(
+		n_images, width, height, latency_ms_per_mb, queue_depth, writer_threads))
+	print("Synchronous writing: {:.1f} s ({:.2f} images/s)".format(sync_seconds, n_images / sync_seconds))
+	print("Writer queue: {:.1f} s ({:.2f} images/s)".format(async_seconds, n_images / async_seconds))
+	print("Speedup: {:.2f}x".format(sync_seconds / async_seconds))
+
+if __name__ in ['__builtin__', '__main__']:
+	main()
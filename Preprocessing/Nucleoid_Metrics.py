@@ -0,0 +1,41 @@
+from ij.process import ImageProcessor, ImageStatistics
+from ij.plugin.filter import ParticleAnalyzer
+from ij.measure import Measurements, ResultsTable
+
+# Quick nucleoid metrics of the DNA (e.g. HU-mCherry) channel, shared by Preprocessing_NikonTi2_images.py and
+# Preprocessing_ImageXpress_images.py, which measure the processed planes while they are in memory for a first look
+# at DNA compaction before a full MicrobeJ or Coli-Inspector analysis.
+# Place this file next to the preprocessing scripts or in the Fiji Jython library (Fiji.app/jars/Lib).
+METRICS_THRESHOLD_METHOD = "Otsu" # ImageJ auto threshold method separating nucleoids from the background
+NUCLEOID_MIN_AREA = 0.05 # Smallest object counted as a nucleoid (calibrated units squared, e.g. um^2)
+
+def get_min_size(cal):
+	"""Smallest nucleoid in pixels, as the ParticleAnalyzer takes its size limits in pixels."""
+	return NUCLEOID_MIN_AREA / (cal.pixelWidth * cal.pixelHeight)
+
+def measure_nucleoids(imp):
+	"""
+	Thresholds a background-subtracted fluorescence plane and measures the nucleoids in it.
+	The concentration index is the coefficient of variation of the nucleoid pixels, which rises when the DNA compacts.
+	:return: A tuple (threshold, nucleoid count, nucleoid area, mean nucleoid area, fraction of the intensity in nucleoids, concentration index).
+	"""
+	ip = imp.getProcessor()
+	cal = imp.getCalibration()
+	ip.setAutoThreshold(METRICS_THRESHOLD_METHOD, True, ImageProcessor.NO_LUT_UPDATE)
+	threshold = ip.getMinThreshold()
+	if threshold == ImageProcessor.NO_THRESHOLD: # Blank plane
+		return 0, 0, 0.0, 0.0, 0.0, 0.0
+
+	inside = ImageStatistics.getStatistics(ip, Measurements.MEAN | Measurements.STD_DEV | Measurements.LIMIT, cal)
+	rt = ResultsTable()
+	ParticleAnalyzer(0, Measurements.AREA, rt, get_min_size(cal), float("inf")).analyze(imp, ip)
+	ip.resetThreshold()
+	total = ImageStatistics.getStatistics(ip, Measurements.MEAN, cal)
+
+	count = rt.size()
+	area = sum(rt.getValue("Area", row) for row in range(count))
+	mean_area = area / count if count else 0.0
+	total_intensity = total.mean * total.pixelCount
+	intensity_fraction = inside.mean * inside.pixelCount / total_intensity if total_intensity > 0 else 0.0
+	concentration_index = inside.stdDev / inside.mean if inside.mean > 0 else 0.0
+	return threshold, count, area, mean_area, intensity_fraction, concentration_index
@@ -1,10 +1,13 @@
-from ij.plugin import ChannelSplitter, RGBStackMerge, ImageCalculator, ImagesToStack, Duplicator
+from ij.plugin import ChannelSplitter, RGBStackMerge, ImageCalculator, ImagesToStack, Duplicator, ContrastEnhancer
 from ij import IJ, ImagePlus, ImageStack, WindowManager
-from ij.process import ImageConverter
+from ij.process import ImageConverter, ByteProcessor, Blitter
 from ij.measure import Calibration
 from ij.gui import GenericDialog
+from ij.io import FileSaver
 from javax.swing import JFileChooser, JFrame
-from java.io import File
+from java.io import File, RandomAccessFile
+from java.lang import Runnable, Throwable
+from java.util.concurrent import Executors, Semaphore, ConcurrentLinkedQueue
 from javax.swing.filechooser import FileFilter
 import os
 
@@ -92,20 +95,44 @@ def get_user_input():
 
 	return bf_channel, fl_channel
 
+# Brightfield images are divided into background (median filtered image) and the difference from it,
+# and the difference is mapped from BRIGHTFIELD_MIN-BRIGHTFIELD_MAX to the 16-bit range
+BRIGHTFIELD_MIN = -7500 # Difference shown as 0
+BRIGHTFIELD_MAX = 10000 # Difference shown as 65535
+BRIGHTFIELD_INTEGER = False # Process 16-bit images without a 32-bit difference image; off until Validate_Preprocessing.py confirms identical outputs
+
 # Function to process brightfield image as described
 def process_brightfield(imp):
 	# create a duplicate of the original image
 	imp_duplicate = imp.duplicate() 
 	IJ.run(imp_duplicate, "Median...", "radius=16") # Equals roughly 2 µm in size
 
+	# With BRIGHTFIELD_INTEGER, 16-bit images are processed without a 32-bit intermediate image, unless adding the offset would saturate
+	ip = imp.getProcessor()
+	if not BRIGHTFIELD_INTEGER or ip.getBitDepth() != 16 or ip.getStatistics().max - BRIGHTFIELD_MIN > 65535:
+		return process_brightfield_float(imp, imp_duplicate)
+
+	# (image - background - min) * 65535 / (max - min), rounded and clamped to 0-65535 exactly as by the 16-bit
+	# conversion of the 32-bit difference: negative values are clamped by the subtraction, large ones by the multiplication
+	result_ip = ip.duplicate()
+	result_ip.add(-BRIGHTFIELD_MIN)
+	result_ip.copyBits(imp_duplicate.getProcessor(), 0, 0, Blitter.SUBTRACT)
+	result_ip.multiply(65535.0 / (BRIGHTFIELD_MAX - BRIGHTFIELD_MIN))
+	result_ip.resetMinAndMax()
+	imp_duplicate.close()
+
+	result = ImagePlus("Result of " + imp.getShortTitle(), result_ip) # Same title as from the Image Calculator
+	result.setCalibration(imp.getCalibration().copy())
+	return result
+
+def process_brightfield_float(imp, imp_duplicate):
+	"""Brightfield processing through a 32-bit difference image; the default, and used for images that are not 16-bit or too bright for the integer path."""
 	# Subtract the filtered image from the original
 	ic = ImageCalculator()
 	result = ic.run("Subtract create 32-bit", imp, imp_duplicate)
 	
 	# Set brightness levels of 32-bit result image and convert to 16-bit
-	standard_min = -7500  # Minimum brightness
-	standard_max = 10000  # Maximum brightness
-	result.setDisplayRange(standard_min, standard_max)
+	result.setDisplayRange(BRIGHTFIELD_MIN, BRIGHTFIELD_MAX)
 	ImageConverter(result).convertToGray16()
 
 	return result  # Return the resulting image
@@ -128,6 +155,83 @@ def set_scale(imp, pixel_Width, pixel_Unit):
 	imp.setCalibration(cal)
 	return imp
 
+# Background writing of output TIFFs, so the next image is processed while the previous one is written.
+# Raise the queue depth on slow (e.g. network) storage if memory allows; each queued image stays in memory until written.
+WRITER_QUEUE_DEPTH = 4 # Maximum number of images waiting to be written before processing blocks
+WRITER_THREADS = 2 # Number of images written at the same time
+
+class TiffWriteTask(Runnable):
+	def __init__(self, writer, imp, path, close, sync):
+		self.writer = writer
+		self.imp = imp
+		self.path = path
+		self.close = close
+		self.sync = sync
+
+	def run(self):
+		try:
+			self.writer.write_file(self.imp, self.path)
+			if self.sync:
+				self.writer.written_paths.add(self.path)
+		except (Exception, Throwable) as e:
+			if self.writer.error is None:
+				self.writer.error = "Could not write {}: {}".format(self.path, e)
+		finally:
+			if self.close:
+				self.imp.close()
+			self.writer.slots.release()
+
+class TiffWriter:
+	"""
+	Bounded queue of background writer threads for TIFF files. submit() blocks while queue_depth
+	images are waiting (back-pressure). A failed write is raised as IOError by the next submit(),
+	wait() or finish(). finish() waits for all writes and syncs the written files to disk.
+	"""
+	def __init__(self, queue_depth=WRITER_QUEUE_DEPTH, writer_threads=WRITER_THREADS):
+		self.executor = Executors.newFixedThreadPool(max(1, writer_threads))
+		self.slots = Semaphore(max(1, queue_depth))
+		self.pending = []
+		self.written_paths = ConcurrentLinkedQueue()
+		self.error = None
+
+	def write_file(self, imp, path):
+		if not FileSaver(imp).saveAsTiff(path):
+			raise IOError("FileSaver failed")
+
+	def check(self):
+		if self.error is not None:
+			raise IOError(self.error)
+
+	def submit(self, imp, path, close=True, sync=True):
+		"""
+		Queues imp to be saved as path. The image must not be changed afterwards and is closed once written if close is True.
+		Files with sync set to False (e.g. temporary files) are not synced to disk by finish().
+		"""
+		self.check()
+		self.slots.acquire()
+		self.pending = [future for future in self.pending if not future.isDone()]
+		self.pending.append(self.executor.submit(TiffWriteTask(self, imp, path, close, sync)))
+
+	def wait(self):
+		"""Waits until all queued images are written."""
+		for future in self.pending:
+			future.get()
+		self.pending = []
+		self.check()
+
+	def finish(self):
+		"""Waits for all writes, syncs the written files to disk and stops the writer threads."""
+		try:
+			self.wait()
+			while not self.written_paths.isEmpty():
+				raf = RandomAccessFile(self.written_paths.poll(), "rw")
+				try:
+					raf.getFD().sync()
+				finally:
+					raf.close()
+		finally:
+			self.executor.shutdown()
+
 def open_and_process_image(filepath, bf_channel, fl_channel):
 	imp = IJ.openImage(filepath)
 	if imp is None:
@@ -160,21 +264,55 @@ def open_and_process_image(filepath, bf_channel, fl_channel):
 
 	return processed_stack
 
-def save_processed_image(image, original_file_path):
+# Downsampled previews for quality control, made from the processed channels while they are in memory
+PREVIEW_SIZE = 256 # Longest side of a channel tile in the preview, in pixels
+PREVIEW_SATURATED = 0.35 # Percentage of saturated pixels in the auto contrast of a preview tile
+
+def make_thumbnail(ip, size=PREVIEW_SIZE):
+	"""Scales an image down to size pixels on its longest side and converts it to 8-bit with auto contrast."""
+	scale = float(size) / max(ip.getWidth(), ip.getHeight())
+	thumbnail = ip.resize(max(1, int(round(ip.getWidth() * scale))), max(1, int(round(ip.getHeight() * scale))), True)
+	ContrastEnhancer().stretchHistogram(thumbnail, PREVIEW_SATURATED)
+	return thumbnail.convertToByte(True)
+
+def save_preview(image, preview_path):
+	"""Saves the channels of a processed image side by side as a small PNG."""
+	stack = image.getStack()
+	tiles = [make_thumbnail(stack.getProcessor(index)) for index in range(1, stack.getSize() + 1)]
+	preview = ByteProcessor(sum(tile.getWidth() for tile in tiles), max(tile.getHeight() for tile in tiles))
+	x = 0
+	for tile in tiles:
+		preview.insert(tile, x, 0)
+		x += tile.getWidth()
+	FileSaver(ImagePlus(os.path.basename(preview_path), preview)).saveAsPng(preview_path)
+
+def save_processed_image(image, original_file_path, writer=None):
 	directory, filename = os.path.split(original_file_path)
 	name, ext = os.path.splitext(filename)
+	if ext != ".tiff":
+		ext = ".tif" # Same extension as given by IJ.saveAsTiff
 	output_filename = name + "_Processed" + ext
 	output_path = os.path.join(directory, output_filename)
 
-	# Save the image
-	IJ.saveAsTiff(image, output_path)
+	# The preview is made before the image is queued, as the writer closes it once written
+	save_preview(image, os.path.join(directory, name + "_Processed_Preview.png"))
+
+	# Save the image, in the background if a writer is given
+	if writer is not None:
+		writer.submit(image, output_path)
+	else:
+		IJ.saveAsTiff(image, output_path)
 
 def batch_process(files, bf_channel, fl_channel):
-	for filepath in files:
-		print("Processing:", filepath)
-		processed_image = open_and_process_image(filepath, bf_channel, fl_channel)
-		if processed_image is not None:
-			save_processed_image(processed_image, filepath)
+	writer = TiffWriter()
+	try:
+		for filepath in files:
+			print("Processing:", filepath)
+			processed_image = open_and_process_image(filepath, bf_channel, fl_channel)
+			if processed_image is not None:
+				save_processed_image(processed_image, filepath, writer)
+	finally:
+		writer.finish()
 
 def select_files():
 	# Create a file chooser
@@ -1,16 +1,21 @@
 from ij import IJ, ImagePlus, ImageStack, WindowManager
-from ij.plugin import ChannelSplitter, RGBStackMerge, ImageCalculator, ImagesToStack
-from ij.process import ImageConverter
+from ij.plugin import ChannelSplitter, RGBStackMerge, ImageCalculator, ImagesToStack, ContrastEnhancer
+from ij.process import ImageConverter, ByteProcessor, Blitter
 from ij.gui import GenericDialog
-from ij.io import DirectoryChooser, OpenDialog
+from ij.io import DirectoryChooser, OpenDialog, FileSaver
 from ij.measure import Calibration
-from java.awt import Frame
+from java.awt import Frame, Color
 from javax.swing import JFileChooser, JFrame
 from javax.swing.filechooser import FileFilter
-from java.lang import String
+from java.lang import String, Runnable, Throwable
+from java.util.concurrent import Executors, Semaphore, ConcurrentLinkedQueue
 from java.nio.charset import Charset
-from java.io import File
+from java.io import File, RandomAccessFile, IOException
+from imp import load_source
 import os
+import time
+import csv
+import json
 
 # Helper class to manage the channel information
 class ChannelConfig:
@@ -77,6 +82,158 @@ time_map_SuperComp = {
     '23': "I37T42_Cip60min" 
 }
 
+# Helper class to manage the plate map entry of a well
+class WellConfig:
+	def __init__(self, well, condition, timing, include):
+		self.well = well
+		self.condition = condition
+		self.timing = timing
+		self.include = include
+
+	def get_time_stamp(self):
+		# Combine condition and timing into the annotation used in output filenames
+		return "_".join(part for part in [self.condition, self.timing] if part)
+
+TRUE_VALUES = ["true", "yes", "y", "1", "x"]
+FALSE_VALUES = ["false", "no", "n", "0", ""]
+
+def normalize_well(well):
+	"""
+	Normalizes a well identifier from the plate map to the ImageXpress filename format.
+	'B3' and 'b03' both become 'B03'. A column number alone ('3' or '03') becomes '03'
+	and applies to every row of that column.
+	:return: The normalized identifier, or None if it is not a valid well.
+	"""
+	well = well.strip().upper()
+	if well[:1].isalpha():
+		row, column = well[0], well[1:]
+	else:
+		row, column = "", well
+	if not column.isdigit() or not 1 <= int(column) <= 48:
+		return None
+	return row + "{:02d}".format(int(column))
+
+def read_plate_map_rows(path):
+	"""Reads the raw plate map rows (list of dicts with lower-case keys) from a CSV or JSON file."""
+	if path.lower().endswith(".json"):
+		with open(path, "r") as f:
+			data = json.load(f)
+		# Accept either a list of well entries or a dict of well -> entry
+		if isinstance(data, dict):
+			rows = []
+			for well, entry in sorted(data.items()):
+				entry = dict(entry)
+				entry["well"] = well
+				rows.append(entry)
+			data = rows
+		return [dict((str(key).strip().lower(), value) for key, value in row.items()) for row in data]
+	else:
+		with open(path, "rb") as f:
+			# Strip a UTF-8 byte order mark that spreadsheet programs may write before the first header
+			return [dict((key.strip().lstrip("\xef\xbb\xbf").lower(), value) for key, value in row.items() if key is not None) for row in csv.DictReader(f)]
+
+def load_plate_map(path):
+	"""
+	Loads and validates a plate map describing condition, timing and include flag for each well.
+	:param path: Path to a CSV file with the columns well, condition, timing and include,
+		or a JSON file holding the same fields.
+	:return: A tuple (plate_map, errors) where plate_map is a dict of normalized well -> WellConfig,
+		and errors is a list of messages describing every invalid entry.
+	"""
+	plate_map = {}
+	errors = []
+	try:
+		rows = read_plate_map_rows(path)
+	except (IOError, ValueError, TypeError, AttributeError, csv.Error) as e:
+		return None, ["Could not read plate map {}: {}".format(path, e)]
+
+	if not rows:
+		return None, ["Plate map {} contains no wells.".format(path)]
+
+	for row_no, row in enumerate(rows, 1):
+		raw_well = row.get("well")
+		if raw_well is None or not str(raw_well).strip():
+			errors.append("Entry {}: missing well.".format(row_no))
+			continue
+		well = normalize_well(str(raw_well))
+		if well is None:
+			errors.append("Entry {}: invalid well '{}'.".format(row_no, raw_well))
+			continue
+		if well in plate_map:
+			errors.append("Entry {}: well '{}' is listed more than once.".format(row_no, well))
+			continue
+
+		include = row.get("include", True)
+		if not isinstance(include, bool):
+			include_text = str(include).strip().lower()
+			if include_text in TRUE_VALUES:
+				include = True
+			elif include_text in FALSE_VALUES:
+				include = False
+			else:
+				errors.append("Entry {}: invalid include flag '{}' for well '{}'.".format(row_no, include, well))
+				continue
+
+		condition = str(row.get("condition") or "").strip()
+		timing = str(row.get("timing") or "").strip()
+		if include and not (condition or timing):
+			errors.append("Entry {}: included well '{}' has neither condition nor timing.".format(row_no, well))
+			continue
+
+		plate_map[well] = WellConfig(well, condition, timing, include)
+
+	return plate_map, errors
+
+def get_well_config(plate_map, well):
+	"""Returns the WellConfig for a well, falling back to a column-wide entry (e.g. '03')."""
+	well = normalize_well(well)
+	if well is None:
+		return None
+	if well in plate_map:
+		return plate_map[well]
+	return plate_map.get(well[1:])
+
+def select_wells_from_plate_map(filepaths, plate_map):
+	"""
+	Checks every selected file against the plate map before any image is opened.
+	:return: A tuple (included_filepaths, skipped_wells, errors).
+	"""
+	included_filepaths = []
+	skipped_wells = set()
+	errors = []
+	unmapped_wells = set()
+	for filepath in filepaths:
+		file_name = os.path.basename(filepath)
+		metadata = parse_filename(file_name)
+		if metadata is None:
+			errors.append("Could not parse well from filename: {}".format(file_name))
+			continue
+		well_config = get_well_config(plate_map, metadata['well'])
+		if well_config is None:
+			unmapped_wells.add(metadata['well'])
+		elif well_config.include:
+			included_filepaths.append(filepath)
+		else:
+			skipped_wells.add(well_config.well)
+
+	if unmapped_wells:
+		errors.append("Wells missing from plate map: {}".format(", ".join(sorted(unmapped_wells))))
+
+	return included_filepaths, sorted(skipped_wells), errors
+
+def get_plate_map_input():
+	"""
+	Lets the user choose an optional plate map file.
+	:return: The plate map path, an empty string to use the built-in time map, or None if canceled.
+	"""
+	gd_plateMap = GenericDialog("Plate map")
+	gd_plateMap.addMessage("CSV/JSON plate map with columns: well, condition, timing, include.\nLeave empty to use the built-in time map and process all selected wells.")
+	gd_plateMap.addFileField("Plate map file:", "")
+	gd_plateMap.showDialog()
+	if gd_plateMap.wasCanceled():
+		return None
+	return gd_plateMap.getNextString().strip()
+
 def select_files():
 	# Allow user to choose filter for well_number
 	gd_wellnumber = GenericDialog("Select filter text for file browsing")
@@ -169,20 +326,44 @@ def get_user_input():
 
 	return [channels_config[i] for i in final_channels_order], image_format, num_channels
 
+# Brightfield images are divided into background (median filtered image) and the difference from it,
+# and the difference is mapped from BRIGHTFIELD_MIN-BRIGHTFIELD_MAX to the 16-bit range
+BRIGHTFIELD_MIN = -7500 # Difference shown as 0
+BRIGHTFIELD_MAX = 10000 # Difference shown as 65535
+BRIGHTFIELD_INTEGER = False # Process 16-bit images without a 32-bit difference image; off until Validate_Preprocessing.py confirms identical outputs
+
 # Function to process brightfield image as described
 def process_brightfield(imp):
 	# create a duplicate of the original image
 	imp_duplicate = imp.duplicate() 
 	IJ.run(imp_duplicate, "Median...", "radius=18") # Equals roughly 2 µm in size
 
+	# With BRIGHTFIELD_INTEGER, 16-bit images are processed without a 32-bit intermediate image, unless adding the offset would saturate
+	ip = imp.getProcessor()
+	if not BRIGHTFIELD_INTEGER or ip.getBitDepth() != 16 or ip.getStatistics().max - BRIGHTFIELD_MIN > 65535:
+		return process_brightfield_float(imp, imp_duplicate)
+
+	# (image - background - min) * 65535 / (max - min), rounded and clamped to 0-65535 exactly as by the 16-bit
+	# conversion of the 32-bit difference: negative values are clamped by the subtraction, large ones by the multiplication
+	result_ip = ip.duplicate()
+	result_ip.add(-BRIGHTFIELD_MIN)
+	result_ip.copyBits(imp_duplicate.getProcessor(), 0, 0, Blitter.SUBTRACT)
+	result_ip.multiply(65535.0 / (BRIGHTFIELD_MAX - BRIGHTFIELD_MIN))
+	result_ip.resetMinAndMax()
+	imp_duplicate.close()
+
+	result = ImagePlus("Result of " + imp.getShortTitle(), result_ip) # Same title as from the Image Calculator
+	result.setCalibration(imp.getCalibration().copy())
+	return result
+
+def process_brightfield_float(imp, imp_duplicate):
+	"""Brightfield processing through a 32-bit difference image; the default, and used for images that are not 16-bit or too bright for the integer path."""
 	# Subtract the filtered image from the original
 	ic = ImageCalculator()
 	result = ic.run("Subtract create 32-bit", imp, imp_duplicate)
 	
 	# Set brightness levels of 32-bit result image and convert to 16-bit
-	standard_min = -7500  # Minimum brightness
-	standard_max = 10000  # Maximum brightness
-	result.setDisplayRange(standard_min, standard_max)
+	result.setDisplayRange(BRIGHTFIELD_MIN, BRIGHTFIELD_MAX)
 	ImageConverter(result).convertToGray16()
 
 	return result  # Return the resulting image
@@ -220,48 +401,245 @@ def set_scale(imp, pixelWidth, pixelUnit):
 	imp.setCalibration(cal)
 	return imp
 
-def main():
-	filepaths = select_files()
-	if not filepaths:
-		IJ.error("No files were selected!")
-		return
-    
-	# Get user input considering modifications for the brightfield channel
-	user_input = get_user_input()
-	if user_input is None:  # Stop the script if the user input is invalid
-		print("User input canceled or invalid.")
-		return
-	channels_config, image_format, num_channels = user_input
-
-	# Define output location
-	dc = DirectoryChooser("Choose Output Directory")
-	output_dir = dc.getDirectory()
-
-	# Set scaling values
-	pixelWidth = 0.115
-	pixelUnit = u"µm"
-
-	# Initialize data structures for organizing images
-	sites = {}
-    
-	# Process and organize files
+# Background writing of output TIFFs, so the next image is processed while the previous one is written.
+# Raise the queue depth on slow (e.g. network) storage if memory allows; each queued image stays in memory until written.
+WRITER_QUEUE_DEPTH = 4 # Maximum number of images waiting to be written before processing blocks
+WRITER_THREADS = 2 # Number of images written at the same time
+
+class TiffWriteTask(Runnable):
+	def __init__(self, writer, imp, path, close, sync):
+		self.writer = writer
+		self.imp = imp
+		self.path = path
+		self.close = close
+		self.sync = sync
+
+	def run(self):
+		try:
+			self.writer.write_file(self.imp, self.path)
+			if self.sync:
+				self.writer.written_paths.add(self.path)
+		except (Exception, Throwable) as e:
+			if self.writer.error is None:
+				self.writer.error = "Could not write {}: {}".format(self.path, e)
+		finally:
+			if self.close:
+				self.imp.close()
+			self.writer.slots.release()
+
+class TiffWriter:
+	"""
+	Bounded queue of background writer threads for TIFF files. submit() blocks while queue_depth
+	images are waiting (back-pressure). A failed write is raised as IOError by the next submit(),
+	wait() or finish(). finish() waits for all writes and syncs the written files to disk.
+	"""
+	def __init__(self, queue_depth=WRITER_QUEUE_DEPTH, writer_threads=WRITER_THREADS):
+		self.executor = Executors.newFixedThreadPool(max(1, writer_threads))
+		self.slots = Semaphore(max(1, queue_depth))
+		self.pending = []
+		self.written_paths = ConcurrentLinkedQueue()
+		self.error = None
+
+	def write_file(self, imp, path):
+		if not FileSaver(imp).saveAsTiff(path):
+			raise IOError("FileSaver failed")
+
+	def check(self):
+		if self.error is not None:
+			raise IOError(self.error)
+
+	def submit(self, imp, path, close=True, sync=True):
+		"""
+		Queues imp to be saved as path. The image must not be changed afterwards and is closed once written if close is True.
+		Files with sync set to False (e.g. temporary files) are not synced to disk by finish().
+		"""
+		self.check()
+		self.slots.acquire()
+		self.pending = [future for future in self.pending if not future.isDone()]
+		self.pending.append(self.executor.submit(TiffWriteTask(self, imp, path, close, sync)))
+
+	def wait(self):
+		"""Waits until all queued images are written."""
+		for future in self.pending:
+			future.get()
+		self.pending = []
+		self.check()
+
+	def finish(self):
+		"""Waits for all writes, syncs the written files to disk and stops the writer threads."""
+		try:
+			self.wait()
+			while not self.written_paths.isEmpty():
+				raf = RandomAccessFile(self.written_paths.poll(), "rw")
+				try:
+					raf.getFD().sync()
+				finally:
+					raf.close()
+		finally:
+			self.executor.shutdown()
+
+def group_files_by_well(filepaths):
+	"""
+	Groups files by well from their filenames, without opening any image.
+	:return: A dict of well -> list of (filepath, metadata) tuples.
+	"""
+	well_files = {}
 	for filepath in filepaths:
 		file_name = os.path.basename(filepath)
 		metadata = parse_filename(file_name)
 		if metadata is None:
-			print("Skipping file due to parsing error: ", filename)
+			print("Skipping file due to parsing error: ", file_name)
 			continue
-        
-		well = metadata['well']
+		well_files.setdefault(metadata['well'], []).append((filepath, metadata))
+	return well_files
+
+def get_time_stamp(well, plate_map):
+	if plate_map is not None:
+		# Condition and timing annotation from the plate map
+		return get_well_config(plate_map, well).get_time_stamp()
+	# Timestamp generation based on well letter
+	# well_letter = well[0]  # Assuming 'well' format starts with a letter
+	well_number = well[1] + well[2]  # Assuming 'well' format ends with a number
+	# Get the appropriate time string for the well_letter from the mapping
+	return time_map_SuperComp.get(well_number, "UnknownTiming")
+
+# Quick nucleoid metrics of the DNA (e.g. HU-mCherry) channel, measured on the processed site images while they are in memory.
+# The measurement is shared with the other preprocessing scripts in Nucleoid_Metrics.py.
+METRICS_COLUMNS = ["Well", "TimeStamp", "Site", "Threshold", "NucleoidCount", "NucleoidArea", "MeanNucleoidArea", "IntensityFraction", "ConcentrationIndex"]
+METRICS_NONE = "None"
+
+nucleoid_metrics = None # Nucleoid_Metrics module, loaded on first use
+
+def import_nucleoid_metrics():
+	"""
+	Loads Nucleoid_Metrics.py from the folder of this script, or imports it from the Fiji Jython library (Fiji.app/jars/Lib).
+	:raise ImportError: If the module is not found.
+	"""
+	global nucleoid_metrics
+	if nucleoid_metrics is None:
+		try:
+			path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Nucleoid_Metrics.py")
+		except NameError: # __file__ is not set by every way of running a script in Fiji
+			path = None
+		if path is not None and os.path.exists(path):
+			nucleoid_metrics = load_source("Nucleoid_Metrics", path)
+		else:
+			import Nucleoid_Metrics
+			nucleoid_metrics = Nucleoid_Metrics
+	return nucleoid_metrics
+
+def measure_nucleoids(imp):
+	"""Nucleoid metrics of a processed plane, see Nucleoid_Metrics.measure_nucleoids."""
+	return import_nucleoid_metrics().measure_nucleoids(imp)
+
+def save_metrics_table(metrics, table_path):
+	with open(table_path, "w") as f:
+		f.write(",".join(METRICS_COLUMNS) + "\n")
+		for row in metrics:
+			f.write("{},{},{},{:.0f},{},{:.3f},{:.3f},{:.4f},{:.4f}\n".format(*row))
+
+def get_metrics_input(channels_config):
+	"""
+	Asks whether quick nucleoid metrics are measured during preprocessing, and on which fluorescence channel.
+	:return: The (0-based) channel number, None if no metrics are measured, or False if canceled.
+	"""
+	fluorescence_channels = [config.channel_number for config in channels_config if config.channel_type == "Fluorescence"]
+	if not fluorescence_channels:
+		return None
+	channel_names = [METRICS_NONE] + ["Channel {}".format(channel + 1) for channel in fluorescence_channels]
+	gd_metrics = GenericDialog("Quick nucleoid metrics")
+	gd_metrics.addChoice("DNA channel for nucleoid metrics:", channel_names, METRICS_NONE)
+	gd_metrics.addMessage("Nucleoid count, area, intensity fraction and concentration index of every site\nare saved as <hyperstack>_Metrics.csv.")
+	gd_metrics.showDialog()
+
+	if gd_metrics.wasCanceled():
+		return False
+
+	choice_index = channel_names.index(gd_metrics.getNextChoice())
+	if choice_index == 0:
+		return None
+	try:
+		import_nucleoid_metrics()
+	except ImportError:
+		IJ.error("Quick nucleoid metrics", "Nucleoid_Metrics.py was not found. Place it next to this script or in Fiji.app/jars/Lib.\nNo nucleoid metrics are measured.")
+		return None
+	return fluorescence_channels[choice_index - 1]
+
+# Downsampled previews for quality control, made from the processed site images while they are in memory
+PREVIEW_SIZE = 256 # Longest side of a site tile in the preview of a well, in pixels
+PLATE_PREVIEW_SIZE = 96 # Longest side of a channel tile in the plate contact sheet, in pixels
+PREVIEW_SATURATED = 0.35 # Percentage of saturated pixels in the auto contrast of a preview tile
+PLATE_PREVIEW_FILENAME = "Plate_Preview.png"
+
+def make_thumbnail(ip, size=PREVIEW_SIZE):
+	"""Scales an image down to size pixels on its longest side and converts it to 8-bit with auto contrast."""
+	scale = float(size) / max(ip.getWidth(), ip.getHeight())
+	thumbnail = ip.resize(max(1, int(round(ip.getWidth() * scale))), max(1, int(round(ip.getHeight() * scale))), True)
+	ContrastEnhancer().stretchHistogram(thumbnail, PREVIEW_SATURATED)
+	return thumbnail.convertToByte(True)
+
+def make_montage(tiles, columns, labels=None):
+	"""Arranges 8-bit tiles row by row in a grid; None leaves a tile empty."""
+	tile_width = max(tile.getWidth() for tile in tiles if tile is not None)
+	tile_height = max(tile.getHeight() for tile in tiles if tile is not None)
+	rows = (len(tiles) + columns - 1) // columns
+	montage = ByteProcessor(columns * tile_width, rows * tile_height)
+	montage.setColor(Color.white)
+	for index, tile in enumerate(tiles):
+		x, y = (index % columns) * tile_width, (index // columns) * tile_height
+		if tile is not None:
+			montage.insert(tile, x, y)
+		if labels and labels[index]:
+			montage.drawString(labels[index], x + 2, y + 14)
+	return montage
+
+def save_png(ip, path):
+	FileSaver(ImagePlus(os.path.basename(path), ip)).saveAsPng(path)
+
+def save_plate_preview(plate_previews, output_dir):
+	"""
+	Saves a contact sheet of all processed wells in their plate layout, with the channels of the first site of every well side by side.
+	:param plate_previews: Dict of well -> montage of the channels of its first site.
+	"""
+	if not plate_previews:
+		return
+	positions = {}
+	for well in plate_previews:
+		try:
+			positions[well] = (ord(well[0].upper()) - ord('A'), int(well[1:]) - 1)
+		except (IndexError, ValueError):
+			print("Well {} is left out of the plate preview".format(well))
+	if not positions:
+		return
+	rows = max(row for row, column in positions.values()) + 1
+	columns = max(column for row, column in positions.values()) + 1
+	tiles = [None] * (rows * columns)
+	labels = [None] * (rows * columns)
+	for well, (row, column) in positions.items():
+		tiles[row * columns + column] = plate_previews[well]
+		labels[row * columns + column] = well
+	save_png(make_montage(tiles, columns, labels), os.path.join(output_dir, PLATE_PREVIEW_FILENAME))
+
+def process_well(well, files, channels_config, num_channels, output_dir, pixelWidth, pixelUnit, plate_map, writer=None, metrics_channel=None, plate_previews=None):
+	"""
+	Opens and processes all site images of one well and saves them as a hyperstack (sites as slices),
+	together with a preview of all sites and channels.
+	:param files: List of (filepath, metadata) tuples of the well.
+	:param writer: Optional TiffWriter saving the hyperstack in the background.
+	:param metrics_channel: Optional (0-based) channel on which quick nucleoid metrics are measured for every site.
+	:param plate_previews: Optional dict to which the well adds its tile of the plate contact sheet.
+	:return: Path of the saved hyperstack.
+	"""
+	sites = {}
+	metrics = []
+	time_stamp = get_time_stamp(well, plate_map)
+	image_date = files[0][1]['date']
+	for filepath, metadata in files:
 		site = metadata['site']
 		channel = metadata['channel']
-		image_date = metadata['date'] 
-        
-		if well not in sites:
-			sites[well] = {}
-		if site not in sites[well]:
-			sites[well][site] = [None]*num_channels
-        
+		if site not in sites:
+			sites[site] = [None]*num_channels
+
 		# Process images based on type and user preference
 		imp = IJ.openImage(filepath)
 		
@@ -272,36 +650,331 @@ def main():
 			elif channels_config[channel_idx].channel_type == "Fluorescence":
 				imp = process_fluorescence(imp)
 
-		sites[well][site][channel_idx] = imp  # Use the new index for placing the image
-    
-	# Create and save hyperstacks
-	for well, sites_channels in sites.items():
-		# Store images per channel
-		stacks_per_channel = [[] for _ in range(num_channels)]
+		if channel - 1 == metrics_channel:
+			imp = set_scale(imp, pixelWidth, pixelUnit)
+			metrics.append((well, time_stamp, site) + measure_nucleoids(imp))
 
-		for site, channels_images in sorted(sites_channels.items()):
-			for ch_idx, img in enumerate(channels_images):
-				if img is not None:
-					stacks_per_channel[ch_idx].append(img)
+		sites[site][channel_idx] = imp  # Use the new index for placing the image
 
-		# Combine images to stacks
-		combined_stacks = [ImagesToStack.run(stacks) for stacks in stacks_per_channel if stacks]
+	# Store images per channel
+	stacks_per_channel = [[] for _ in range(num_channels)]
 
-		# Merge channels into a hyperstack
-		hyperstack = merge_channels(*combined_stacks)
-		
-		# Set scale for each image
-		hyperstack = set_scale(hyperstack, pixelWidth, pixelUnit)  # Add this line before saving the image
-		
-		# Timestamp generation based on well letter
-		# well_letter = well[0]  # Assuming 'well' format starts with a letter
-		well_number = well[1] + well[2]  # Assuming 'well' format ends with a number
-		# Get the appropriate time string for the well_letter from the mapping
-		time_stamp = time_map_SuperComp.get(well_number, "UnknownTiming")
-
-		# Save the hyperstack
-		output_path = os.path.join(output_dir, "{}_{}_{}_Hyperstack.tif".format(image_date, well, time_stamp))
+	for site, channels_images in sorted(sites.items()):
+		for ch_idx, img in enumerate(channels_images):
+			if img is not None:
+				stacks_per_channel[ch_idx].append(img)
+
+	# Preview of the well with one row per channel and one column per site
+	site_names = sorted(sites)
+	tiles = [make_thumbnail(sites[site][ch_idx].getProcessor()) if sites[site][ch_idx] is not None else None for ch_idx in range(num_channels) for site in site_names]
+	labels = ["Site {}".format(site) if ch_idx == 0 else None for ch_idx in range(num_channels) for site in site_names]
+	first_site = [img for img in sites[site_names[0]] if img is not None]
+	if plate_previews is not None and first_site:
+		plate_previews[well] = make_montage([make_thumbnail(img.getProcessor(), PLATE_PREVIEW_SIZE) for img in first_site], len(first_site))
+
+	# Combine images to stacks
+	combined_stacks = [ImagesToStack.run(stacks) for stacks in stacks_per_channel if stacks]
+
+	# Merge channels into a hyperstack
+	hyperstack = merge_channels(*combined_stacks)
+	
+	# Set scale for each image
+	hyperstack = set_scale(hyperstack, pixelWidth, pixelUnit)  # Add this line before saving the image
+
+	# Save the hyperstack
+	output_path = os.path.join(output_dir, "{}_{}_{}_Hyperstack.tif".format(image_date, well, time_stamp))
+	if any(tile is not None for tile in tiles):
+		save_png(make_montage(tiles, len(site_names), labels), os.path.splitext(output_path)[0] + "_Preview.png")
+	if metrics:
+		save_metrics_table(sorted(metrics, key=lambda row: row[2]), os.path.splitext(output_path)[0] + "_Metrics.csv")
+	if writer is not None:
+		writer.submit(hyperstack, output_path)
+	else:
 		IJ.saveAsTiff(hyperstack, output_path)
+		hyperstack.close()
+	return output_path
+
+class FileWatcher:
+	"""
+	Tracks the files of an acquisition folder between polls. A file is complete when its size and
+	modification time have not changed for stable_polls polls and it is not locked for writing.
+	"""
+	def __init__(self, watch_dir, extensions, titlePattern, stable_polls):
+		self.watch_dir = watch_dir
+		self.extensions = tuple(extensions)
+		self.titlePattern = titlePattern
+		self.stable_polls = stable_polls
+		self.history = {} # path -> (size, modification time, number of unchanged polls)
+
+	def poll(self, exclude_paths):
+		"""Returns the paths that have become complete since they were first seen, except exclude_paths."""
+		complete_paths = []
+		for filename in sorted(os.listdir(self.watch_dir)):
+			path = os.path.join(self.watch_dir, filename)
+			if not filename.endswith(self.extensions) or self.titlePattern not in filename or "_thumb" in filename.lower():
+				continue
+			if path in exclude_paths or not os.path.isfile(path):
+				continue
+			try:
+				size, mtime = os.path.getsize(path), os.path.getmtime(path)
+			except os.error:
+				continue # File was moved or deleted since the listing
+			previous = self.history.get(path)
+			if previous is not None and previous[0] == size and previous[1] == mtime:
+				unchanged = previous[2] + 1
+			else:
+				unchanged = 0
+			self.history[path] = (size, mtime, unchanged)
+			if unchanged >= self.stable_polls and size > 0 and is_file_unlocked(path):
+				complete_paths.append(path)
+		return complete_paths
+
+def is_file_unlocked(path):
+	"""Checks that no other program (e.g. the acquisition software) holds a lock on the file."""
+	try:
+		raf = RandomAccessFile(path, "rw")
+	except IOException:
+		return False
+	try:
+		lock = raf.getChannel().tryLock()
+		if lock is None:
+			return False
+		lock.release()
+		return True
+	except IOException:
+		return False
+	finally:
+		raf.close()
+
+RUN_CONFIG_FILENAME = "ImageXpress_preprocessing_config.json"
+TIFF_EXTENSIONS = [".tif", ".TIF", ".tiff", ".TIFF"]
+
+def save_run_configuration(config_path, channels_config, num_channels, output_dir, plate_map_path, metrics_channel=None):
+	"""Saves the run configuration as JSON, so a watched acquisition folder can be processed with it later."""
+	run_config = {
+		"channels": [config.__dict__ for config in channels_config],
+		"num_channels": num_channels,
+		"output_dir": output_dir,
+		"plate_map": plate_map_path,
+		"metrics_channel": metrics_channel
+	}
+	with open(config_path, "w") as f:
+		json.dump(run_config, f, indent=2)
+
+def load_run_configuration(config_path):
+	"""
+	Loads a run configuration saved by save_run_configuration.
+	:return: A tuple (channels_config, num_channels, output_dir, plate_map_path, metrics_channel), or None if invalid.
+	"""
+	try:
+		with open(config_path, "r") as f:
+			run_config = json.load(f)
+		channels_config = [ChannelConfig(config["channel_type"], config["channel_number"], config["do_processing"]) for config in run_config["channels"]]
+		# Configurations saved before nucleoid metrics were added have no "metrics_channel" entry
+		return channels_config, run_config["num_channels"], run_config["output_dir"], run_config["plate_map"], run_config.get("metrics_channel")
+	except (IOError, ValueError, KeyError, TypeError) as e:
+		print("Could not load run configuration {}: {}".format(config_path, e))
+		return None
+
+def watch_directory(watch_dir, titlePattern, expected_sites, channels_config, num_channels, output_dir, pixelWidth, pixelUnit, plate_map, poll_seconds, stable_polls, idle_minutes, metrics_channel=None):
+	"""
+	Watches an acquisition folder and preprocesses each well as soon as all its site images
+	(expected_sites x num_channels files) have been completely written by the microscope.
+	Processed files are recorded in a log in the folder, so watching can be stopped and resumed.
+	Stops when no new file has appeared for idle_minutes, or when Esc is pressed.
+	"""
+	log_path = os.path.join(watch_dir, "ImageXpress_preprocessed_files.txt")
+	processed_paths = set()
+	if os.path.exists(log_path):
+		with open(log_path, "r") as f:
+			processed_paths = set(line.strip() for line in f if line.strip())
+	watcher = FileWatcher(watch_dir, TIFF_EXTENSIONS, titlePattern, stable_polls)
+	complete_files = {} # well -> list of (filepath, metadata) of complete files
+	reported_wells = set()
+	files_per_well = expected_sites * num_channels
+	last_activity = time.time()
+	writer = TiffWriter()
+	plate_previews = {}
+	IJ.resetEscape()
+	print("Watching {} (press Esc to stop)".format(watch_dir))
+	while not IJ.escapePressed():
+		done_paths = []
+		for well, files in group_files_by_well(watcher.poll(processed_paths)).items():
+			last_activity = time.time()
+			well_config = get_well_config(plate_map, well) if plate_map is not None else None
+			if plate_map is not None and (well_config is None or not well_config.include):
+				# Excluded or unknown wells are never opened
+				if well not in reported_wells:
+					print("Skipping well {}: {}".format(well, "missing from plate map" if well_config is None else "excluded in plate map"))
+					reported_wells.add(well)
+				done_paths.extend(filepath for filepath, metadata in files)
+				continue
+			well_files = complete_files.setdefault(well, [])
+			well_files.extend(files)
+			processed_paths.update(filepath for filepath, metadata in files) # Not polled again while waiting for the rest of the well
+			if len(well_files) >= files_per_well:
+				output_path = process_well(well, sorted(well_files), channels_config, num_channels, output_dir, pixelWidth, pixelUnit, plate_map, writer, metrics_channel, plate_previews)
+				print("Saving well {}: {}".format(well, output_path))
+				done_paths.extend(filepath for filepath, metadata in well_files)
+				del complete_files[well]
+		if done_paths:
+			writer.wait() # Files are only logged once their well has been written
+			processed_paths.update(done_paths)
+			with open(log_path, "a") as f:
+				for filepath in done_paths:
+					f.write(filepath + "\n")
+		if any(entry[2] == 0 for entry in watcher.history.values()):
+			last_activity = time.time() # A file is still being written
+		if time.time() - last_activity > idle_minutes * 60:
+			print("No new files for {} minutes, stopped watching.".format(idle_minutes))
+			break
+		IJ.showStatus("Watching {}: {} well(s) waiting for images".format(watch_dir, len(complete_files)))
+		time.sleep(poll_seconds)
+	writer.finish()
+	save_plate_preview(plate_previews, output_dir)
+	for well, well_files in sorted(complete_files.items()):
+		print("Well {} incomplete: {} of {} images".format(well, len(well_files), files_per_well))
+	print("Watch mode ended.")
+
+def get_watch_input():
+	"""
+	Asks for the acquisition folder and polling settings of watch mode.
+	:return: A tuple (watch_dir, titlePattern, expected_sites, poll_seconds, stable_polls, idle_minutes), or None if canceled.
+	"""
+	gd_watch = GenericDialog("Watch acquisition folder")
+	gd_watch.addDirectoryField("Acquisition folder:", "E:/ImageXpress microscope")
+	gd_watch.addStringField("Filter text:", "_") # Only filenames containing this text are processed
+	gd_watch.addNumericField("Sites per well:", 4, 0)
+	gd_watch.addNumericField("Poll interval (s):", 10, 0)
+	gd_watch.addNumericField("Unchanged polls before a file is complete:", 3, 0)
+	gd_watch.addNumericField("Stop after idle time (min):", 60, 0)
+	gd_watch.showDialog()
+	if gd_watch.wasCanceled():
+		return None
+	watch_dir = gd_watch.getNextString().strip()
+	if not os.path.isdir(watch_dir):
+		IJ.error("Folder not found: {}".format(watch_dir))
+		return None
+	titlePattern = gd_watch.getNextString()
+	expected_sites = max(1, int(gd_watch.getNextNumber()))
+	poll_seconds = max(1, int(gd_watch.getNextNumber()))
+	stable_polls = max(1, int(gd_watch.getNextNumber()))
+	idle_minutes = max(1, gd_watch.getNextNumber())
+	return watch_dir, titlePattern, expected_sites, poll_seconds, stable_polls, idle_minutes
+
+RUN_MODE_PROCESS = "Process selected files"
+RUN_MODE_WATCH = "Watch acquisition folder"
+
+def main():
+	gd_mode = GenericDialog("Run mode")
+	gd_mode.addChoice("Mode:", [RUN_MODE_PROCESS, RUN_MODE_WATCH], RUN_MODE_PROCESS)
+	gd_mode.addMessage("Watch mode processes each well in an acquisition folder as soon as\nthe microscope has finished writing all its site images.")
+	gd_mode.showDialog()
+	if gd_mode.wasCanceled():
+		return
+
+	# Set scaling values
+	pixelWidth = 0.115
+	pixelUnit = u"µm"
+
+	if gd_mode.getNextChoice() == RUN_MODE_WATCH:
+		watch_input = get_watch_input()
+		if watch_input is None:
+			return
+		watch_dir, titlePattern, expected_sites, poll_seconds, stable_polls, idle_minutes = watch_input
+
+		# Reuse the configuration saved in the folder, so watching can be restarted without dialogs
+		config_path = os.path.join(watch_dir, RUN_CONFIG_FILENAME)
+		run_config = None
+		if os.path.exists(config_path):
+			gd_config = GenericDialog("Saved configuration")
+			gd_config.addMessage("Use the configuration saved in the acquisition folder?\n" + config_path)
+			gd_config.enableYesNoCancel()
+			gd_config.showDialog()
+			if gd_config.wasCanceled():
+				return
+			elif gd_config.wasOKed():
+				run_config = load_run_configuration(config_path)
+				if run_config is None:
+					IJ.error("Could not load saved configuration: {}".format(config_path))
+					return
+		if run_config is None:
+			plate_map_path = get_plate_map_input()
+			if plate_map_path is None:
+				return
+			user_input = get_user_input()
+			if user_input is None:
+				print("User input canceled or invalid.")
+				return
+			channels_config, image_format, num_channels = user_input
+			metrics_channel = get_metrics_input(channels_config)
+			if metrics_channel is False:
+				return
+			output_dir = DirectoryChooser("Choose Output Directory").getDirectory()
+			if output_dir is None:
+				return
+			run_config = (channels_config, num_channels, output_dir, plate_map_path, metrics_channel)
+			save_run_configuration(config_path, *run_config)
+		channels_config, num_channels, output_dir, plate_map_path, metrics_channel = run_config
+
+		# Validate the plate map before watching starts
+		plate_map = None
+		if plate_map_path:
+			plate_map, errors = load_plate_map(plate_map_path)
+			if errors:
+				IJ.error("Invalid plate map", "\n".join(errors))
+				return
+
+		watch_directory(watch_dir, titlePattern, expected_sites, channels_config, num_channels, output_dir, pixelWidth, pixelUnit, plate_map, poll_seconds, stable_polls, idle_minutes, metrics_channel)
+		return
+
+	filepaths = select_files()
+	if not filepaths:
+		IJ.error("No files were selected!")
+		return
+
+	# Load the plate map and validate it against the selected files before any image is opened
+	plate_map_path = get_plate_map_input()
+	if plate_map_path is None:
+		return
+	plate_map = None
+	if plate_map_path:
+		plate_map, errors = load_plate_map(plate_map_path)
+		if not errors:
+			filepaths, skipped_wells, errors = select_wells_from_plate_map(filepaths, plate_map)
+		if errors:
+			IJ.error("Invalid plate map", "\n".join(errors))
+			return
+		if skipped_wells:
+			print("Skipping wells excluded in plate map: {}".format(", ".join(skipped_wells)))
+		if not filepaths:
+			IJ.error("No selected files belong to wells included in the plate map!")
+			return
+    
+	# Get user input considering modifications for the brightfield channel
+	user_input = get_user_input()
+	if user_input is None:  # Stop the script if the user input is invalid
+		print("User input canceled or invalid.")
+		return
+	channels_config, image_format, num_channels = user_input
+
+	metrics_channel = get_metrics_input(channels_config)
+	if metrics_channel is False:
+		return
+
+	# Define output location
+	dc = DirectoryChooser("Choose Output Directory")
+	output_dir = dc.getDirectory()
+
+	# Process each well and save it as a hyperstack, writing the previous well while the next one is processed
+	writer = TiffWriter()
+	plate_previews = {}
+	try:
+		for well, files in sorted(group_files_by_well(filepaths).items()):
+			process_well(well, files, channels_config, num_channels, output_dir, pixelWidth, pixelUnit, plate_map, writer, metrics_channel, plate_previews)
+	finally:
+		writer.finish()
+	save_plate_preview(plate_previews, output_dir)
 		
 	print(u"Images were scaled: 1 pixel = {} µm.".format(pixelWidth))
 	print("Processing completed.")
@@ -1,21 +1,31 @@
-from ij.plugin import ChannelSplitter, RGBStackMerge, ImageCalculator, ImagesToStack, Duplicator, ZProjector, HyperStackConverter
-from ij.plugin.filter import BackgroundSubtracter
+from ij.plugin import ChannelSplitter, RGBStackMerge, ImageCalculator, ImagesToStack, Duplicator, ZProjector, HyperStackConverter, ContrastEnhancer
+from ij.plugin.filter import BackgroundSubtracter, GaussianBlur
 from ij.plugin.frame import RoiManager
 from ij import IJ, ImagePlus, ImageStack, WindowManager, VirtualStack
-from ij.process import ImageConverter, FloatProcessor
+from ij.process import ImageConverter, FloatProcessor, ByteProcessor, ImageProcessor, Blitter, FHT
 from ij.measure import Calibration
 from ij.gui import GenericDialog
 from ij.io import FileSaver, FileInfo
 from javax.swing import JFileChooser, JFrame
-from java.io import File
+from java.awt import Color
+from java.io import File, RandomAccessFile, IOException
 from javax.swing.filechooser import FileFilter
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions, ImagePlusReader, ImportProcess
-from loci.plugins.util import BFVirtualStack
-from loci.formats import ChannelSeparator
+from loci.plugins.util import BFVirtualStack, ImageProcessorReader, LociPrefs
+from loci.formats import ChannelSeparator, MetadataTools, ImageReader, FormatTools
 from loci.formats.in import ND2Reader
+from java.lang import Float, Runtime, Runnable, Throwable
+from java.util.concurrent import Executors, Semaphore, ConcurrentLinkedQueue
+from java.lang.management import ManagementFactory
+from imp import load_source
 import os
+import math
+import jarray
 import uuid
+import time
+import json
+import hashlib
 
 class ChannelConfig:
 	def __init__(self, channel_type, channel_number, do_processing):
@@ -29,6 +39,24 @@ class FlatFieldConfig:
 		self.channel_number = channel_number
 		self.do_fluoFlatField = do_fluoFlatField
 
+class RegistrationConfig:
+	def __init__(self, reference_channel):
+		self.reference_channel = reference_channel
+
+class MetricsConfig:
+	def __init__(self, channel_number):
+		self.channel_number = channel_number
+
+class StageTimer:
+	"""Accumulates wall time and processed megapixels for each stage of the pipeline."""
+	def __init__(self):
+		self.seconds = {}
+		self.megapixels = {}
+
+	def add(self, stage, start_time, megapixels):
+		self.seconds[stage] = self.seconds.get(stage, 0.0) + (time.time() - start_time)
+		self.megapixels[stage] = self.megapixels.get(stage, 0.0) + megapixels
+
 class CustomFileFilter(FileFilter):
 	def __init__(self, _description, extensions):
 		self._description = _description
@@ -128,6 +156,39 @@ def open_other_images_by_location(filepath, virtual=False):
 
 	return imps
 
+# Flat field images are opened once per run and kept as (FloatProcessor, mean intensity), instead of being opened for every frame
+flatfield_cache = {}
+
+def get_flatfield(flatFieldPath):
+	"""
+	Returns the flat field image as FloatProcessor and its mean intensity, opening it only the first time.
+	A flat field image that is replaced on disk (e.g. rebuilt) is opened again.
+	:return: A tuple (FloatProcessor, mean intensity), or None if the image cannot be opened.
+	"""
+	try:
+		cache_key = (flatFieldPath, os.path.getmtime(flatFieldPath), os.path.getsize(flatFieldPath))
+	except os.error:
+		return None
+	if cache_key not in flatfield_cache:
+		flat_imp = IJ.openImage(flatFieldPath)
+		if flat_imp is None:
+			return None
+		flat_ip = flat_imp.getProcessor()
+		flatfield_cache[cache_key] = (flat_ip if isinstance(flat_ip, FloatProcessor) else flat_ip.convertToFloatProcessor(), flat_imp.getStatistics().mean)
+	return flatfield_cache[cache_key]
+
+def correct_flatfield(ip, flatfield):
+	"""
+	Divides a plane by the flat field and multiplies it by the mean of the flat field, in 32-bit as the division is not integer.
+	The result is the same as with the Image Calculator, without a copy of the frame or a new image.
+	:return: The corrected plane as a new FloatProcessor.
+	"""
+	flat_ip, mean_flat_intensity = flatfield
+	corrected_ip = ip.duplicate() if isinstance(ip, FloatProcessor) else ip.convertToFloatProcessor()
+	corrected_ip.copyBits(flat_ip, 0, 0, Blitter.DIVIDE)
+	corrected_ip.multiply(mean_flat_intensity)
+	return corrected_ip
+
 # Function to process brightfield image as described
 def process_brightfield(frame_imp, flatfield_configs, channel_No, applyGaussian, gaussRadius):
 	# Find the FlatFieldConfig for the given channel number (assuming channel_No starts at 0)
@@ -138,39 +199,19 @@ def process_brightfield(frame_imp, flatfield_configs, channel_No, applyGaussian,
 		return None
 	
 	# Open the flat field image
-	flat_imp = IJ.openImage(flat_field_config.flatFieldPath)
-	if flat_imp is None:
-		print("Could not open flat field image for channel {} from: {}".format(channel_No + 1, flat_field_image_path))
-		return None
-
-	# Calculate the mean intensity of the flat field image	
-	mean_flat_intensity = flat_imp.getStatistics().mean
-
-	# Perform flat field correction on original image
-	imp = frame_imp.duplicate() # Duplicate to preserve the original image
-	imp.setProcessor(imp.getProcessor().convertToFloatProcessor()) # Convert to FloatProcessor
-
-	ic = ImageCalculator()
-	ffcorrected_imp =  ic.run("Divide create", imp, flat_imp)
-	
-	# Check if division was successful
-	if ffcorrected_imp is None:
-		print("Error during division operation.")
+	flatfield = get_flatfield(flat_field_config.flatFieldPath)
+	if flatfield is None:
+		print("Could not open flat field image for channel {} from: {}".format(channel_No + 1, flat_field_config.flatFieldPath))
 		return None
 
-	# Scale pixel intensity values to match original image    
-	ip = ffcorrected_imp.getProcessor()
-	ip.multiply(mean_flat_intensity)
+	# Perform flat field correction and scale pixel intensity values to match original image
+	ip = correct_flatfield(frame_imp.getProcessor(), flatfield)
 
 	# After scaling, ensure pixel values are still within the 0-4095 range
 	standard_min =  0  # Minimum brightness
 	standard_max = 4095  # Maximum brightness for 12-bit range image
 	ip.setMinAndMax(standard_min, standard_max)  # Set the display range to 12-bit
 
-	# Update the image and calibration
-	ffcorrected_imp.setProcessor(ip)
-	ffcorrected_imp.updateAndDraw()
-
 	# Convert to 16-bit while maintaining the 12-bit range
 	new_ip = ip.convertToShortProcessor()
 
@@ -178,9 +219,6 @@ def process_brightfield(frame_imp, flatfield_configs, channel_No, applyGaussian,
 	processed_frame = ImagePlus("Processed Frame", new_ip)
 	processed_frame.setCalibration(frame_imp.getCalibration().copy())
 
-	# Release resources associated with the flat field image
-	flat_imp.flush()
-
 	# Optionally apply Gaussian Blur
 	if applyGaussian:
 		IJ.run(processed_frame, "Gaussian Blur...", "sigma={}".format(gaussRadius))
@@ -198,41 +236,22 @@ def process_fluorescence(frame_imp, flatfield_configs, channel_No, pixelWidth):
 	
 	if flat_field_config.do_fluoFlatField:
 		# Open the flat field image
-		flat_imp = IJ.openImage(flat_field_config.flatFieldPath)
-		if flat_imp is None:
-			print("Could not open flat field image for channel {} from: {}".format(channel_No + 1, flat_field_image_path))
+		flatfield = get_flatfield(flat_field_config.flatFieldPath)
+		if flatfield is None:
+			print("Could not open flat field image for channel {} from: {}".format(channel_No + 1, flat_field_config.flatFieldPath))
 			return None
 
-		# Calculate the mean intensity of the flat field image
-		mean_flat_intensity = flat_imp.getStatistics().mean
-
 		# Save the current LUT before any conversion
 		original_LUT = frame_imp.getProcessor().getLut()
 
-		# Perform flat field correction on original image
-		imp = frame_imp.duplicate() # Duplicate to preserve the original image
-		imp.setProcessor(imp.getProcessor().convertToFloatProcessor()) # Convert to FloatProcessor
-
-		ic = ImageCalculator()
-		ffcorrected_imp =  ic.run("Divide create", imp, flat_imp)
-
-		if ffcorrected_imp is None:
-			print("Error during division operation.")
-			return None
-
-		# Scale pixel intensity values to match original image    
-		ip = ffcorrected_imp.getProcessor()
-		ip.multiply(mean_flat_intensity)
+		# Perform flat field correction and scale pixel intensity values to match original image
+		ip = correct_flatfield(frame_imp.getProcessor(), flatfield)
 
 		# After scaling, ensure pixel values are still within the 0-4095 range
 		standard_min =  0  # Minimum brightness
 		standard_max = 4095  # Maximum brightness for 12-bit range image
 		ip.setMinAndMax(standard_min, standard_max)  # Set the display range to 12-bit
 
-		# Update the image and calibration
-		ffcorrected_imp.setProcessor(ip)
-		ffcorrected_imp.updateAndDraw()
-
 		# Convert to 16-bit while maintaining the 12-bit range
 		new_ip = ip.convertToShortProcessor()
 
@@ -240,9 +259,6 @@ def process_fluorescence(frame_imp, flatfield_configs, channel_No, pixelWidth):
 		processed_frame = ImagePlus("Processed Frame", new_ip)
 		processed_frame.setCalibration(frame_imp.getCalibration().copy())
 
-		# Release resources associated with the flat field image
-		flat_imp.flush()
-
 		# Restore the original LUT to the corrected image
 		processed_frame.getProcessor().setLut(original_LUT)
 		processed_frame.updateAndDraw()
@@ -267,6 +283,83 @@ def set_scale(imp, pixel_Width, pixel_Unit):
 	imp.setCalibration(cal)
 	return imp
 
+# Background writing of output TIFFs, so the next image is processed while the previous one is written.
+# Raise the queue depth on slow (e.g. network) storage if memory allows; each queued image stays in memory until written.
+WRITER_QUEUE_DEPTH = 4 # Maximum number of images waiting to be written before processing blocks
+WRITER_THREADS = 2 # Number of images written at the same time
+
+class TiffWriteTask(Runnable):
+	def __init__(self, writer, imp, path, close, sync):
+		self.writer = writer
+		self.imp = imp
+		self.path = path
+		self.close = close
+		self.sync = sync
+
+	def run(self):
+		try:
+			self.writer.write_file(self.imp, self.path)
+			if self.sync:
+				self.writer.written_paths.add(self.path)
+		except (Exception, Throwable) as e:
+			if self.writer.error is None:
+				self.writer.error = "Could not write {}: {}".format(self.path, e)
+		finally:
+			if self.close:
+				self.imp.close()
+			self.writer.slots.release()
+
+class TiffWriter:
+	"""
+	Bounded queue of background writer threads for TIFF files. submit() blocks while queue_depth
+	images are waiting (back-pressure). A failed write is raised as IOError by the next submit(),
+	wait() or finish(). finish() waits for all writes and syncs the written files to disk.
+	"""
+	def __init__(self, queue_depth=WRITER_QUEUE_DEPTH, writer_threads=WRITER_THREADS):
+		self.executor = Executors.newFixedThreadPool(max(1, writer_threads))
+		self.slots = Semaphore(max(1, queue_depth))
+		self.pending = []
+		self.written_paths = ConcurrentLinkedQueue()
+		self.error = None
+
+	def write_file(self, imp, path):
+		if not FileSaver(imp).saveAsTiff(path):
+			raise IOError("FileSaver failed")
+
+	def check(self):
+		if self.error is not None:
+			raise IOError(self.error)
+
+	def submit(self, imp, path, close=True, sync=True):
+		"""
+		Queues imp to be saved as path. The image must not be changed afterwards and is closed once written if close is True.
+		Files with sync set to False (e.g. temporary files) are not synced to disk by finish().
+		"""
+		self.check()
+		self.slots.acquire()
+		self.pending = [future for future in self.pending if not future.isDone()]
+		self.pending.append(self.executor.submit(TiffWriteTask(self, imp, path, close, sync)))
+
+	def wait(self):
+		"""Waits until all queued images are written."""
+		for future in self.pending:
+			future.get()
+		self.pending = []
+		self.check()
+
+	def finish(self):
+		"""Waits for all writes, syncs the written files to disk and stops the writer threads."""
+		try:
+			self.wait()
+			while not self.written_paths.isEmpty():
+				raf = RandomAccessFile(self.written_paths.poll(), "rw")
+				try:
+					raf.getFD().sync()
+				finally:
+					raf.close()
+		finally:
+			self.executor.shutdown()
+
 def open_image(filepath, largefile):
 	# Check if the file is an .nd2 file by the file extension
 	if filepath.endswith(".nd2"):
@@ -280,7 +373,202 @@ def open_image(filepath, largefile):
 
 	return imps
 
-def process_image(imp, channels_configs, flatfield_configs, applyGaussian, gaussRadius, temp_dir_path, location_index):
+# Stage drift registration: the translation of every frame relative to the first frame is estimated by phase correlation
+# of the reference channel, first on the whole plane scaled down to REGISTRATION_SIZE, then on a full-resolution crop
+# of half that size around the center. Frames are shifted by whole pixels, so intensities are not interpolated.
+REGISTRATION_SIZE = 256 # Side (power of 2) of the scaled-down planes used for phase correlation
+REGISTRATION_DAMPING = 1.0 # Added to the cross-power magnitude (relative to its RMS), so frequencies dominated by noise are damped
+REGISTRATION_REFERENCE_INTERVAL = 20 # Frames registered to the same reference frame before the current frame becomes the reference
+
+def get_hann_window(size):
+	hann = [0.5 - 0.5 * math.cos(2 * math.pi * i / size) for i in range(size)]
+	return [wy * wx for wy in hann for wx in hann]
+
+def get_windowed_fht(ip, window, size):
+	"""Hartley transform of a size x size plane after subtracting the mean and applying a Hann window."""
+	pixels = ip.convertToFloatProcessor().getPixels()
+	mean = sum(pixels) / len(pixels)
+	fht = FHT(FloatProcessor(size, size, jarray.array([(value - mean) * weight for value, weight in zip(pixels, window)], "f"), None))
+	fht.transform()
+	return fht
+
+def get_peak_offset(values, index, size, step):
+	"""Subpixel offset of a maximum from a parabola through the maximum and its two (wrapped) neighbors."""
+	position = (index // step) % size
+	before = values[index - step * position + step * ((position - 1) % size)]
+	after = values[index - step * position + step * ((position + 1) % size)]
+	denominator = before - 2 * values[index] + after
+	return 0.5 * (before - after) / denominator if denominator < 0 else 0.0
+
+def phase_correlation(fht, reference_fht, size):
+	"""
+	Translation of a plane relative to a reference plane from the normalized cross-power spectrum of their Hartley transforms.
+	:return: A tuple (dx, dy) in pixels of the planes, with subpixel accuracy.
+	"""
+	h1 = fht.getPixels()
+	h2 = reference_fht.getPixels()
+	# Frequencies without signal are damped instead of amplified to the level of the others
+	epsilon = REGISTRATION_DAMPING * math.sqrt(sum(value * value for value in h1) * sum(value * value for value in h2)) / (size * size)
+	product = jarray.zeros(size * size, "f")
+	for row in range(size):
+		mirror_row = ((size - row) % size) * size
+		offset = row * size
+		for column in range(size):
+			index = offset + column
+			mirror = mirror_row + (size - column) % size
+			even1, odd1 = (h1[index] + h1[mirror]) * 0.5, (h1[index] - h1[mirror]) * 0.5
+			even2, odd2 = (h2[index] + h2[mirror]) * 0.5, (h2[index] - h2[mirror]) * 0.5
+			magnitude = math.sqrt((even1 * even1 + odd1 * odd1) * (even2 * even2 + odd2 * odd2)) + epsilon
+			if magnitude > 0:
+				product[index] = (even1 * even2 + odd1 * odd2 - even1 * odd2 + odd1 * even2) / magnitude
+	correlation = FHT(FloatProcessor(size, size, product, None), True)
+	correlation.inverseTransform()
+	values = correlation.getPixels()
+	peak = max(xrange(size * size), key=values.__getitem__)
+	dy, dx = peak // size, peak % size
+	dx = (dx - size if dx > size // 2 else dx) + get_peak_offset(values, peak, size, 1)
+	dy = (dy - size if dy > size // 2 else dy) + get_peak_offset(values, peak, size, size)
+	return dx, dy
+
+class DriftCorrector:
+	"""
+	Estimates the drift of the frames of one location on the reference channel, in frame order, and shifts
+	the processed planes of all channels back by whole pixels.
+	"""
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.size = 2
+		while self.size * 2 <= min(REGISTRATION_SIZE, width, height):
+			self.size *= 2
+		self.crop_size = max(2, self.size // 2)
+		self.window = get_hann_window(self.size)
+		self.crop_window = get_hann_window(self.crop_size)
+		self.crop_x = (width - self.crop_size) // 2
+		self.crop_y = (height - self.crop_size) // 2
+		self.reference = None
+		self.shifts = [] # (frame, drift x, drift y, applied shift x, applied shift y) per frame
+
+	def get_crop(self, ip, x, y):
+		ip.setRoi(x, y, self.crop_size, self.crop_size)
+		crop = ip.crop()
+		ip.resetRoi()
+		return crop
+
+	def estimate(self, ip, frame_no):
+		"""Drift (x, y) of a frame relative to the first frame, in pixels."""
+		scaled_fht = get_windowed_fht(ip.resize(self.size, self.size, True), self.window, self.size)
+		if self.reference is None:
+			self.reference = (scaled_fht, get_windowed_fht(self.get_crop(ip, self.crop_x, self.crop_y), self.crop_window, self.crop_size), 0.0, 0.0, frame_no)
+			return 0.0, 0.0
+		reference_scaled, reference_crop, reference_x, reference_y, reference_frame = self.reference
+		coarse_x, coarse_y = phase_correlation(scaled_fht, reference_scaled, self.size)
+		# Refine on the full-resolution crop displaced by the coarse estimate
+		x = min(max(self.crop_x + int(round(coarse_x * self.width / float(self.size))), 0), self.width - self.crop_size)
+		y = min(max(self.crop_y + int(round(coarse_y * self.height / float(self.size))), 0), self.height - self.crop_size)
+		fine_x, fine_y = phase_correlation(get_windowed_fht(self.get_crop(ip, x, y), self.crop_window, self.crop_size), reference_crop, self.crop_size)
+		drift_x = reference_x + x - self.crop_x + fine_x
+		drift_y = reference_y + y - self.crop_y + fine_y
+		if frame_no - reference_frame >= REGISTRATION_REFERENCE_INTERVAL:
+			self.reference = (scaled_fht, get_windowed_fht(self.get_crop(ip, self.crop_x, self.crop_y), self.crop_window, self.crop_size), drift_x, drift_y, frame_no)
+		return drift_x, drift_y
+
+	def add_frame(self, ip, frame_no):
+		drift_x, drift_y = self.estimate(ip, frame_no)
+		self.shifts.append((frame_no, drift_x, drift_y, -int(round(drift_x)), -int(round(drift_y))))
+
+	def correct(self, ip):
+		"""Shifts a plane of the current frame back by the drift; uncovered pixels are 0."""
+		shift_x, shift_y = self.shifts[-1][3:]
+		if shift_x != 0 or shift_y != 0:
+			ip.translate(shift_x, shift_y)
+
+def save_drift_table(shifts, table_path):
+	with open(table_path, "w") as f:
+		f.write("Frame,DriftX,DriftY,ShiftX,ShiftY\n")
+		for frame_no, drift_x, drift_y, shift_x, shift_y in shifts:
+			f.write("{},{:.2f},{:.2f},{},{}\n".format(frame_no, drift_x, drift_y, shift_x, shift_y))
+
+# Quick nucleoid metrics of the DNA (e.g. HU-mCherry) channel, measured on the processed planes while they are in memory.
+# The measurement is shared with the other preprocessing scripts in Nucleoid_Metrics.py.
+METRICS_COLUMNS = ["Frame", "Threshold", "NucleoidCount", "NucleoidArea", "MeanNucleoidArea", "IntensityFraction", "ConcentrationIndex"]
+
+nucleoid_metrics = None # Nucleoid_Metrics module, loaded on first use
+
+def import_nucleoid_metrics():
+	"""
+	Loads Nucleoid_Metrics.py from the folder of this script, or imports it from the Fiji Jython library (Fiji.app/jars/Lib).
+	:raise ImportError: If the module is not found.
+	"""
+	global nucleoid_metrics
+	if nucleoid_metrics is None:
+		try:
+			path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Nucleoid_Metrics.py")
+		except NameError: # __file__ is not set by every way of running a script in Fiji
+			path = None
+		if path is not None and os.path.exists(path):
+			nucleoid_metrics = load_source("Nucleoid_Metrics", path)
+		else:
+			import Nucleoid_Metrics
+			nucleoid_metrics = Nucleoid_Metrics
+	return nucleoid_metrics
+
+def measure_nucleoids(imp):
+	"""Nucleoid metrics of a processed plane, see Nucleoid_Metrics.measure_nucleoids."""
+	return import_nucleoid_metrics().measure_nucleoids(imp)
+
+def save_metrics_table(metrics, table_path):
+	with open(table_path, "w") as f:
+		f.write(",".join(METRICS_COLUMNS) + "\n")
+		for row in metrics:
+			f.write("{},{:.0f},{},{:.3f},{:.3f},{:.4f},{:.4f}\n".format(*row))
+
+# Downsampled previews for quality control, made from the processed planes while they are in memory
+PREVIEW_SIZE = 256 # Longest side of a preview tile in pixels
+PREVIEW_SATURATED = 0.35 # Percentage of saturated pixels in the auto contrast of a preview tile
+
+def make_thumbnail(ip, size=PREVIEW_SIZE):
+	"""Scales a plane down to size pixels on its longest side and converts it to 8-bit with auto contrast."""
+	scale = float(size) / max(ip.getWidth(), ip.getHeight())
+	thumbnail = ip.resize(max(1, int(round(ip.getWidth() * scale))), max(1, int(round(ip.getHeight() * scale))), True)
+	ContrastEnhancer().stretchHistogram(thumbnail, PREVIEW_SATURATED)
+	return thumbnail.convertToByte(True)
+
+def make_montage(tiles, columns, labels=None):
+	"""Arranges 8-bit tiles row by row in a grid; None leaves a tile empty."""
+	tile_width = max(tile.getWidth() for tile in tiles if tile is not None)
+	tile_height = max(tile.getHeight() for tile in tiles if tile is not None)
+	rows = (len(tiles) + columns - 1) // columns
+	montage = ByteProcessor(columns * tile_width, rows * tile_height)
+	montage.setColor(Color.white)
+	for index, tile in enumerate(tiles):
+		x, y = (index % columns) * tile_width, (index // columns) * tile_height
+		if tile is not None:
+			montage.insert(tile, x, y)
+		if labels and labels[index]:
+			montage.drawString(labels[index], x + 2, y + 14)
+	return montage
+
+def get_preview_frames(total_time_frames):
+	"""First, middle and last frame."""
+	return sorted(set([1, (total_time_frames + 1) // 2, total_time_frames]))
+
+def save_preview(previews, nChannels, preview_path):
+	"""Saves the preview tiles of a location as a PNG montage with one row per preview frame and one column per channel."""
+	preview_frames = sorted(set(frame_no for frame_no, channel_index in previews))
+	tiles = [previews.get((frame_no, channel_index)) for frame_no in preview_frames for channel_index in range(nChannels)]
+	labels = [("Frame {}".format(frame_no) if channel_index == 0 else None) for frame_no in preview_frames for channel_index in range(nChannels)]
+	FileSaver(ImagePlus(os.path.basename(preview_path), make_montage(tiles, nChannels, labels))).saveAsPng(preview_path)
+
+def process_image(imp, channels_configs, flatfield_configs, applyGaussian, gaussRadius, temp_dir_path, location_index, stage_timer=None, writer=None, registration_config=None, metrics_config=None):
+	if stage_timer is None:
+		stage_timer = StageTimer()
+	if writer is None:
+		local_writer = writer = TiffWriter()
+	else:
+		local_writer = None
+	plane_megapixels = imp.getWidth() * imp.getHeight() / 1e6
+
 	# Get pixel size from the first image
 	pixel_frame = Duplicator().run(imp, 1, 1, 1, 1, 1, 1)
 	pixelWidth, pixelUnit = get_pixel_size(pixel_frame)
@@ -297,28 +585,56 @@ def process_image(imp, channels_configs, flatfield_configs, applyGaussian, gauss
 	channel_frame_paths = [[] for _ in channels_configs]
 	#channels = [[] for _ in channels_configs]  # List to hold processed frames for each channel
 
+	# The reference channel is processed first in every frame, so its drift is known for the other channels
+	drift_corrector = None
+	ordered_configs = channels_configs
+	if registration_config is not None:
+		drift_corrector = DriftCorrector(imp.getWidth(), imp.getHeight())
+		ordered_configs = sorted(channels_configs, key=lambda cfg: cfg.channel_number != registration_config.reference_channel)
+	metrics = [] if metrics_config is not None else None
+	preview_frames = get_preview_frames(total_time_frames)
+	previews = {} # (frame, channel) -> preview tile
+
 	for frame_no in range(1, total_time_frames + 1):
-		for ch_config in channels_configs:
+		for ch_config in ordered_configs:
+			start_time = time.time()
 			frame = Duplicator().run(imp, ch_config.channel_number + 1, ch_config.channel_number + 1, 1, 1, frame_no, frame_no)
+			stage_timer.add("read", start_time, plane_megapixels)
 
+			start_time = time.time()
 			if ch_config.do_processing:
 				if ch_config.channel_type == "Brightfield":
 					processed_frame = process_brightfield(frame, flatfield_configs, ch_config.channel_number, applyGaussian, gaussRadius)
 				elif ch_config.channel_type == "Fluorescence":
 					processed_frame = process_fluorescence(frame, flatfield_configs, ch_config.channel_number, pixelWidth)
+				stage_timer.add(ch_config.channel_type, start_time, plane_megapixels)
 			else:
 				processed_frame = frame
 			
 			processed_frame = set_scale(processed_frame, pixelWidth, pixelUnit)
+
+			# Measured before the drift correction, which fills the uncovered border with 0
+			if metrics is not None and ch_config.channel_number == metrics_config.channel_number:
+				start_time = time.time()
+				metrics.append((frame_no,) + measure_nucleoids(processed_frame))
+				stage_timer.add("metrics", start_time, plane_megapixels)
+
+			if drift_corrector is not None:
+				start_time = time.time()
+				if ch_config.channel_number == registration_config.reference_channel:
+					drift_corrector.add_frame(processed_frame.getProcessor(), frame_no)
+				drift_corrector.correct(processed_frame.getProcessor())
+				stage_timer.add("registration", start_time, plane_megapixels)
+
+			if frame_no in preview_frames:
+				previews[(frame_no, ch_config.channel_number)] = make_thumbnail(processed_frame.getProcessor())
    
-			# Save the processed frame to disk
+			# Queue the processed frame for saving to disk; the writer closes it once written to free memory
+			start_time = time.time()
 			frame_filename = "{}_frame{}_channel{}_Loc{}.tif".format(random_token, frame_no, ch_config.channel_number, location_index)
 			frame_filepath = os.path.join(temp_dir_path, frame_filename)
-			fs = FileSaver(processed_frame)
-			fs.saveAsTiff(frame_filepath)
-
-			# Close the processed frame to free memory
-			processed_frame.close()
+			writer.submit(processed_frame, frame_filepath, sync=False)
+			stage_timer.add("save_temp", start_time, plane_megapixels)
 
 			# Store the file path
 			channel_frame_paths[ch_config.channel_number].append(frame_filepath)
@@ -337,7 +653,14 @@ def process_image(imp, channels_configs, flatfield_configs, applyGaussian, gauss
 	# # Set scale for each image
 	# processed_stack = set_scale(processed_stack, pixelWidth, pixelUnit)
 
-	return channel_frame_paths, pixelWidth, pixelUnit
+	# Temporary frames are read back when the hyperstack is assembled
+	if local_writer is not None:
+		local_writer.finish()
+	else:
+		writer.wait()
+
+	shifts = drift_corrector.shifts if drift_corrector is not None else None
+	return channel_frame_paths, pixelWidth, pixelUnit, shifts, metrics, previews
 
 def cleanup_temp_directory(temp_dir, location_index):
 	# Delete all files in the temp_dir for the specified location_index
@@ -353,7 +676,7 @@ def cleanup_temp_directory(temp_dir, location_index):
 			except Exception as e:
 				print("Error while deleting file {}: {}".format(file_path, e))
 
-def save_processed_image(channel_frame_paths, original_file_path, applyGaussian, multiLoc, location_index):
+def save_processed_image(channel_frame_paths, original_file_path, applyGaussian, multiLoc, location_index, writer=None, shifts=None, metrics=None, previews=None):
 	# Prepare an output file path for the full processed stack
 	directory, original_filename = os.path.split(original_file_path)
 	filename, _ = os.path.splitext(original_filename)
@@ -369,6 +692,14 @@ def save_processed_image(channel_frame_paths, original_file_path, applyGaussian,
 	
 	output_file_path = os.path.join(directory, output_filename)
 
+	# Drift of every frame and the shift applied to it, next to the output image
+	if shifts is not None:
+		save_drift_table(shifts, os.path.splitext(output_file_path)[0] + "_Drift.csv")
+	if metrics is not None:
+		save_metrics_table(metrics, os.path.splitext(output_file_path)[0] + "_Metrics.csv")
+	if previews:
+		save_preview(previews, len(channel_frame_paths), os.path.splitext(output_file_path)[0] + "_Preview.png")
+
 	# Initialize a list to keep ImagePlus objects for each channel
 	channel_stacks = []
 	
@@ -416,12 +747,15 @@ def save_processed_image(channel_frame_paths, original_file_path, applyGaussian,
 	processed_hyperstack = set_scale(processed_hyperstack, cal_pixelWidth, cal_pixelUnit)
 	cal_frame.close()
 
-	# Save the full processed stack to disk
-	FileSaver(processed_hyperstack).saveAsTiff(output_file_path)
+	# Save the full processed stack to disk, in the background if a writer is given
+	if writer is not None:
+		writer.submit(processed_hyperstack, output_file_path)
+	else:
+		FileSaver(processed_hyperstack).saveAsTiff(output_file_path)
 
-	# Close the processed hyperstack to free up memory
-	processed_hyperstack.close()
-	IJ.run("Collect Garbage")
+		# Close the processed hyperstack to free up memory
+		processed_hyperstack.close()
+		IJ.run("Collect Garbage")
 	
 	return output_filename_init
 
@@ -441,13 +775,27 @@ def delete_empty_directory(directory_path):
 			except OSError as e:
 				print("Error: {} could not be deleted. Exception: {}".format(directory_path, e))
 
-def batch_process(files, channels_configs, flatfield_configs, applyGaussian, gaussRadius):
+def batch_process(files, channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config=None, metrics_config=None):
+	stage_timer = StageTimer()
+	writer = TiffWriter()
+	try:
+		batch_process_files(files, channels_configs, flatfield_configs, applyGaussian, gaussRadius, stage_timer, writer, registration_config, metrics_config)
+	finally:
+		writer.finish()
+
+	# Calibrate the cost model of the dry-run planner with the timings of this run
+	update_cost_model(stage_timer)
+
+def batch_process_files(files, channels_configs, flatfield_configs, applyGaussian, gaussRadius, stage_timer, writer, registration_config=None, metrics_config=None):
 	processed_image = None
 	output_filename_init = ""
 	for filepath in files:
 		print("Processing:", filepath)
 		largefile = is_large_file(filepath)
+		start_time = time.time()
 		opened_images = open_image(filepath, largefile)
+		if opened_images:
+			stage_timer.add("open", start_time, sum(imp.getWidth() * imp.getHeight() * imp.getStackSize() for imp in opened_images) / 1e6)
 		multiLoc = len(opened_images) > 1 if opened_images else False
 		directory, _ = os.path.split(filepath) # Use directory of image for storing temporary files
 		temp_dir_path = os.path.join(directory, "temp_dir")
@@ -463,9 +811,11 @@ def batch_process(files, channels_configs, flatfield_configs, applyGaussian, gau
 				else:
 					print("Processing image")
 				# Process the image and save the results
-				channel_frame_paths, pixelWidth, pixelUnit = process_image(imp, channels_configs, flatfield_configs, applyGaussian, gaussRadius, temp_dir_path, i if multiLoc else 0)
+				channel_frame_paths, pixelWidth, pixelUnit, shifts, metrics, previews = process_image(imp, channels_configs, flatfield_configs, applyGaussian, gaussRadius, temp_dir_path, i if multiLoc else 0, stage_timer, writer, registration_config, metrics_config)
 				if channel_frame_paths is not None:
-					output_filename_init = save_processed_image(channel_frame_paths, filepath, applyGaussian, multiLoc, i if multiLoc else 0)
+					start_time = time.time()
+					output_filename_init = save_processed_image(channel_frame_paths, filepath, applyGaussian, multiLoc, i if multiLoc else 0, writer, shifts, metrics, previews)
+					stage_timer.add("assemble", start_time, imp.getWidth() * imp.getHeight() * len(channel_frame_paths) * len(channel_frame_paths[0]) / 1e6)
 
 				# Cleanup temp directory by deleting temporary files
 				cleanup_temp_directory(temp_dir_path, i if multiLoc else 0)
@@ -477,6 +827,189 @@ def batch_process(files, channels_configs, flatfield_configs, applyGaussian, gau
 		delete_empty_directory(temp_dir_path)
 		IJ.run("Collect Garbage")
 
+# Cost model used by the dry-run planner: seconds per megapixel for each pipeline stage.
+# Defaults are replaced by measurements once a batch has been processed on this machine.
+COST_MODEL_PATH = os.path.join(os.path.expanduser("~"), ".NikonTi2_preprocessing_costs.json")
+COST_MODEL_DECAY = 0.7 # Weight of earlier runs when a new run is added to the cost model
+DEFAULT_STAGE_COSTS = {
+	"open": 0.02,
+	"read": 0.01,
+	"Brightfield": 0.15,
+	"Fluorescence": 0.40,
+	"save_temp": 0.03,
+	"assemble": 0.05,
+	"registration": 0.05,
+	"metrics": 0.10
+}
+
+def load_cost_model():
+	"""
+	Loads the stage costs (seconds per megapixel) calibrated from previous runs.
+	:return: A tuple (dict of stage -> seconds per megapixel, number of calibration runs).
+	"""
+	costs = dict(DEFAULT_STAGE_COSTS)
+	runs = 0
+	if os.path.exists(COST_MODEL_PATH):
+		try:
+			with open(COST_MODEL_PATH, "r") as f:
+				model = json.load(f)
+			for stage, totals in model.get("stages", {}).items():
+				if totals["megapixels"] > 0:
+					costs[stage] = totals["seconds"] / totals["megapixels"]
+			runs = model.get("runs", 0)
+		except (IOError, ValueError, KeyError) as e:
+			print("Could not read cost model {}: {}".format(COST_MODEL_PATH, e))
+	return costs, runs
+
+def update_cost_model(stage_timer):
+	"""Adds the stage timings of a finished run to the stored cost model, weighting earlier runs down."""
+	if not stage_timer.seconds:
+		return
+	model = {"stages": {}, "runs": 0}
+	if os.path.exists(COST_MODEL_PATH):
+		try:
+			with open(COST_MODEL_PATH, "r") as f:
+				model = json.load(f)
+		except (IOError, ValueError) as e:
+			print("Could not read cost model {}: {}".format(COST_MODEL_PATH, e))
+	stages = model.setdefault("stages", {})
+	for stage, totals in stages.items():
+		totals["seconds"] *= COST_MODEL_DECAY
+		totals["megapixels"] *= COST_MODEL_DECAY
+	for stage in stage_timer.seconds:
+		totals = stages.setdefault(stage, {"seconds": 0.0, "megapixels": 0.0})
+		totals["seconds"] += stage_timer.seconds[stage]
+		totals["megapixels"] += stage_timer.megapixels[stage]
+	model["runs"] = model.get("runs", 0) + 1
+	model["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+	try:
+		with open(COST_MODEL_PATH, "w") as f:
+			json.dump(model, f, indent=2)
+	except IOError as e:
+		print("Could not save cost model {}: {}".format(COST_MODEL_PATH, e))
+
+def read_image_headers(filepath):
+	"""
+	Reads the dimensions of every series (location) of a file from its header, without reading pixel data.
+	:return: A list of dicts with width, height, channels, slices, frames and bytes per pixel.
+	"""
+	reader = ImageReader()
+	series_headers = []
+	try:
+		reader.setId(filepath)
+		for series in range(reader.getSeriesCount()):
+			reader.setSeries(series)
+			series_headers.append({
+				"width": reader.getSizeX(),
+				"height": reader.getSizeY(),
+				"channels": reader.getSizeC(),
+				"slices": reader.getSizeZ(),
+				"frames": reader.getSizeT(),
+				"bitsPerPixel": reader.getBitsPerPixel(),
+				"bytesPerPixel": FormatTools.getBytesPerPixel(reader.getPixelType())
+			})
+	finally:
+		reader.close()
+	return series_headers
+
+def format_bytes(nBytes):
+	for unit in ["B", "KB", "MB", "GB"]:
+		if nBytes < 1024.0:
+			return "{:.1f} {}".format(nBytes, unit)
+		nBytes /= 1024.0
+	return "{:.1f} TB".format(nBytes)
+
+def format_duration(seconds):
+	hours, rest = divmod(int(round(seconds)), 3600)
+	minutes, seconds = divmod(rest, 60)
+	return "{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+def plan_batch(files, channels_configs, registration_config=None, metrics_config=None):
+	"""
+	Dry run: estimates wall time, peak memory, scratch (temp_dir) and output bytes for a batch
+	from the file headers and the calibrated stage costs, and recommends how many Fiji instances to run in parallel.
+	Nothing is processed or written except the report in the Log window.
+	:return: A dict with the totals of the plan.
+	"""
+	costs, runs = load_cost_model()
+	heap_bytes = IJ.maxMemory()
+	cores = Runtime.getRuntime().availableProcessors()
+	try:
+		physical_bytes = ManagementFactory.getOperatingSystemMXBean().getTotalPhysicalMemorySize()
+	except Exception:
+		physical_bytes = heap_bytes
+
+	total_seconds = 0.0
+	total_output_bytes = 0
+	peak_scratch_bytes = 0
+	peak_memory_bytes = 0
+	print("Dry run for {} file(s), cost model from {} calibration run(s):".format(len(files), runs))
+	for filepath in files:
+		try:
+			series_headers = read_image_headers(filepath)
+		except Exception as e:
+			print("Error reading header of {}: {}".format(filepath, e))
+			continue
+		file_bytes = os.path.getsize(filepath)
+		largefile = is_large_file(filepath)
+		file_megapixels = sum(h["width"] * h["height"] * h["channels"] * h["slices"] * h["frames"] for h in series_headers) / 1e6
+		file_seconds = file_megapixels * costs["open"]
+		for index, h in enumerate(series_headers):
+			if h["slices"] > 1:
+				print("  Warning: {} location {} has {} z-slices; only the first is processed.".format(os.path.basename(filepath), index + 1, h["slices"]))
+			plane_megapixels = h["width"] * h["height"] / 1e6
+			location_seconds = 0.0
+			location_output_bytes = 0
+			for ch_config in channels_configs:
+				stage = ch_config.channel_type if ch_config.do_processing else None
+				plane_seconds = costs["read"] + costs["save_temp"] + (costs.get(stage, 0.0) if stage else 0.0)
+				location_seconds += h["frames"] * plane_megapixels * plane_seconds
+				# Processed planes are written as 16-bit, unprocessed planes keep their bit depth
+				bytesPerPixel = 2 if ch_config.do_processing else h["bytesPerPixel"]
+				location_output_bytes += h["frames"] * h["width"] * h["height"] * bytesPerPixel
+			location_seconds += len(channels_configs) * h["frames"] * plane_megapixels * costs["assemble"]
+			if registration_config is not None:
+				location_seconds += len(channels_configs) * h["frames"] * plane_megapixels * costs["registration"]
+			if metrics_config is not None:
+				location_seconds += h["frames"] * plane_megapixels * costs["metrics"]
+			file_seconds += location_seconds
+			total_output_bytes += location_output_bytes
+			# temp_dir holds the frames of one location at a time
+			peak_scratch_bytes = max(peak_scratch_bytes, location_output_bytes)
+			# Opened file (unless virtual) + channel stacks and merged hyperstack + float working planes
+			working_bytes = 6 * h["width"] * h["height"] * 4
+			location_memory = (0 if largefile else file_bytes) + 2 * location_output_bytes + working_bytes
+			peak_memory_bytes = max(peak_memory_bytes, location_memory)
+			print("  {} location {}: {} x {} px, {} channel(s), {} frame(s), {}-bit: {}, output {}".format(
+				os.path.basename(filepath), index + 1, h["width"], h["height"], h["channels"], h["frames"],
+				h["bitsPerPixel"], format_duration(location_seconds), format_bytes(location_output_bytes)))
+		total_seconds += file_seconds
+
+	# The script processes its files one after the other; a batch can only be parallelized by running several Fiji
+	# instances, each on a separate part of the files. As many instances as cores and physical memory allow.
+	workers = 1
+	if peak_memory_bytes > 0:
+		workers = int(max(1, min(cores, len(files), (physical_bytes * 0.8) // peak_memory_bytes)))
+
+	print("Expected wall time: {}".format(format_duration(total_seconds)))
+	print("Peak memory: {} (Fiji heap: {}, physical memory: {})".format(format_bytes(peak_memory_bytes), format_bytes(heap_bytes), format_bytes(physical_bytes)))
+	print("Peak scratch space in temp_dir: {}".format(format_bytes(peak_scratch_bytes)))
+	print("Total output: {}".format(format_bytes(total_output_bytes)))
+	if workers > 1:
+		print("To run in parallel: start {} separate Fiji instances (of {} cores) and run this script in each of them at the same time,".format(workers, cores))
+		print("  selecting a separate part of the files (about {} per instance) in each file dialog. Expected wall time: {}".format(
+			-(-len(files) // workers), format_duration(total_seconds / workers)))
+	if peak_memory_bytes > heap_bytes:
+		print("Warning: the expected peak memory exceeds the Fiji heap. Increase the maximum memory in Edit > Options > Memory & Threads.")
+
+	return {
+		"seconds": total_seconds,
+		"peak_memory_bytes": peak_memory_bytes,
+		"scratch_bytes": peak_scratch_bytes,
+		"output_bytes": total_output_bytes,
+		"workers": workers
+	}
+
 def get_gaussian_input():
 	gd_gauss = GenericDialog("Gaussian Blur filter application")
 	gd_gauss.addCheckbox("Apply Gaussian Blur filter to Brightfield channel?", True)
@@ -494,8 +1027,281 @@ def get_gaussian_input():
 
 	return applyGaussian, gaussRadius
 
-def get_flatfield_paths(channels_configs):
+REGISTRATION_NONE = "None"
+
+def get_registration_input(channels_configs):
+	"""
+	Asks whether stage drift is corrected, and on which channel it is estimated.
+	:return: A RegistrationConfig, None if drift is not corrected, or False if canceled.
+	"""
+	channel_names = [REGISTRATION_NONE] + ["Channel {} ({})".format(cfg.channel_number + 1, cfg.channel_type) for cfg in channels_configs]
+	gd_registration = GenericDialog("Stage drift registration")
+	gd_registration.addChoice("Reference channel for drift correction:", channel_names, REGISTRATION_NONE)
+	gd_registration.addMessage("The drift of every frame is estimated by phase correlation on the reference channel\nand all channels are shifted back; the shifts are saved as <output>_Drift.csv.")
+	gd_registration.showDialog()
+
+	if gd_registration.wasCanceled():
+		return False
+
+	choice_index = channel_names.index(gd_registration.getNextChoice())
+	if choice_index == 0:
+		return None
+	return RegistrationConfig(channels_configs[choice_index - 1].channel_number)
+
+METRICS_NONE = "None"
+
+def get_metrics_input(channels_configs):
+	"""
+	Asks whether quick nucleoid metrics are measured during preprocessing, and on which fluorescence channel.
+	:return: A MetricsConfig, None if no metrics are measured, or False if canceled.
+	"""
+	fluorescence_configs = [cfg for cfg in channels_configs if cfg.channel_type == "Fluorescence"]
+	if not fluorescence_configs:
+		return None
+	channel_names = [METRICS_NONE] + ["Channel {}".format(cfg.channel_number + 1) for cfg in fluorescence_configs]
+	gd_metrics = GenericDialog("Quick nucleoid metrics")
+	gd_metrics.addChoice("DNA channel for nucleoid metrics:", channel_names, METRICS_NONE)
+	gd_metrics.addMessage("Nucleoid count, area, intensity fraction and concentration index of every frame\nare saved as <output>_Metrics.csv.")
+	gd_metrics.showDialog()
+
+	if gd_metrics.wasCanceled():
+		return False
+
+	choice_index = channel_names.index(gd_metrics.getNextChoice())
+	if choice_index == 0:
+		return None
+	try:
+		import_nucleoid_metrics()
+	except ImportError:
+		IJ.error("Quick nucleoid metrics", "Nucleoid_Metrics.py was not found. Place it next to this script or in Fiji.app/jars/Lib.\nNo nucleoid metrics are measured.")
+		return None
+	return MetricsConfig(fluorescence_configs[choice_index - 1].channel_number)
+
+FLATFIELD_MEAN = "Mean"
+FLATFIELD_SIGMA_CLIPPED = "Sigma-clipped mean"
+REFERENCE_EXTENSIONS = (".nd2", ".tif", ".tiff")
+
+def get_exposure_time(meta, series, plane):
+	"""Returns the exposure time of a plane as text (e.g. '100.0 ms'), or None if it is not in the metadata."""
+	try:
+		exposure = meta.getPlaneExposureTime(series, plane)
+	except Exception:
+		return None
+	if exposure is None:
+		return None
+	return "{} {}".format(exposure.value(), exposure.unit().getSymbol())
+
+def iterate_reference_planes(reference_paths, channel_number):
+	"""
+	Yields the planes of one channel from all reference files (all series, all frames),
+	reading a single plane at a time so that memory use does not depend on the number of frames.
+	Files with only one channel are used as they are.
+	:return: Generator of (FloatProcessor, exposure time) tuples.
+	"""
+	for path in reference_paths:
+		reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+		meta = MetadataTools.createOMEXMLMetadata()
+		reader.setMetadataStore(meta)
+		try:
+			reader.setId(path)
+			for series in range(reader.getSeriesCount()):
+				reader.setSeries(series)
+				nChannels = reader.getSizeC()
+				if nChannels > 1 and channel_number >= nChannels:
+					print("Reference file {} has no channel {}.".format(path, channel_number + 1))
+					break
+				for plane in range(reader.getImageCount()):
+					z, c, t = reader.getZCTCoords(plane)
+					if nChannels > 1 and c != channel_number:
+						continue
+					ip = reader.openProcessors(plane)[0]
+					yield ip.convertToFloatProcessor(), get_exposure_time(meta, series, plane)
+		finally:
+			reader.close()
+
+def get_flatfield_cache_key(reference_paths, channel_number, method, clipSigma, smoothSigma):
+	"""Hashes the reference files (path, size, modification time) and settings into a cache key."""
+	sha = hashlib.sha1()
+	sha.update(u"{}|{}|{}|{}".format(channel_number, method, clipSigma, smoothSigma).encode("utf-8"))
+	for path in sorted(reference_paths):
+		sha.update(u"|{}|{}|{}".format(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)).encode("utf-8"))
+	return sha.hexdigest()
+
+def build_flatfield(reference_paths, channel_number, method, clipSigma, smoothSigma, output_dir):
+	"""
+	Builds a normalized flat-field (gain) image from empty-pad reference acquisitions.
+	Reference planes are streamed one at a time into running sums, so any number of frames can be used.
+	With the sigma-clipped method, a second pass averages only pixels within clipSigma standard
+	deviations of the running mean, which removes debris and hot pixels present in a few frames.
+	The result is optionally smoothed, normalized to a mean of 1, and cached: an identical reference
+	set with identical settings returns the previously saved image without reading the frames again.
+	:return: Path to the saved flat-field image, or None if no reference planes could be read.
+	"""
+	cache_key = get_flatfield_cache_key(reference_paths, channel_number, method, clipSigma, smoothSigma)
+	output_path = os.path.join(output_dir, "FlatField_Ch{}_{}.tif".format(channel_number + 1, cache_key[:12]))
+	if os.path.exists(output_path):
+		print("Using cached flat field image for channel {}: {}".format(channel_number + 1, output_path))
+		return output_path
+
+	# First pass: sums of deviations from the first plane (shifted data keeps float precision for the variance)
+	shift_fp = None
+	sum_fp = None
+	sumsq_fp = None
+	nPlanes = 0
+	exposures = set()
+	for fp, exposure in iterate_reference_planes(reference_paths, channel_number):
+		if shift_fp is None:
+			shift_fp = fp.duplicate()
+			sum_fp = FloatProcessor(fp.getWidth(), fp.getHeight())
+			sumsq_fp = FloatProcessor(fp.getWidth(), fp.getHeight())
+		elif fp.getWidth() != shift_fp.getWidth() or fp.getHeight() != shift_fp.getHeight():
+			print("Reference planes for channel {} differ in size.".format(channel_number + 1))
+			return None
+		fp.copyBits(shift_fp, 0, 0, Blitter.SUBTRACT)
+		sum_fp.copyBits(fp, 0, 0, Blitter.ADD)
+		fp.sqr()
+		sumsq_fp.copyBits(fp, 0, 0, Blitter.ADD)
+		nPlanes += 1
+		if exposure is not None:
+			exposures.add(exposure)
+		IJ.showStatus("Flat field channel {}: {} planes".format(channel_number + 1, nPlanes))
+
+	if nPlanes == 0:
+		print("No reference planes found for channel {}.".format(channel_number + 1))
+		return None
+	if len(exposures) > 1:
+		print("Warning: reference planes for channel {} have different exposure times: {}".format(channel_number + 1, ", ".join(sorted(exposures))))
+
+	# Mean = shift + sum/n
+	mean_fp = sum_fp.duplicate()
+	mean_fp.multiply(1.0 / nPlanes)
+	mean_fp.copyBits(shift_fp, 0, 0, Blitter.ADD)
+
+	if method == FLATFIELD_SIGMA_CLIPPED and nPlanes > 2:
+		# Standard deviation from the shifted sums: var = (sumsq - sum^2/n) / (n - 1)
+		limit_fp = sum_fp.duplicate()
+		limit_fp.sqr()
+		limit_fp.multiply(-1.0 / nPlanes)
+		limit_fp.copyBits(sumsq_fp, 0, 0, Blitter.ADD)
+		limit_fp.multiply(1.0 / (nPlanes - 1))
+		limit_fp.sqrt()
+		limit_fp.multiply(clipSigma)
+		sum_fp = None
+		sumsq_fp = None
+
+		# Second pass: average of the pixels within the clipping limit
+		clipped_sum_fp = FloatProcessor(mean_fp.getWidth(), mean_fp.getHeight())
+		clipped_count_fp = FloatProcessor(mean_fp.getWidth(), mean_fp.getHeight())
+		for fp, exposure in iterate_reference_planes(reference_paths, channel_number):
+			deviation_fp = fp.duplicate()
+			deviation_fp.copyBits(mean_fp, 0, 0, Blitter.SUBTRACT)
+			deviation_fp.abs()
+			deviation_fp.copyBits(limit_fp, 0, 0, Blitter.SUBTRACT)
+			deviation_fp.setThreshold(-Float.MAX_VALUE, 0.0, ImageProcessor.NO_LUT_UPDATE)
+			weight_fp = deviation_fp.createMask().convertToFloatProcessor()
+			weight_fp.multiply(1.0 / 255)
+			fp.copyBits(weight_fp, 0, 0, Blitter.MULTIPLY)
+			clipped_sum_fp.copyBits(fp, 0, 0, Blitter.ADD)
+			clipped_count_fp.copyBits(weight_fp, 0, 0, Blitter.ADD)
+		# Pixels without any plane within the limit (float rounding, or a constant pixel with SD 0) keep the unclipped mean
+		clipped_count_fp.setThreshold(-Float.MAX_VALUE, 0.5, ImageProcessor.NO_LUT_UPDATE)
+		empty_fp = clipped_count_fp.createMask().convertToFloatProcessor()
+		empty_fp.multiply(1.0 / 255)
+		clipped_count_fp.copyBits(empty_fp, 0, 0, Blitter.ADD)
+		clipped_sum_fp.copyBits(clipped_count_fp, 0, 0, Blitter.DIVIDE)
+		empty_fp.copyBits(mean_fp, 0, 0, Blitter.MULTIPLY)
+		clipped_sum_fp.copyBits(empty_fp, 0, 0, Blitter.ADD)
+		flat_fp = clipped_sum_fp
+	else:
+		flat_fp = mean_fp
+
+	if smoothSigma > 0:
+		GaussianBlur().blurGaussian(flat_fp, smoothSigma, smoothSigma, 0.002)
+
+	# Normalize to a mean of 1, so the image is a gain map
+	flat_fp.resetMinAndMax()
+	flat_fp.multiply(1.0 / flat_fp.getStatistics().mean)
+	flat_fp.resetMinAndMax()
+
+	metadata = {
+		"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+		"channel": channel_number + 1,
+		"exposure": ", ".join(sorted(exposures)) if exposures else "unknown",
+		"method": method,
+		"clip_sigma": clipSigma if method == FLATFIELD_SIGMA_CLIPPED else None,
+		"smooth_sigma": smoothSigma,
+		"planes": nPlanes,
+		"reference_files": sorted(reference_paths),
+		"cache_key": cache_key
+	}
+	flat_imp = ImagePlus("FlatField_Ch{}".format(channel_number + 1), flat_fp)
+	flat_imp.setProperty("Info", "\n".join("{} = {}".format(key, metadata[key]) for key in sorted(metadata)))
+	FileSaver(flat_imp).saveAsTiff(output_path)
+	with open(os.path.splitext(output_path)[0] + ".json", "w") as f:
+		json.dump(metadata, f, indent=2)
+	flat_imp.close()
+
+	print("Saved flat field image for channel {} from {} planes: {}".format(channel_number + 1, nPlanes, output_path))
+	return output_path
+
+def get_flatfield_builder_input(channels_configs):
+	"""
+	Optionally builds flat-field images from folders of empty-pad reference acquisitions.
+	:return: A dict of channel number -> built flat-field path (empty if not used), or None if canceled.
+	"""
+	built_paths = {}
+	gd_build = GenericDialog("Build flat field images")
+	gd_build.addMessage("Flat field images can be built from empty agar pad acquisitions (.nd2 or .tif),\nor existing flat field images can be chosen in the next dialog.")
+	gd_build.addCheckbox("Build flat field images from reference acquisitions?", False)
+	gd_build.showDialog()
+	if gd_build.wasCanceled():
+		return None
+	if not gd_build.getNextBoolean():
+		return built_paths
+
+	refStartDir = "E:/Nikon Eclipse microscope/Background illumination controls"
+	for ch_config in channels_configs:
+		if not ch_config.do_processing:
+			continue
+		gd = GenericDialog("Channel {} flat field reference".format(ch_config.channel_number + 1))
+		gd.addDirectoryField("Reference folder (empty = skip):", refStartDir)
+		gd.addNumericField("Channel in reference files:", ch_config.channel_number + 1, 0)
+		gd.addChoice("Estimate:", [FLATFIELD_MEAN, FLATFIELD_SIGMA_CLIPPED], FLATFIELD_SIGMA_CLIPPED)
+		gd.addNumericField("Clipping limit (SD, at least 1):", 3, 1)
+		gd.addNumericField("Smoothing sigma (pixels, 0 = off):", 2, 1)
+		gd.showDialog()
+		if gd.wasCanceled():
+			return None
+
+		reference_dir = gd.getNextString().strip()
+		reference_channel = int(gd.getNextNumber()) - 1
+		method = gd.getNextChoice()
+		clipSigma = max(gd.getNextNumber(), 1.0)
+		smoothSigma = max(gd.getNextNumber(), 0.0)
+		if not reference_dir:
+			continue
+		if not os.path.isdir(reference_dir):
+			IJ.error("Reference folder not found: {}".format(reference_dir))
+			return None
+
+		reference_paths = [os.path.join(reference_dir, name) for name in sorted(os.listdir(reference_dir))
+			if name.lower().endswith(REFERENCE_EXTENSIONS) and not name.startswith("FlatField_")]
+		if not reference_paths:
+			IJ.error("No reference images found in: {}".format(reference_dir))
+			return None
+
+		flatFieldPath = build_flatfield(reference_paths, reference_channel, method, clipSigma, smoothSigma, reference_dir)
+		if flatFieldPath is None:
+			IJ.error("Could not build flat field image for channel {}.".format(ch_config.channel_number + 1))
+			return None
+		built_paths[ch_config.channel_number] = flatFieldPath
+
+	return built_paths
+
+def get_flatfield_paths(channels_configs, built_paths=None):
 	flatfield_configs = []
+	if built_paths is None:
+		built_paths = {}
 	FLATFIELD_BG_SUBTRACTION = "Flat Field Correction + Background subtraction"
 	ONLY_BG_SUBTRACTION = "Only Background subtraction"
 	
@@ -504,7 +1310,7 @@ def get_flatfield_paths(channels_configs):
 	gd_flatField = GenericDialog("Choose Flat Field image for each channel")
 	for ch_config in channels_configs:
 		if ch_config.do_processing:
-			gd_flatField.addFileField("Channel {} Flat Field image".format(ch_config.channel_number + 1), flatStartDir)
+			gd_flatField.addFileField("Channel {} Flat Field image".format(ch_config.channel_number + 1), built_paths.get(ch_config.channel_number, flatStartDir))
 			if ch_config.channel_type == "Fluorescence":
 				gd_flatField.addChoice("Channel {} pre-processing method:".format(ch_config.channel_number + 1), [FLATFIELD_BG_SUBTRACTION, ONLY_BG_SUBTRACTION], FLATFIELD_BG_SUBTRACTION)
 	gd_flatField.showDialog()
@@ -544,51 +1350,43 @@ def select_files():
 	else:
 		return []
 	
+RUN_MODE_PROCESS = "Process images"
+RUN_MODE_PLAN = "Dry run (plan only)"
+RUN_MODE_WATCH = "Watch acquisition folder"
+
 def close_all_images():
 	"""Close all open image windows in ImageJ."""
 	if WindowManager.getWindowCount() > 0:
 		IJ.run("Close All")
 	IJ.run("Collect Garbage")
 
-def main():
-	gd_clear = GenericDialog("Clear open image files")
-	gd_clear.addMessage("This process will close all currently open image windows. Do you want to proceed?")
-	gd_clear.enableYesNoCancel()
-	gd_clear.showDialog()	
-	if gd_clear.wasCanceled(): # User pressed "Cancel" or closed the dialog
-		return 
-	elif gd_clear.wasOKed(): # User pressed "Yes"
-		close_all_images()
-		
-	gd_message = GenericDialog("ND2 preprocessing")
-	gd_message.addMessage("Select all files from Nikon microscope for preprocessing. All images should have the same channel layout and use the same acquisition settings.")
-	gd_message.setOKLabel("Browse")
-	gd_message.showDialog()
-	if gd_message.wasCanceled():
-		return 
-
-	filepaths = select_files()
-	if not filepaths:
-		IJ.error("No files were selected!")
-		return
-
+def get_run_configuration():
+	"""
+	Asks for channel layout, flat field images, Gaussian blur, drift registration and nucleoid metrics settings.
+	:return: A tuple (channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config), or None if canceled.
+	"""
 	# Get user input
 	channels_configs = get_image_input()
 	if not channels_configs:
-		return
+		return None
+
+	built_paths = get_flatfield_builder_input(channels_configs)
+	if built_paths is None:
+		print("Flat field building was canceled by user.")
+		return None
 
-	flatfield_configs = get_flatfield_paths(channels_configs)
+	flatfield_configs = get_flatfield_paths(channels_configs, built_paths)
 
 	if flatfield_configs is None:
 		print("Flat field configuration was canceled by user.")
-		return
+		return None
 
 	# Iterate over flatfield configurations and check that every config
 	# that requires flat field correction has a non-empty path.
 	for cfg in flatfield_configs:
 		if cfg.do_fluoFlatField and not cfg.flatFieldPath.strip():
 			IJ.error("Missing flat field image path for channel {}.".format(cfg.channel_number + 1))
-			return
+			return None
 
 	# Check for identical flatFieldPaths
 	path_to_channels = {}
@@ -616,14 +1414,241 @@ def main():
 		gd_duplicate.enableYesNoCancel()
 		gd_duplicate.showDialog()
 		if gd_duplicate.wasCanceled():
-			return
+			return None
 		elif not gd_duplicate.wasOKed():  # User pressed "No"
 			print("User chose not to proceed with duplicate flat field paths.")
-			return  # Exit if the user does not want to continue
+			return None  # Exit if the user does not want to continue
+
+	gaussian_input = get_gaussian_input()
+	if not gaussian_input:
+		return None
+	applyGaussian, gaussRadius = gaussian_input
+
+	registration_config = get_registration_input(channels_configs)
+	if registration_config is False:
+		return None
 
-	applyGaussian, gaussRadius = get_gaussian_input()
+	metrics_config = get_metrics_input(channels_configs)
+	if metrics_config is False:
+		return None
+
+	return channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config
+
+RUN_CONFIG_FILENAME = "NikonTi2_preprocessing_config.json"
+
+def save_run_configuration(config_path, channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config=None, metrics_config=None):
+	"""Saves the run configuration as JSON, so a watched acquisition folder can be processed with it later."""
+	run_config = {
+		"channels": [cfg.__dict__ for cfg in channels_configs],
+		"flatfields": [cfg.__dict__ for cfg in flatfield_configs],
+		"applyGaussian": applyGaussian,
+		"gaussRadius": gaussRadius,
+		"registration": registration_config.__dict__ if registration_config is not None else None,
+		"metrics": metrics_config.__dict__ if metrics_config is not None else None
+	}
+	with open(config_path, "w") as f:
+		json.dump(run_config, f, indent=2)
+
+def load_run_configuration(config_path):
+	"""
+	Loads a run configuration saved by save_run_configuration.
+	:return: A tuple (channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config), or None if invalid.
+	"""
+	try:
+		with open(config_path, "r") as f:
+			run_config = json.load(f)
+		channels_configs = [ChannelConfig(cfg["channel_type"], cfg["channel_number"], cfg["do_processing"]) for cfg in run_config["channels"]]
+		flatfield_configs = [FlatFieldConfig(cfg["flatFieldPath"], cfg["channel_number"], cfg["do_fluoFlatField"]) for cfg in run_config["flatfields"]]
+		# Configurations saved before drift registration and nucleoid metrics were added have no "registration" or "metrics" entry
+		registration = run_config.get("registration")
+		registration_config = RegistrationConfig(registration["reference_channel"]) if registration else None
+		metrics = run_config.get("metrics")
+		metrics_config = MetricsConfig(metrics["channel_number"]) if metrics else None
+		return channels_configs, flatfield_configs, run_config["applyGaussian"], run_config["gaussRadius"], registration_config, metrics_config
+	except (IOError, ValueError, KeyError, TypeError) as e:
+		print("Could not load run configuration {}: {}".format(config_path, e))
+		return None
+
+class FileWatcher:
+	"""
+	Tracks the files of an acquisition folder between polls. A file is complete when its size and
+	modification time have not changed for stable_polls polls and it is not locked for writing.
+	"""
+	def __init__(self, watch_dir, extensions, stable_polls):
+		self.watch_dir = watch_dir
+		self.extensions = tuple(extensions)
+		self.stable_polls = stable_polls
+		self.history = {} # path -> (size, modification time, number of unchanged polls)
+
+	def poll(self, exclude_paths):
+		"""Returns the paths that have become complete since they were first seen, except exclude_paths."""
+		complete_paths = []
+		for filename in sorted(os.listdir(self.watch_dir)):
+			path = os.path.join(self.watch_dir, filename)
+			if not filename.lower().endswith(self.extensions) or path in exclude_paths or not os.path.isfile(path):
+				continue
+			try:
+				size, mtime = os.path.getsize(path), os.path.getmtime(path)
+			except os.error:
+				continue # File was moved or deleted since the listing
+			previous = self.history.get(path)
+			if previous is not None and previous[0] == size and previous[1] == mtime:
+				unchanged = previous[2] + 1
+			else:
+				unchanged = 0
+			self.history[path] = (size, mtime, unchanged)
+			if unchanged >= self.stable_polls and size > 0 and is_file_unlocked(path):
+				complete_paths.append(path)
+		return complete_paths
+
+def is_file_unlocked(path):
+	"""Checks that no other program (e.g. the acquisition software) holds a lock on the file."""
+	try:
+		raf = RandomAccessFile(path, "rw")
+	except IOException:
+		return False
+	try:
+		lock = raf.getChannel().tryLock()
+		if lock is None:
+			return False
+		lock.release()
+		return True
+	except IOException:
+		return False
+	finally:
+		raf.close()
+
+def read_processed_log(log_path):
+	if not os.path.exists(log_path):
+		return set()
+	with open(log_path, "r") as f:
+		return set(line.strip() for line in f if line.strip())
+
+def watch_directory(watch_dir, channels_configs, flatfield_configs, applyGaussian, gaussRadius, poll_seconds, stable_polls, idle_minutes, registration_config=None, metrics_config=None):
+	"""
+	Watches an acquisition folder and preprocesses every .nd2 file as soon as the microscope has finished writing it.
+	Processed files are recorded in a log in the folder, so watching can be stopped and resumed.
+	Stops when no new file has appeared for idle_minutes, or when Esc is pressed.
+	"""
+	log_path = os.path.join(watch_dir, "NikonTi2_preprocessed_files.txt")
+	processed_paths = read_processed_log(log_path)
+	watcher = FileWatcher(watch_dir, [".nd2"], stable_polls)
+	last_activity = time.time()
+	IJ.resetEscape()
+	print("Watching {} (press Esc to stop)".format(watch_dir))
+	while not IJ.escapePressed():
+		complete_paths = watcher.poll(processed_paths)
+		for filepath in complete_paths:
+			batch_process([filepath], channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config)
+			processed_paths.add(filepath)
+			with open(log_path, "a") as f:
+				f.write(filepath + "\n")
+			last_activity = time.time()
+		if watcher.history and any(entry[2] == 0 for entry in watcher.history.values()):
+			last_activity = time.time() # A file is still being written
+		if time.time() - last_activity > idle_minutes * 60:
+			print("No new files for {} minutes, stopped watching.".format(idle_minutes))
+			break
+		IJ.showStatus("Watching {}: {} file(s) processed".format(watch_dir, len(processed_paths)))
+		time.sleep(poll_seconds)
+	print("Watch mode ended.")
+
+def get_watch_input():
+	"""
+	Asks for the acquisition folder and polling settings of watch mode.
+	:return: A tuple (watch_dir, poll_seconds, stable_polls, idle_minutes), or None if canceled.
+	"""
+	gd_watch = GenericDialog("Watch acquisition folder")
+	gd_watch.addDirectoryField("Acquisition folder:", "E:/Nikon Eclipse microscope")
+	gd_watch.addNumericField("Poll interval (s):", 10, 0)
+	gd_watch.addNumericField("Unchanged polls before a file is complete:", 3, 0)
+	gd_watch.addNumericField("Stop after idle time (min):", 60, 0)
+	gd_watch.showDialog()
+	if gd_watch.wasCanceled():
+		return None
+	watch_dir = gd_watch.getNextString().strip()
+	if not os.path.isdir(watch_dir):
+		IJ.error("Folder not found: {}".format(watch_dir))
+		return None
+	poll_seconds = max(1, int(gd_watch.getNextNumber()))
+	stable_polls = max(1, int(gd_watch.getNextNumber()))
+	idle_minutes = max(1, gd_watch.getNextNumber())
+	return watch_dir, poll_seconds, stable_polls, idle_minutes
+
+def main():
+	gd_clear = GenericDialog("Clear open image files")
+	gd_clear.addMessage("This process will close all currently open image windows. Do you want to proceed?")
+	gd_clear.enableYesNoCancel()
+	gd_clear.showDialog()	
+	if gd_clear.wasCanceled(): # User pressed "Cancel" or closed the dialog
+		return 
+	elif gd_clear.wasOKed(): # User pressed "Yes"
+		close_all_images()
+
+	gd_mode = GenericDialog("Run mode")
+	gd_mode.addChoice("Mode:", [RUN_MODE_PROCESS, RUN_MODE_PLAN, RUN_MODE_WATCH], RUN_MODE_PROCESS)
+	gd_mode.addMessage("The dry run reads only file headers and reports expected run time,\nmemory, temp_dir and output size in the Log window.")
+	gd_mode.addMessage("Watch mode processes each .nd2 file in an acquisition folder\nas soon as the microscope has finished writing it.")
+	gd_mode.showDialog()
+	if gd_mode.wasCanceled():
+		return
+	run_mode = gd_mode.getNextChoice()
+
+	if run_mode == RUN_MODE_WATCH:
+		watch_input = get_watch_input()
+		if watch_input is None:
+			return
+		watch_dir, poll_seconds, stable_polls, idle_minutes = watch_input
+
+		# Reuse the configuration saved in the folder, so watching can be restarted without dialogs
+		config_path = os.path.join(watch_dir, RUN_CONFIG_FILENAME)
+		run_config = None
+		if os.path.exists(config_path):
+			gd_config = GenericDialog("Saved configuration")
+			gd_config.addMessage("Use the configuration saved in the acquisition folder?\n" + config_path)
+			gd_config.enableYesNoCancel()
+			gd_config.showDialog()
+			if gd_config.wasCanceled():
+				return
+			elif gd_config.wasOKed():
+				run_config = load_run_configuration(config_path)
+				if run_config is None:
+					IJ.error("Could not load saved configuration: {}".format(config_path))
+					return
+		if run_config is None:
+			run_config = get_run_configuration()
+			if run_config is None:
+				return
+			save_run_configuration(config_path, *run_config)
+
+		channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config = run_config
+		watch_directory(watch_dir, channels_configs, flatfield_configs, applyGaussian, gaussRadius, poll_seconds, stable_polls, idle_minutes, registration_config, metrics_config)
+		IJ.run("Collect Garbage")
+		return
+
+	gd_message = GenericDialog("ND2 preprocessing")
+	gd_message.addMessage("Select all files from Nikon microscope for preprocessing. All images should have the same channel layout and use the same acquisition settings.")
+	gd_message.setOKLabel("Browse")
+	gd_message.showDialog()
+	if gd_message.wasCanceled():
+		return 
+
+	filepaths = select_files()
+	if not filepaths:
+		IJ.error("No files were selected!")
+		return
+
+	# Get user input
+	run_config = get_run_configuration()
+	if run_config is None:
+		return
+	channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config = run_config
+
+	if run_mode == RUN_MODE_PLAN:
+		plan_batch(filepaths, channels_configs, registration_config, metrics_config)
+		return
 
-	batch_process(filepaths, channels_configs, flatfield_configs, applyGaussian, gaussRadius)
+	batch_process(filepaths, channels_configs, flatfield_configs, applyGaussian, gaussRadius, registration_config, metrics_config)
 	print("Processing completed")
 	IJ.run("Collect Garbage")
 
@@ -0,0 +1,428 @@
+from ij import IJ, ImagePlus
+from ij.process import ImageProcessor, ShortProcessor, FloatProcessor, Blitter
+from ij.plugin import RGBStackMerge
+from ij.gui import GenericDialog
+from ij.io import DirectoryChooser, FileSaver
+from java.util import Random
+from imp import load_source
+import os
+import sys
+import hashlib
+import time
+import json
+import shutil
+import tempfile
+
+# Golden-output and performance-budget validation of the preprocessing functions of all three scripts.
+# "Record" runs every check on synthetic images and stores the outputs as golden files; "Verify" reruns the
+# checks and compares pixels, layout and calibration with the golden files and the throughput with the budgets.
+# No golden outputs are committed, because they can only be recorded in Fiji: record them from a checkout of the
+# scripts before a change to the processing (reference scripts folder) and verify the changed scripts against them.
+# This script has not been run yet, so it is not validated itself.
+GOLDEN_FILENAME = "golden.json"
+GOLDEN_WIDTH = 160 # Size of the synthetic planes compared with the golden outputs, in pixels
+GOLDEN_HEIGHT = 120
+PERFORMANCE_SIZE = 1024 # Side of the synthetic planes timed for the throughput budgets, in pixels
+PERFORMANCE_REPEATS = 3 # Timed runs per stage; the fastest run counts
+PERFORMANCE_MARGIN = 1.5 # Budget of a stage when recorded, relative to its measured seconds per megapixel
+# Outputs are compared without tolerance, e.g. the cached Nikon flat field must match the flat-field division of the reference scripts exactly
+PIXEL_TOLERANCES = {} # "<check>_<output>" -> largest accepted absolute pixel difference; all other outputs must be identical
+PIXEL_WIDTH = 0.065 # Calibration of the synthetic images
+PIXEL_UNIT = u"\u00b5m"
+
+SCRIPTS = [ # Validated scripts: name -> file, plus the module they share
+	("NikonTi2", "Preprocessing_NikonTi2_images.py"),
+	("ImageXpress", "Preprocessing_ImageXpress_images.py"),
+	("DM6000B", "Preprocessing_DM6000B_images.py")
+]
+SHARED_MODULES = ["Nucleoid_Metrics"]
+
+MODE_RECORD = "Record golden outputs"
+MODE_VERIFY = "Verify against golden outputs"
+
+def get_script_dir():
+	try:
+		return os.path.dirname(os.path.abspath(__file__))
+	except NameError:
+		return DirectoryChooser("Choose the Preprocessing folder").getDirectory()
+
+def import_preprocessing_modules(script_dir, prefix):
+	"""
+	Loads the three preprocessing scripts of a folder, which are validated through their functions.
+	Every script is loaded from its path under the module name <prefix>_<name>, and the shared modules are removed
+	from sys.modules, so scripts of another folder loaded earlier in the same Fiji session (e.g. the reference
+	scripts of a recording) are never reused.
+	"""
+	for name in SHARED_MODULES:
+		sys.modules.pop(name, None)
+	modules = {}
+	for name, filename in SCRIPTS:
+		modules[name] = load_source("{}_{}".format(prefix, name), os.path.join(script_dir, filename))
+	return modules
+
+def get_script_hashes(script_dir):
+	"""MD5 of every validated script and shared module in a folder, to show which code a run used."""
+	hashes = {}
+	for filename in [filename for name, filename in SCRIPTS] + [name + ".py" for name in SHARED_MODULES]:
+		path = os.path.join(script_dir, filename)
+		if os.path.exists(path):
+			with open(path, "rb") as f:
+				hashes[filename] = hashlib.md5(f.read()).hexdigest()
+	return hashes
+
+def create_plane(width, height, seed, background, signal, noise):
+	"""Creates a 16-bit plane with blurred cell-like ellipses on a flat background and Gaussian noise, identical for the same seed."""
+	random = Random(seed)
+	ip = ShortProcessor(width, height)
+	ip.setValue(background)
+	ip.fill()
+	ip.setValue(background + signal)
+	cell_length = max(4, width // 12)
+	for i in range(width * height // (cell_length * cell_length * 4)):
+		ip.fillOval(random.nextInt(width), random.nextInt(height), cell_length, max(2, cell_length // 3))
+	ip.blurGaussian(1.5)
+	ImageProcessor.setRandomSeed(seed)
+	ip.noise(noise)
+	return ip
+
+def create_image(title, width, height, seed, background, signal, noise):
+	imp = ImagePlus(title, create_plane(width, height, seed, background, signal, noise))
+	imp.getCalibration().pixelWidth = PIXEL_WIDTH
+	imp.getCalibration().pixelHeight = PIXEL_WIDTH
+	imp.getCalibration().setUnit(PIXEL_UNIT)
+	return imp
+
+# Synthetic brightfield and fluorescence images: (background, signal, noise) of the planes
+BRIGHTFIELD_16BIT = (20000, -6000, 800) # ImageXpress and DM6000B
+BRIGHTFIELD_12BIT = (2000, -600, 60) # Nikon
+FLUORESCENCE = (200, 1500, 30)
+
+def save_flatfield(modules, work_dir, width, height):
+	"""
+	Saves a vignetted flat field image and returns the Nikon flat field configs using it
+	for a brightfield channel 0 and a fluorescence channel 1, and a fluorescence channel 2 without flat field.
+	"""
+	ip = FloatProcessor(width, height)
+	ip.setValue(1.0)
+	ip.fill()
+	ip.setValue(1.4)
+	ip.fillOval(width // 4, height // 4, width // 2, height // 2)
+	ip.blurGaussian(min(width, height) / 6.0)
+	flatfield_path = os.path.join(work_dir, "FlatField_{}x{}.tif".format(width, height))
+	FileSaver(ImagePlus("FlatField", ip)).saveAsTiff(flatfield_path)
+	FlatFieldConfig = modules["NikonTi2"].FlatFieldConfig
+	return [FlatFieldConfig(flatfield_path, 0, True), FlatFieldConfig(flatfield_path, 1, True), FlatFieldConfig("", 2, False)]
+
+def describe_image(imp):
+	"""Layout and calibration of an output image."""
+	cal = imp.getCalibration()
+	return {
+		"dimensions": list(imp.getDimensions()),
+		"bitDepth": imp.getBitDepth(),
+		"pixelWidth": cal.pixelWidth,
+		"pixelHeight": cal.pixelHeight,
+		"unit": cal.getUnit()
+	}
+
+# Checks: each returns a tuple (dict of output name -> ImagePlus, dict of output name -> JSON value)
+
+def check_processing(modules, work_dir):
+	"""Brightfield and fluorescence processing of all three scripts on single planes."""
+	flatfield_configs = save_flatfield(modules, work_dir, GOLDEN_WIDTH, GOLDEN_HEIGHT)
+	nikon = modules["NikonTi2"]
+	images = {}
+	for name in ["ImageXpress", "DM6000B"]:
+		images[name + "_brightfield"] = modules[name].process_brightfield(create_image("BF", GOLDEN_WIDTH, GOLDEN_HEIGHT, 1, *BRIGHTFIELD_16BIT))
+		images[name + "_fluorescence"] = modules[name].process_fluorescence(create_image("FL", GOLDEN_WIDTH, GOLDEN_HEIGHT, 2, *FLUORESCENCE))
+	images["NikonTi2_brightfield"] = nikon.process_brightfield(create_image("BF", GOLDEN_WIDTH, GOLDEN_HEIGHT, 3, *BRIGHTFIELD_12BIT), flatfield_configs, 0, False, 1.0)
+	images["NikonTi2_brightfield_GBlur"] = nikon.process_brightfield(create_image("BF", GOLDEN_WIDTH, GOLDEN_HEIGHT, 3, *BRIGHTFIELD_12BIT), flatfield_configs, 0, True, 1.0)
+	images["NikonTi2_fluorescence_FlatField"] = nikon.process_fluorescence(create_image("FL", GOLDEN_WIDTH, GOLDEN_HEIGHT, 4, *FLUORESCENCE), flatfield_configs, 1, PIXEL_WIDTH)
+	images["NikonTi2_fluorescence"] = nikon.process_fluorescence(create_image("FL", GOLDEN_WIDTH, GOLDEN_HEIGHT, 4, *FLUORESCENCE), flatfield_configs, 2, PIXEL_WIDTH)
+	values = dict((name, describe_image(imp)) for name, imp in images.items())
+	return images, values
+
+def check_filenames_and_scale(modules, work_dir):
+	"""ImageXpress filename parsing and the calibration set by set_scale in all three scripts."""
+	values = {}
+	for filename in ["20240311_B03_s1_w1.TIF", "20240311_N24_s4_w2.TIF", "20240311_B03_s1.TIF", "Plate_B03_s1_wX.TIF"]:
+		values["parse_filename " + filename] = modules["ImageXpress"].parse_filename(filename)
+	for name, module in sorted(modules.items()):
+		imp = module.set_scale(ImagePlus("Scale", ShortProcessor(8, 8)), PIXEL_WIDTH, PIXEL_UNIT)
+		values["set_scale " + name] = describe_image(imp)
+	return {}, values
+
+def check_nikon_hyperstack(modules, work_dir):
+	"""Assembly of processed Nikon frames into a hyperstack: channel order, frame order, _Loc{n} naming and calibration."""
+	nikon = modules["NikonTi2"]
+	nChannels, nFrames = 3, 4
+	channel_frame_paths = [[] for _ in range(nChannels)]
+	for channel in range(nChannels):
+		for frame_no in range(1, nFrames + 1):
+			frame = create_image("Frame", GOLDEN_WIDTH, GOLDEN_HEIGHT, 100 * channel + frame_no, *FLUORESCENCE)
+			frame_path = os.path.join(work_dir, "Synthetic_frame{}_channel{}_Loc1.tif".format(frame_no, channel))
+			FileSaver(frame).saveAsTiff(frame_path)
+			channel_frame_paths[channel].append(frame_path)
+
+	images = {}
+	values = {}
+	original_file_path = os.path.join(work_dir, "Synthetic.nd2")
+	for applyGaussian, multiLoc in [(True, True), (False, False)]:
+		output_filename_init = nikon.save_processed_image(channel_frame_paths, original_file_path, applyGaussian, multiLoc, 1)
+		output_filenames = sorted(filename for filename in os.listdir(work_dir) if filename.startswith(output_filename_init) and filename.endswith(".tif"))
+		name = "hyperstack" + ("_multiLoc" if multiLoc else "")
+		values[name + " filenames"] = output_filenames
+		output_path = os.path.join(work_dir, output_filename_init + ("_Loc2.tif" if multiLoc else ".tif"))
+		if os.path.exists(output_path):
+			images[name] = IJ.openImage(output_path)
+			values[name] = describe_image(images[name])
+			os.remove(output_path)
+	return images, values
+
+def check_imagexpress_well(modules, work_dir):
+	"""Assembly of processed ImageXpress site images into a well hyperstack: brightfield channel first, sites as slices, naming and calibration."""
+	imagexpress = modules["ImageXpress"]
+	well_dir = os.path.join(work_dir, "ImageXpress")
+	os.makedirs(well_dir)
+	files = []
+	for site in range(1, 4):
+		for channel, spec in [(1, FLUORESCENCE), (2, BRIGHTFIELD_16BIT)]:
+			filename = "20240311_B03_s{}_w{}.TIF".format(site, channel)
+			filepath = os.path.join(well_dir, filename)
+			FileSaver(create_image(filename, GOLDEN_WIDTH, GOLDEN_HEIGHT, 10 * site + channel, *spec)).saveAsTiff(filepath)
+			files.append((filepath, imagexpress.parse_filename(filename)))
+	# Channel 2 is brightfield and comes first, as ordered by get_user_input
+	channels_config = [imagexpress.ChannelConfig("Brightfield", 1, True), imagexpress.ChannelConfig("Fluorescence", 0, True)]
+	output_path = imagexpress.process_well("B03", files, channels_config, 2, well_dir, PIXEL_WIDTH, PIXEL_UNIT, None)
+	images = {"well": IJ.openImage(output_path)}
+	values = {"well filename": os.path.basename(output_path), "well": describe_image(images["well"])}
+	return images, values
+
+def check_dm6000b_image(modules, work_dir):
+	"""Processing of a two-channel DM6000B image from file to output: channel order, naming and calibration."""
+	dm6000b = modules["DM6000B"]
+	channels = [create_image("BF", GOLDEN_WIDTH, GOLDEN_HEIGHT, 31, *BRIGHTFIELD_16BIT), create_image("FL", GOLDEN_WIDTH, GOLDEN_HEIGHT, 32, *FLUORESCENCE)]
+	imp = RGBStackMerge.mergeChannels(channels, False)
+	imp.setCalibration(channels[0].getCalibration().copy())
+	filepath = os.path.join(work_dir, "Synthetic_DM6000B.tif")
+	FileSaver(imp).saveAsTiff(filepath)
+	dm6000b.save_processed_image(dm6000b.open_and_process_image(filepath, 0, 1), filepath)
+	output_path = os.path.join(work_dir, "Synthetic_DM6000B_Processed.tif")
+	images = {"image": IJ.openImage(output_path)} if os.path.exists(output_path) else {}
+	values = {"image filename exists": os.path.exists(output_path)}
+	if images:
+		values["image"] = describe_image(images["image"])
+	return images, values
+
+CHECKS = [
+	("processing", check_processing),
+	("filenames_and_scale", check_filenames_and_scale),
+	("NikonTi2_hyperstack", check_nikon_hyperstack),
+	("ImageXpress_well", check_imagexpress_well),
+	("DM6000B_image", check_dm6000b_image)
+]
+
+# Expected results that hold for any version of the scripts: each returns a list of (passed, message) tuples
+
+def expect_nucleoid_size_filter(modules, work_dir):
+	"""Single-pixel specks are below the smallest nucleoid area, so a plane with specks and one nucleoid counts 1 nucleoid."""
+	ip = ShortProcessor(GOLDEN_WIDTH, GOLDEN_HEIGHT)
+	ip.setValue(FLUORESCENCE[0])
+	ip.fill()
+	ip.setValue(FLUORESCENCE[0] + FLUORESCENCE[1])
+	ip.fillOval(GOLDEN_WIDTH // 2 - 10, GOLDEN_HEIGHT // 2 - 4, 20, 8)
+	for i in range(30):
+		ip.set(5 + (i * 37) % (GOLDEN_WIDTH - 10), 5 + (i * 23) % (GOLDEN_HEIGHT - 10), FLUORESCENCE[0] + FLUORESCENCE[1])
+	results = []
+	for name in ["NikonTi2", "ImageXpress"]:
+		imp = ImagePlus("Specks", ip.duplicate())
+		imp.getCalibration().pixelWidth = PIXEL_WIDTH
+		imp.getCalibration().pixelHeight = PIXEL_WIDTH
+		imp.getCalibration().setUnit(PIXEL_UNIT)
+		count = modules[name].measure_nucleoids(imp)[1]
+		results.append((count == 1, "{} nucleoid count with 30 single-pixel specks and 1 nucleoid: {} (expected 1)".format(name, count)))
+	return results
+
+def expect_integer_brightfield(modules, work_dir):
+	"""The integer brightfield processing of 16-bit images (BRIGHTFIELD_INTEGER) gives the same pixels as the 32-bit processing."""
+	results = []
+	for name in ["ImageXpress", "DM6000B"]:
+		module = modules[name]
+		if not hasattr(module, "BRIGHTFIELD_INTEGER"):
+			continue
+		enabled = module.BRIGHTFIELD_INTEGER
+		for width, height in [(GOLDEN_WIDTH, GOLDEN_HEIGHT), (PERFORMANCE_SIZE, PERFORMANCE_SIZE)]:
+			outputs = []
+			for integer in [False, True]:
+				module.BRIGHTFIELD_INTEGER = integer
+				outputs.append(module.process_brightfield(create_image("BF", width, height, 5, *BRIGHTFIELD_16BIT)))
+			module.BRIGHTFIELD_INTEGER = enabled
+			difference = max_difference(outputs[1], outputs[0])
+			results.append((difference == 0, "{} integer brightfield on {} x {} pixels: max pixel difference from 32-bit {} (expected 0)".format(name, width, height, difference)))
+	return results
+
+EXPECTATIONS = [expect_nucleoid_size_filter, expect_integer_brightfield]
+
+def get_performance_stages(modules, work_dir):
+	"""
+	:return: A list of (stage, function, plane spec) tuples; each function processes one synthetic plane given as ImagePlus.
+	"""
+	flatfield_configs = save_flatfield(modules, work_dir, PERFORMANCE_SIZE, PERFORMANCE_SIZE)
+	nikon = modules["NikonTi2"]
+	return [
+		("DM6000B brightfield", modules["DM6000B"].process_brightfield, BRIGHTFIELD_16BIT),
+		("DM6000B fluorescence", modules["DM6000B"].process_fluorescence, FLUORESCENCE),
+		("ImageXpress brightfield", modules["ImageXpress"].process_brightfield, BRIGHTFIELD_16BIT),
+		("ImageXpress fluorescence", modules["ImageXpress"].process_fluorescence, FLUORESCENCE),
+		("NikonTi2 brightfield", lambda imp: nikon.process_brightfield(imp, flatfield_configs, 0, True, 1.0), BRIGHTFIELD_12BIT),
+		("NikonTi2 fluorescence", lambda imp: nikon.process_fluorescence(imp, flatfield_configs, 1, PIXEL_WIDTH), FLUORESCENCE)
+	]
+
+def measure_stages(modules, work_dir):
+	"""
+	Times every stage on synthetic planes of PERFORMANCE_SIZE pixels.
+	:return: A dict of stage -> seconds per megapixel of the fastest of PERFORMANCE_REPEATS runs.
+	"""
+	megapixels = PERFORMANCE_SIZE * PERFORMANCE_SIZE / 1e6
+	seconds_per_megapixel = {}
+	for stage, function, spec in get_performance_stages(modules, work_dir):
+		plane = create_plane(PERFORMANCE_SIZE, PERFORMANCE_SIZE, 7, *spec)
+		function(ImagePlus("Warm-up", plane.duplicate())) # Not timed, so class loading and JIT compilation are left out
+		fastest = None
+		for repeat in range(PERFORMANCE_REPEATS):
+			imp = ImagePlus(stage, plane.duplicate())
+			start_time = time.time()
+			function(imp)
+			seconds = time.time() - start_time
+			fastest = seconds if fastest is None else min(fastest, seconds)
+		seconds_per_megapixel[stage] = fastest / megapixels
+	return seconds_per_megapixel
+
+def max_difference(imp, golden_imp):
+	"""Largest absolute pixel difference over all slices, or None if the images differ in dimensions or bit depth."""
+	if list(imp.getDimensions()) != list(golden_imp.getDimensions()) or imp.getBitDepth() != golden_imp.getBitDepth():
+		return None
+	stack, golden_stack = imp.getStack(), golden_imp.getStack()
+	difference = 0.0
+	for index in range(1, stack.getSize() + 1):
+		ip = stack.getProcessor(index).convertToFloat().duplicate()
+		ip.copyBits(golden_stack.getProcessor(index).convertToFloat(), 0, 0, Blitter.DIFFERENCE)
+		difference = max(difference, ip.getStatistics().max)
+	return difference
+
+def get_golden_image_path(golden_dir, check, name):
+	return os.path.join(golden_dir, "{}_{}.tif".format(check, name))
+
+def record(modules, golden_dir, work_dir, scripts_dir):
+	"""Runs all checks and stage timings and stores their outputs as golden files and budgets."""
+	golden = {"imagej": IJ.getFullVersion(), "recorded": time.strftime("%Y-%m-%d %H:%M:%S"), "scripts": scripts_dir,
+		"script_hashes": get_script_hashes(scripts_dir), "checks": {}, "budgets": {}}
+	print("Recording with the scripts in {}".format(scripts_dir))
+	for check, function in CHECKS:
+		images, values = function(modules, work_dir)
+		for name, imp in images.items():
+			FileSaver(imp).saveAsTiff(get_golden_image_path(golden_dir, check, name))
+		golden["checks"][check] = {"images": sorted(images), "values": values}
+		print("Recorded {}: {} image(s), {} value(s)".format(check, len(images), len(values)))
+	for stage, seconds in sorted(measure_stages(modules, work_dir).items()):
+		golden["budgets"][stage] = {"seconds_per_megapixel": seconds, "budget": seconds * PERFORMANCE_MARGIN}
+		print("Recorded {}: {:.3f} s/MP (budget {:.3f} s/MP)".format(stage, seconds, seconds * PERFORMANCE_MARGIN))
+	with open(os.path.join(golden_dir, GOLDEN_FILENAME), "w") as f:
+		json.dump(golden, f, indent=2, sort_keys=True)
+	print("Golden outputs saved in {}".format(golden_dir))
+
+def verify(modules, golden_dir, work_dir, scripts_dir):
+	"""
+	Reruns all checks and stage timings, compares them with the golden files and budgets, and checks the EXPECTATIONS.
+	:return: The number of failed comparisons.
+	"""
+	with open(os.path.join(golden_dir, GOLDEN_FILENAME), "r") as f:
+		golden = json.load(f)
+	if golden.get("imagej") != IJ.getFullVersion():
+		print("Note: golden outputs were recorded with ImageJ {}, running {}".format(golden.get("imagej"), IJ.getFullVersion()))
+	print("Verifying the scripts in {} against golden outputs recorded with the scripts in {}".format(scripts_dir, golden.get("scripts")))
+	recorded_hashes = golden.get("script_hashes", {})
+	for filename, script_hash in sorted(get_script_hashes(scripts_dir).items()):
+		print("{}: {}".format(filename, "same as recorded" if recorded_hashes.get(filename) == script_hash else "changed since recording"))
+
+	failures = []
+	def report(passed, message):
+		print("{}: {}".format("PASS" if passed else "FAIL", message))
+		if not passed:
+			failures.append(message)
+
+	for check, function in CHECKS:
+		golden_check = golden["checks"].get(check)
+		if golden_check is None:
+			report(False, "{} has no golden outputs".format(check))
+			continue
+		images, values = function(modules, work_dir)
+		values = json.loads(json.dumps(values)) # Same types as the loaded golden values
+		for name in sorted(set(values) | set(golden_check["values"])):
+			report(values.get(name) == golden_check["values"].get(name), "{} {}: {} (golden {})".format(check, name, values.get(name), golden_check["values"].get(name)))
+		for name in sorted(set(images) | set(golden_check["images"])):
+			golden_path = get_golden_image_path(golden_dir, check, name)
+			if name not in images or not os.path.exists(golden_path):
+				report(False, "{} {}: image missing from {}".format(check, name, "output" if name not in images else "golden outputs"))
+				continue
+			tolerance = PIXEL_TOLERANCES.get("{}_{}".format(check, name), 0)
+			difference = max_difference(images[name], IJ.openImage(golden_path))
+			if difference is None:
+				report(False, "{} {}: dimensions or bit depth differ from golden image".format(check, name))
+			else:
+				report(difference <= tolerance, "{} {}: max pixel difference {} (tolerance {})".format(check, name, difference, tolerance))
+
+	for expectation in EXPECTATIONS:
+		for passed, message in expectation(modules, work_dir):
+			report(passed, message)
+
+	for stage, seconds in sorted(measure_stages(modules, work_dir).items()):
+		budget = golden["budgets"].get(stage)
+		if budget is None:
+			report(False, "{}: no throughput budget".format(stage))
+		else:
+			report(seconds <= budget["budget"], "{}: {:.3f} s/MP (budget {:.3f} s/MP, recorded {:.3f} s/MP)".format(stage, seconds, budget["budget"], budget["seconds_per_megapixel"]))
+	return len(failures)
+
+def main():
+	script_dir = get_script_dir()
+	if script_dir is None:
+		return
+
+	gd = GenericDialog("Validate preprocessing")
+	gd.addChoice("Mode:", [MODE_VERIFY, MODE_RECORD], MODE_VERIFY)
+	gd.addDirectoryField("Golden output folder:", os.path.join(script_dir, "Validation_golden"))
+	gd.addDirectoryField("Reference scripts folder (record):", script_dir)
+	gd.addMessage("Record with the scripts before a change (e.g. a checkout of the previous commit), then verify the changed scripts.\nVerify fails on any pixel, layout or calibration difference and on stages slower than their budget.")
+	gd.showDialog()
+	if gd.wasCanceled():
+		return
+	mode = gd.getNextChoice()
+	golden_dir = gd.getNextString().strip()
+	reference_dir = gd.getNextString().strip()
+	if mode == MODE_RECORD:
+		if not os.path.exists(os.path.join(reference_dir, "Preprocessing_NikonTi2_images.py")):
+			IJ.error("No preprocessing scripts found in {}".format(reference_dir))
+			return
+		script_dir = reference_dir
+		if not os.path.isdir(golden_dir):
+			os.makedirs(golden_dir)
+	elif mode == MODE_VERIFY and not os.path.exists(os.path.join(golden_dir, GOLDEN_FILENAME)):
+		IJ.error("No golden outputs found in {}".format(golden_dir))
+		return
+
+	modules = import_preprocessing_modules(script_dir, "reference" if mode == MODE_RECORD else "current")
+	work_dir = tempfile.mkdtemp(prefix="Validate_Preprocessing_")
+	try:
+		if mode == MODE_RECORD:
+			record(modules, golden_dir, work_dir, script_dir)
+		else:
+			failures = verify(modules, golden_dir, work_dir, script_dir)
+			if failures:
+				IJ.error("Validate preprocessing", "{} check(s) failed, see the Log window.".format(failures))
+			else:
+				print("All checks passed.")
+	finally:
+		shutil.rmtree(work_dir, True)
+
+if __name__ in ['__builtin__', '__main__']:
+	main()